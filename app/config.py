@@ -1,5 +1,6 @@
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
+from typing import Literal, Optional
 
 class Settings(BaseSettings):
 
@@ -12,8 +13,97 @@ class Settings(BaseSettings):
     # Databases
     # ------------------------------------------------------------------------------
 
+    # Where the application's data lives: 'database' or 'memory'. The memory backend keeps
+    # everything in process and loses it on restart, intended for load tests and ephemeral
+    # staging environments. It requires running a single worker process.
+    STORAGE_BACKEND: Literal['database', 'memory'] = 'database'
+
     DB_URL: str = 'sqlite:///db.sqlite'
 
+    # Databases to shard messages across, keyed by conversation. When empty, messages are stored
+    # in the main database. Set via JSON, e.g. APP_MESSAGE_SHARD_URLS='["sqlite:///m0.sqlite", ...]'
+    # NOTE: changing this list moves conversations between shards, run 'rebalance-messages'
+    # before serving traffic with the new list.
+    MESSAGE_SHARD_URLS: list[str] = []
+
+    # Unit of work: when enabled, repositories used by API requests only flush their writes and
+    # each request commits them all at once before responding, rather than committing every write
+    # as it's made. Notifications and cache updates wait for the commit. This saves a commit per
+    # write, at the cost of holding SQLite's write lock from a request's first write until it ends.
+    DB_UNIT_OF_WORK: bool = False
+
+    # Archiving: the 'archive-messages' command moves messages older than ARCHIVE_AFTER_DAYS out of
+    # the message table and into compressed, immutable segment files under ARCHIVE_DIR, holding up
+    # to SEGMENT_MAX_MESSAGES messages apiece. Reads page into archived history transparently.
+    # Leave ARCHIVE_DIR unset to disable archiving. If RETENTION_DAYS is set, the same command
+    # deletes whole segments once their newest message is older than that.
+    MESSAGES_ARCHIVE_DIR: Optional[str] = None
+    MESSAGES_ARCHIVE_AFTER_DAYS: int = 90
+    MESSAGES_ARCHIVE_SEGMENT_MAX_MESSAGES: int = 10000
+    MESSAGES_RETENTION_DAYS: Optional[int] = None
+
+
+    # ------------------------------------------------------------------------------
+    # Messaging
+    # ------------------------------------------------------------------------------
+
+    # Number of messages returned per page when a client does not specify a limit
+    MESSAGES_PAGE_DEFAULT_LIMIT: int = 50
+
+    # Upper bound on the number of messages returned by a single page, regardless of
+    # the limit requested by the client
+    MESSAGES_PAGE_MAX_LIMIT: int = 200
+
+    # Number of conversations returned per page of a user's conversation list when a client does
+    # not specify a limit, and the upper bound regardless of the limit requested
+    CONVERSATIONS_PAGE_DEFAULT_LIMIT: int = 50
+    CONVERSATIONS_PAGE_MAX_LIMIT: int = 200
+
+    # Limits on multi-conversation polls: the number of conversations that may be polled at once,
+    # and the total number of messages returned across all of them
+    MESSAGES_POLL_MAX_CONVERSATIONS: int = 200
+    MESSAGES_POLL_MAX_TOTAL: int = 500
+
+    # Number of search results returned per page when a client does not specify a limit, and the
+    # upper bound regardless of the limit requested
+    SEARCH_PAGE_DEFAULT_LIMIT: int = 20
+    SEARCH_PAGE_MAX_LIMIT: int = 100
+
+    # Maximum number of messages that may be submitted in a single batch
+    MESSAGES_BATCH_MAX_SIZE: int = 1000
+
+    # Group commit: when enabled, messages posted by concurrent requests are inserted and committed
+    # together, up to MAX_BATCH messages at once, waiting no more than MAX_DELAY seconds for
+    # a batch to fill. This trades a few milliseconds of latency for far fewer fsyncs under load.
+    MESSAGES_GROUP_COMMIT_ENABLED: bool = False
+    MESSAGES_GROUP_COMMIT_MAX_BATCH: int = 256
+    MESSAGES_GROUP_COMMIT_MAX_DELAY: float = 0.002
+
+    # Hot-tail cache: when enabled, the newest TAIL_SIZE messages of recently active conversations
+    # are kept in memory so polls for recent messages are answered without a query. Conversations
+    # are evicted least-recently-used once the cache's estimated size exceeds MAX_BYTES.
+    # NOTE: the cache only sees messages written by its own process, only enable it when a single
+    # worker process serves message writes.
+    MESSAGES_CACHE_ENABLED: bool = False
+    MESSAGES_CACHE_TAIL_SIZE: int = 100
+    MESSAGES_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+
+    # Upper bound (in seconds) on how long a long-polling request may be parked waiting
+    # for new messages to arrive
+    MESSAGES_LONG_POLL_MAX_WAIT: float = 30.0
+
+    # Number of seconds between heartbeats sent to idle streaming clients
+    STREAM_HEARTBEAT_INTERVAL: float = 15.0
+
+    # Number of undelivered messages buffered per streaming client before it is considered
+    # too slow and disconnected
+    STREAM_SUBSCRIBER_QUEUE_SIZE: int = 256
+
+    # Number of seconds a websocket client has to authenticate after connecting
+    WEBSOCKET_AUTH_TIMEOUT: float = 10.0
+
+    # Maximum number of conversations a single websocket connection may subscribe to
+    WEBSOCKET_MAX_SUBSCRIPTIONS: int = 200
 
 
     # ------------------------------------------------------------------------------
@@ -23,6 +113,30 @@ class Settings(BaseSettings):
     # The port that the server will be operating from
     SERVER_PORT: int = 8000
 
+    # Conditional GETs: when enabled, polling endpoints send an ETag and answer a matching
+    # If-None-Match with 304 Not Modified without querying for the response. ETags are derived
+    # from activity seen by the serving process, so only enable this when a single worker
+    # process serves writes.
+    CONDITIONAL_GET_ENABLED: bool = False
+
+    # Operational counters (caches, password hashing) served at /stats/ to logged-in users. Off by
+    # default, as they describe the whole service rather than the user asking.
+    STATS_ENABLED: bool = False
+
+
+    # ------------------------------------------------------------------------------
+    # Password Hashing
+    # ------------------------------------------------------------------------------
+
+    # Passwords are hashed on a dedicated thread pool rather than on the event loop. Each hash
+    # allocates 64 MiB, so the number of hashes run concurrently is capped by this memory budget.
+    PASSWORD_HASHING_MAX_MEMORY: int = 256 * 1024 * 1024
+
+    # Number of hashes that may wait for a free worker. Beyond this, logins and registrations are
+    # refused with '503 Service Unavailable', asking clients to retry after RETRY_AFTER seconds.
+    PASSWORD_HASHING_MAX_QUEUE: int = 32
+    PASSWORD_HASHING_RETRY_AFTER: int = 2
+
 
     # ------------------------------------------------------------------------------
     # OAuth2 Configuration
@@ -34,6 +148,41 @@ class Settings(BaseSettings):
     # Number of seconds that an access token is valid
     OAUTH2_ACCESS_TOKEN_TIME_TO_LIVE: int = 8 * 60 * 60
 
+    # Access token format: 'opaque' tokens are random strings looked up in the database by every
+    # request, 'signed' tokens carry their user and expiry, signed with TOKEN_SECRET (which every
+    # worker must share), and are verified without a database read. Signed tokens logged out
+    # early are recorded in a revocation list that each worker re-reads every SYNC_INTERVAL
+    # seconds. Opaque tokens issued before switching to 'signed' remain valid until they expire.
+    OAUTH2_TOKEN_MODE: Literal['opaque', 'signed'] = 'opaque'
+    OAUTH2_TOKEN_SECRET: Optional[str] = None
+    OAUTH2_TOKEN_REVOCATION_SYNC_INTERVAL: int = 10
+
+    # Expired access tokens (and revocations) are deleted every SWEEP_INTERVAL seconds, or never
+    # if 0, in batches of SWEEP_BATCH_SIZE rows. Each batch is its own transaction, followed by a
+    # pause of SWEEP_BATCH_PAUSE seconds, so the sweep never holds the write lock for long.
+    OAUTH2_TOKEN_SWEEP_INTERVAL: int = 15 * 60
+    OAUTH2_TOKEN_SWEEP_BATCH_SIZE: int = 500
+    OAUTH2_TOKEN_SWEEP_BATCH_PAUSE: float = 0.05
+
+    # Authentication cache: remembers which user each bearer token belongs to, sparing requests
+    # the token and user lookups. Entries last TTL seconds at most (never beyond their token's
+    # expiry). Revoking tokens or changing users evicts them at once within the same process;
+    # other worker processes notice within TTL seconds.
+    # NOTE: a token logged out through one worker stays usable on the others for up to TTL
+    # seconds, only enable the cache when a single worker process serves the API.
+    AUTH_CACHE_ENABLED: bool = False
+    AUTH_CACHE_MAX_ENTRIES: int = 10000
+    AUTH_CACHE_TTL: int = 30
+
+    # User cache: users looked up by ID, username or email address are kept in memory for up to
+    # TTL seconds, up to MAX_ENTRIES of them, evicting the least recently used. Users written by
+    # this process are cached write-through; other worker processes notice within TTL seconds.
+    # NOTE: a user changed or deleted through one worker is still served by the others for up to
+    # TTL seconds, only enable the cache when a single worker process serves the API.
+    USER_CACHE_ENABLED: bool = False
+    USER_CACHE_MAX_ENTRIES: int = 10000
+    USER_CACHE_TTL: int = 60
+
 
 settings = Settings()
 
@@ -1,56 +1,331 @@
 
+from contextlib import asynccontextmanager, contextmanager
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from functools import cached_property
+from sqlalchemy import URL, make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlmodel import create_engine, Session
-from typing import Annotated, Self
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import Annotated, AsyncIterator, Callable, Dict, Iterator, List, Optional, Self, TypeVar
 
 from app.config import settings
-from app.repositories.accesstoken import AccessTokenRepository, DbAccessTokenRepository
-from app.repositories.conversation import ConversationRepository, DbConversationRepository
-from app.repositories.membership import MembershipRepository, DbMembershipRepository
-from app.repositories.message import MessageRepository, DbMessageRepository
-from app.repositories.user import UserRepository, DbUserRepository
+from app.hashing import PasswordHashingPool
+from app.repositories.accesstoken import (
+    AccessTokenRepository,
+    DbAccessTokenRepository,
+    InMemoryAccessTokenRepository
+)
+from app.repositories.archive import ArchivedMessageRepository
+from app.repositories.groupcommit import GroupCommitMessageWriter
+from app.repositories.conversation import (
+    ConversationRepository,
+    DbConversationRepository,
+    InMemoryConversationRepository
+)
+from app.repositories.membership import (
+    MembershipRepository,
+    DbMembershipRepository,
+    InMemoryMembershipRepository
+)
+from app.repositories.message import (
+    MessageRepository,
+    DbMessageRepository,
+    InMemoryMessageRepository,
+    ShardedMessageRepository
+)
+from app.repositories.messagecache import CachedMessageRepository, MessageTailCache
+from app.repositories.signedtoken import SignedAccessTokenRepository, TokenRevocationList, TokenSigner
+from app.repositories.tokencache import (
+    AuthenticationCache,
+    InvalidatingAccessTokenRepository,
+    InvalidatingUserRepository
+)
+from app.repositories.user import UserRepository, DbUserRepository, InMemoryUserRepository
+from app.repositories.unitofwork import (
+    begin_unit_of_work,
+    enable_savepoints,
+    end_unit_of_work,
+    in_unit_of_work
+)
+from app.repositories.usercache import CachedUserRepository, UserCache
 from app.models.user import User
+from app.notifications import NotificationBus, notification_bus
 
 from shared.time import get_current_time
 
 
+T = TypeVar('T')
+
+
 ###################################################################################################
 #
 #   Application Dependency Collections
 #
 ###################################################################################################
 
+class InMemoryStore:
+    '''
+    Process-wide repositories backing the 'memory' storage backend
+    '''
+
+    def __init__(self):
+        self.membership_repository = InMemoryMembershipRepository()
+        self.message_repository = InMemoryMessageRepository()
+        self.token_repository = InMemoryAccessTokenRepository()
+        self.user_repository = InMemoryUserRepository()
+        self.conversation_repository = InMemoryConversationRepository(
+            self.membership_repository,
+            self.user_repository
+        )
+
+
+
 class AppDependencyCollection:
 
-    def __init__(self, session: Session):
+    def __init__(self, session: Session, unit_of_work: bool = False):
+        '''
+        When 'unit_of_work' is set, repositories only flush their writes and the container's owner
+        commits them, see commit()
+        '''
         self.session = session
+        self.shard_sessions: Dict[int, Session] = {}
+
+        self.unit_of_work = unit_of_work
+        self.after_commit_callbacks: List[Callable[[], None]] = []
+        if unit_of_work:
+            begin_unit_of_work(session)
+
+
+    @property
+    def sessions(self) -> List[Session]:
+        '''
+        Every session opened by this container: the main database's and any message shards'
+        '''
+        return [self.session, *self.shard_sessions.values()]
+
+
+    def get_shard_session(self, index: int) -> Session:
+        '''
+        Retrieves the session for the specified message shard, opening it on first use
+        '''
+        session = self.shard_sessions.get(index, None)
+        if session is None:
+            session = ShardSessionFactories[index]()
+            if self.unit_of_work:
+                begin_unit_of_work(session)
+            self.shard_sessions[index] = session
+        return session
 
 
     @cached_property
     def conversation_repository(self) -> ConversationRepository:
+        if settings.STORAGE_BACKEND == 'memory':
+            return memory_store.conversation_repository
         return DbConversationRepository(self.session)
 
 
     @cached_property
     def membership_repository(self) -> MembershipRepository:
+        if settings.STORAGE_BACKEND == 'memory':
+            return memory_store.membership_repository
         return DbMembershipRepository(self.session)
 
 
     @cached_property
     def message_repository(self) -> MessageRepository:
-        return DbMessageRepository(self.session)
+        if settings.STORAGE_BACKEND == 'memory':
+            return memory_store.message_repository
+        repository: MessageRepository
+        if ShardSessionFactories:
+            repository = ShardedMessageRepository(self.get_shard_session, len(ShardSessionFactories))
+        else:
+            repository = DbMessageRepository(self.session)
+
+        if settings.MESSAGES_ARCHIVE_DIR is not None:
+            repository = ArchivedMessageRepository(repository, self.session, settings.MESSAGES_ARCHIVE_DIR)
+
+        if self.message_cache is not None:
+            return CachedMessageRepository(repository, self.message_cache, self.after_commit)
+        return repository
+
+
+    @cached_property
+    def message_cache(self) -> Optional[MessageTailCache]:
+        '''
+        The process-wide hot-tail message cache, or None if caching is disabled
+        '''
+        if settings.STORAGE_BACKEND == 'memory' or not settings.MESSAGES_CACHE_ENABLED:
+            return None
+        return message_cache
+
+
+    @cached_property
+    def message_writer(self) -> Optional[GroupCommitMessageWriter]:
+        '''
+        The process-wide group-commit writer for messages, or None if group commit is disabled
+        '''
+        if settings.STORAGE_BACKEND == 'memory' or not settings.MESSAGES_GROUP_COMMIT_ENABLED:
+            return None
+        return group_commit_writer
+
+
+    @cached_property
+    def password_hasher(self) -> PasswordHashingPool:
+        return password_hashing_pool
+
+
+    @cached_property
+    def authentication_cache(self) -> Optional[AuthenticationCache]:
+        '''
+        The process-wide token authentication cache, or None if caching is disabled
+        '''
+        if settings.STORAGE_BACKEND == 'memory' or not settings.AUTH_CACHE_ENABLED:
+            return None
+        return authentication_cache
+
+
+    @cached_property
+    def user_cache(self) -> Optional[UserCache]:
+        '''
+        The process-wide user cache, or None if caching is disabled
+        '''
+        if settings.STORAGE_BACKEND == 'memory' or not settings.USER_CACHE_ENABLED:
+            return None
+        return user_cache
 
 
     @cached_property
     def token_repository(self) -> AccessTokenRepository:
-        return DbAccessTokenRepository(self.session)
+        if settings.STORAGE_BACKEND == 'memory':
+            repository = memory_store.token_repository
+        else:
+            repository = DbAccessTokenRepository(self.session)
+
+        if token_signer is not None:
+            repository = SignedAccessTokenRepository(
+                repository,
+                token_signer,
+                token_revocations,
+                self.session if settings.STORAGE_BACKEND != 'memory' else None
+            )
+
+        if self.authentication_cache is not None:
+            return InvalidatingAccessTokenRepository(repository, self.authentication_cache, self.after_commit)
+        return repository
+
 
     @cached_property
     def user_repository(self) -> UserRepository:
-        return DbUserRepository(self.session)
+        if settings.STORAGE_BACKEND == 'memory':
+            return memory_store.user_repository
+        repository: UserRepository = DbUserRepository(self.session)
+
+        if self.user_cache is not None:
+            repository = CachedUserRepository(repository, self.user_cache, self.after_commit)
+
+        if self.authentication_cache is not None:
+            return InvalidatingUserRepository(repository, self.authentication_cache, self.after_commit)
+        return repository
+
+
+    @cached_property
+    def notification_bus(self) -> NotificationBus:
+        return notification_bus
+
+
+    def after_commit(self, callback: Callable[[], None]) -> None:
+        '''
+        Runs the callback (e.g. publishing a notification) once the writes made so far have been
+        committed: immediately, unless in a unit of work or a transaction()
+        '''
+        if in_unit_of_work(self.session):
+            self.after_commit_callbacks.append(callback)
+        else:
+            callback()
+
+
+    def commit(self) -> None:
+        '''
+        Commits the writes made through this container, then runs the callbacks awaiting them
+        '''
+        for session in self.sessions:
+            session.commit()
+        self.run_after_commit_callbacks()
+
+
+    def rollback(self) -> None:
+        for session in self.sessions:
+            session.rollback()
+        self.after_commit_callbacks.clear()
+
+
+    def run_after_commit_callbacks(self) -> None:
+        callbacks, self.after_commit_callbacks = self.after_commit_callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        '''
+        Commits the enclosed writes to the main database together as the block exits, or rolls
+        them all back if it raises. Callbacks they schedule via after_commit() run only once
+        they're committed. Message shards are separate databases, so writes to them still
+        commit on their own. Within a unit of work the writes are left for its owner to commit.
+        '''
+        if self.unit_of_work:
+            yield
+            return
+
+        begin_unit_of_work(self.session)
+        try:
+            yield
+            self.session.commit()
+        except:
+            self.session.rollback()
+            self.after_commit_callbacks.clear()
+            raise
+        finally:
+            end_unit_of_work(self.session)
+        self.run_after_commit_callbacks()
+
+
+    @contextmanager
+    def savepoint(self) -> Iterator[None]:
+        '''
+        Within a unit of work, makes the enclosed writes to the main database all-or-nothing
+        without committing them: if the block raises, only its own writes are undone. Outside
+        of a unit of work every write is committed as it's made, so this does nothing.
+        '''
+        if not self.unit_of_work:
+            yield
+            return
+
+        with self.session.begin_nested():
+            yield
+
+
+    def release(self) -> None:
+        '''
+        Returns any database connection held by this container to the pool. The container remains
+        usable and will check out a fresh connection upon its next query. This is intended for
+        requests that park for long periods (e.g. long-polling) so they don't starve the pool.
+        Within a unit of work, the writes made so far are committed first.
+        '''
+        if self.unit_of_work:
+            self.commit()
+        for session in self.sessions:
+            session.close()
+
+
+    async def run_sync(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        '''
+        Runs synchronous database work (e.g. a service call) on behalf of async code. This
+        container's sessions use blocking drivers, so the work simply runs inline.
+        '''
+        return fn(*args, **kwargs)
 
 
     def __call__(self) -> Self:
@@ -63,29 +338,174 @@ class AppDependencyCollection:
 
 
 
+class AsyncAppDependencyCollection(AppDependencyCollection):
+    '''
+    Dependency container for the API's async routes. Its sessions run on asyncio drivers, so the
+    existing repositories and services can be used unchanged provided they're called through
+    run_sync(), which runs them without blocking the event loop while queries are in flight.
+    '''
+
+    def __init__(self, session: AsyncSession, unit_of_work: bool = False):
+        super().__init__(session.sync_session, unit_of_work)
+        self.async_session = session
+        self.async_shard_sessions: Dict[int, AsyncSession] = {}
+
+
+    @property
+    def async_sessions(self) -> List[AsyncSession]:
+        return [self.async_session, *self.async_shard_sessions.values()]
+
+
+    def get_shard_session(self, index: int) -> Session:
+        '''
+        Retrieves the session for the specified message shard, opening it on first use
+        '''
+        session = self.async_shard_sessions.get(index, None)
+        if session is None:
+            session = AsyncShardSessionFactories[index]()
+            if self.unit_of_work:
+                begin_unit_of_work(session.sync_session)
+            self.async_shard_sessions[index] = session
+            self.shard_sessions[index] = session.sync_session
+        return session.sync_session
+
+
+    async def run_sync(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        '''
+        Runs synchronous database work (e.g. a service call) on behalf of async code. Queries made
+        by the work suspend it rather than block, letting the event loop serve other requests.
+        '''
+        return await self.async_session.run_sync(lambda _: fn(*args, **kwargs))
+
+
+
 ###################################################################################################
 #
 #   FastAPI Dependency-Injected Helpers
 #
 ###################################################################################################
 
-db_engine = create_engine(settings.DB_URL)
-SessionFactory = sessionmaker(bind=db_engine, autoflush=False, autocommit=False)
+memory_store = InMemoryStore()
 
-def get_engine():
+db_engine = create_engine(settings.DB_URL)
+SessionFactory = sessionmaker(bind=db_engine, class_=Session, autoflush=False, autocommit=False)
+
+# Message shards, each with its own engine and session factory
+shard_engines = [create_engine(x) for x in settings.MESSAGE_SHARD_URLS]
+ShardSessionFactories = [
+    sessionmaker(bind=x, class_=Session, autoflush=False, autocommit=False) for x in shard_engines
+]
+
+message_cache = MessageTailCache(
+    max_entries_per_conversation=settings.MESSAGES_CACHE_TAIL_SIZE,
+    max_bytes=settings.MESSAGES_CACHE_MAX_BYTES
+)
+
+# Signs access tokens when they're self-contained rather than stored, see OAUTH2_TOKEN_MODE
+token_signer = TokenSigner(settings.OAUTH2_TOKEN_SECRET) if settings.OAUTH2_TOKEN_MODE == 'signed' else None
+token_revocations = TokenRevocationList(sync_interval=settings.OAUTH2_TOKEN_REVOCATION_SYNC_INTERVAL)
+
+authentication_cache = AuthenticationCache(
+    max_entries=settings.AUTH_CACHE_MAX_ENTRIES,
+    time_to_live=settings.AUTH_CACHE_TTL
+)
+
+user_cache = UserCache(
+    max_entries=settings.USER_CACHE_MAX_ENTRIES,
+    time_to_live=settings.USER_CACHE_TTL
+)
+
+password_hashing_pool = PasswordHashingPool(
+    max_memory=settings.PASSWORD_HASHING_MAX_MEMORY,
+    max_queue_size=settings.PASSWORD_HASHING_MAX_QUEUE
+)
+
+def get_async_url(url: str) -> URL:
+    '''
+    Maps a database URL onto the equivalent URL for its asyncio driver
+    '''
+    parsed = make_url(url)
+    if parsed.drivername == 'sqlite':
+        parsed = parsed.set(drivername='sqlite+aiosqlite')
+    return parsed
+
+# Asyncio counterparts of the engines above, used by the API's routes so queries don't block the
+# event loop. The synchronous engines remain for the CLI commands and for background work.
+async_db_engine = create_async_engine(get_async_url(settings.DB_URL))
+AsyncSessionFactory = async_sessionmaker(bind=async_db_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+async_shard_engines = [create_async_engine(get_async_url(x)) for x in settings.MESSAGE_SHARD_URLS]
+AsyncShardSessionFactories = [
+    async_sessionmaker(bind=x, class_=AsyncSession, autoflush=False, expire_on_commit=False) for x in async_shard_engines
+]
+
+# Units of work rely on savepoints to recover from a failed write without losing the others
+if settings.DB_UNIT_OF_WORK:
+    for x in [async_db_engine, *async_shard_engines]:
+        enable_savepoints(x.sync_engine)
+
+group_commit_writer = GroupCommitMessageWriter(
+    ShardSessionFactories or [SessionFactory],
+    max_batch_size=settings.MESSAGES_GROUP_COMMIT_MAX_BATCH,
+    max_delay=settings.MESSAGES_GROUP_COMMIT_MAX_DELAY,
+    summary_session_factory=SessionFactory,
+    cache=message_cache if settings.MESSAGES_CACHE_ENABLED else None
+)
+
+def get_engine(unit_of_work: bool = False) -> Iterator[AppDependencyCollection]:
     '''
     Retrieves the current application dependency container (aka "engine")
     '''
     session = SessionFactory()
+    app_engine = AppDependencyCollection(session, unit_of_work)
     try:
-        app_engine = AppDependencyCollection(session)
         yield app_engine
-        session.commit()
+        app_engine.commit()
     except:
-        session.rollback()
+        app_engine.rollback()
         raise
     finally:
-        session.close()
+        for x in app_engine.sessions:
+            x.close()
+
+
+@contextmanager
+def open_engine(unit_of_work: bool = False) -> Iterator[AppDependencyCollection]:
+    '''
+    Context-managed equivalent of get_engine(), for code that runs outside of a request's
+    dependency scope (e.g. the body of a streaming response)
+    '''
+    yield from get_engine(unit_of_work)
+
+
+@asynccontextmanager
+async def open_async_engine(unit_of_work: bool = False) -> AsyncIterator[AsyncAppDependencyCollection]:
+    '''
+    Asyncio equivalent of open_engine()
+    '''
+    app_engine = AsyncAppDependencyCollection(AsyncSessionFactory(), unit_of_work)
+    try:
+        yield app_engine
+        for x in app_engine.async_sessions:
+            await x.commit()
+        app_engine.run_after_commit_callbacks()
+    except:
+        for x in app_engine.async_sessions:
+            await x.rollback()
+        app_engine.after_commit_callbacks.clear()
+        raise
+    finally:
+        for x in app_engine.async_sessions:
+            await x.close()
+
+
+async def get_async_engine() -> AsyncIterator[AsyncAppDependencyCollection]:
+    '''
+    Retrieves the current application dependency container for async routes. Routes depend on it
+    with the 'function' scope, so its writes are committed before the response is sent.
+    '''
+    async with open_async_engine(settings.DB_UNIT_OF_WORK) as app_engine:
+        yield app_engine
 
 
 # Specifies our desired OAuth2 access scheme
@@ -98,13 +518,17 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl='/auth/login')
 # 'authorization' header
 AccessTokenDependency = Annotated[str, Depends(oauth2_scheme)]
 
-def get_user_from_token(
-    app_engine: Annotated[AppDependencyCollection, Depends(get_engine)],
-    token: AccessTokenDependency
-) -> User:
+def get_user_from_token(app_engine: AppDependencyCollection, token: str) -> User:
     '''
     Retrieves the user associated with the specified token
+    Raises HTTPException if the token isn't valid
     '''
+    cache = app_engine.authentication_cache
+    if cache is not None:
+        user = cache.get_user(token)
+        if user is not None:
+            return user
+        generation = cache.generation
 
     # Grab the access token specified
     access_token = app_engine.token_repository.get_token_by_id(token)
@@ -132,10 +556,22 @@ def get_user_from_token(
             detail="invalid token"
         )
 
+    if cache is not None:
+        cache.put(access_token, user, generation)
     return user
 
 
+async def get_current_user(
+    app_engine: Annotated[AsyncAppDependencyCollection, Depends(get_async_engine, scope='function')],
+    token: AccessTokenDependency
+) -> User:
+    '''
+    Retrieves the user associated with the request's access token
+    '''
+    return await app_engine.run_sync(get_user_from_token, app_engine, token)
+
+
 # Dependency class for the current authenticated user, to be used for
 # endpoints requring the user requesting the operation.
-CurrentUserDependency = Annotated[User, Depends(get_user_from_token)]
+CurrentUserDependency = Annotated[User, Depends(get_current_user, scope='function')]
 
@@ -1,13 +1,28 @@
 
 from datetime import datetime
 from pydantic import BaseModel, EmailStr
-from typing import List
+from typing import Dict, List, Optional
 
 class PublicConversationDTO(BaseModel):
     name: str
     participants: List[str]
 
 
+class ConversationSummaryDTO(BaseModel):
+    id: str
+    name: str
+    participants: List[str]
+    last_message_id: Optional[int]
+    last_activity_at: datetime
+    message_count: int
+
+
+class ConversationPageDTO(BaseModel):
+    conversations: List[ConversationSummaryDTO]
+    next_cursor: Optional[str]
+    has_more: bool
+
+
 class NewConversationRequestDTO(BaseModel):
     name: str
     participants: list[str]
@@ -17,9 +32,37 @@ class SendMessageDTO(BaseModel):
     content: str
 
 
+class BatchMessagesResponseDTO(BaseModel):
+    ids: List[int]
+
+
 class ConversationMessageDTO(BaseModel):
     id: int
     created_at: datetime
     sender: str
     sender_id: str
     content: str
+
+
+class ConversationMessagePageDTO(BaseModel):
+    messages: List[ConversationMessageDTO]
+    next_cursor: Optional[int]
+    has_more: bool
+
+
+class ConversationPollDTO(BaseModel):
+    conversations: Dict[str, ConversationMessagePageDTO]
+    has_more: bool
+
+
+class MessageSearchHitDTO(BaseModel):
+    conversation_id: str
+    message: ConversationMessageDTO
+    snippet: str
+    rank: float
+
+
+class MessageSearchPageDTO(BaseModel):
+    results: List[MessageSearchHitDTO]
+    next_cursor: Optional[str]
+    has_more: bool
@@ -0,0 +1,25 @@
+
+from pydantic import BaseModel
+from typing import Literal, Optional
+
+class AuthFrameDTO(BaseModel):
+    type: Literal['auth']
+    token: str
+
+
+class SubscribeFrameDTO(BaseModel):
+    type: Literal['subscribe']
+    conversation_id: str
+    after: Optional[int] = None
+
+
+class UnsubscribeFrameDTO(BaseModel):
+    type: Literal['unsubscribe']
+    conversation_id: str
+
+
+class SendFrameDTO(BaseModel):
+    type: Literal['send']
+    conversation_id: str
+    content: str
+    ref: Optional[str] = None
@@ -0,0 +1,98 @@
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Tuple, TypeVar
+
+from shared.password import get_memory_cost, hash_password, verify_password
+
+
+T = TypeVar('T')
+
+
+class PasswordHashingBusyError(Exception):
+    '''
+    Raised when the password hashing queue is full
+    '''
+
+
+
+class PasswordHashingPool:
+    '''
+    Runs password hashing on a dedicated thread pool, keeping it off the event loop (Argon2
+    releases the GIL while it works). Every hash allocates a fixed amount of memory, so the number
+    of workers is derived from a memory budget. Requests beyond that wait for a free worker, and
+    once 'max_queue_size' are waiting, further requests are refused with PasswordHashingBusyError
+    rather than being left to pile up.
+
+    NOTE: all methods are expected to be called from the event loop's thread.
+    '''
+
+    def __init__(self, max_memory: int, max_queue_size: int):
+        self.max_workers = max(1, max_memory // get_memory_cost())
+        self.max_queue_size = max_queue_size
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='password-hashing')
+
+        # Requests either running or waiting for a worker
+        self.pending = 0
+
+        self.completed = 0
+        self.rejected = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.hash_time_total = 0.0
+        self.hash_time_max = 0.0
+
+
+    def get_stats(self) -> Dict[str, float]:
+        return {
+            'workers': self.max_workers,
+            'pending': self.pending,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'queue_wait_seconds_total': self.queue_wait_total,
+            'queue_wait_seconds_max': self.queue_wait_max,
+            'hash_seconds_total': self.hash_time_total,
+            'hash_seconds_max': self.hash_time_max
+        }
+
+
+    async def hash_password(self, plaintext: str) -> str:
+        '''
+        Hashes the specified plaintext into a password hash safe for storage
+        Raises PasswordHashingBusyError if the queue is full
+        '''
+        return await self._run(hash_password, plaintext)
+
+
+    async def verify_password(self, plaintext: str, hashed: str) -> bool:
+        '''
+        Returns True when the specified plaintext corresponds to the hashed value
+        Raises PasswordHashingBusyError if the queue is full
+        '''
+        return await self._run(verify_password, plaintext, hashed)
+
+
+    async def _run(self, fn: Callable[..., T], *args) -> T:
+        if self.pending >= self.max_workers + self.max_queue_size:
+            self.rejected += 1
+            raise PasswordHashingBusyError('Too many passwords waiting to be hashed')
+
+        def timed() -> Tuple[T, float, float]:
+            started = time.perf_counter()
+            result = fn(*args)
+            return result, started, time.perf_counter()
+
+        self.pending += 1
+        submitted = time.perf_counter()
+        try:
+            result, started, finished = await asyncio.get_running_loop().run_in_executor(self.executor, timed)
+        finally:
+            self.pending -= 1
+
+        self.completed += 1
+        self.queue_wait_total += started - submitted
+        self.queue_wait_max = max(self.queue_wait_max, started - submitted)
+        self.hash_time_total += finished - started
+        self.hash_time_max = max(self.hash_time_max, finished - started)
+        return result
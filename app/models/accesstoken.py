@@ -1,6 +1,7 @@
 
 from datetime import datetime, timedelta
-from sqlmodel import SQLModel, Field, Column
+from sqlmodel import SQLModel, Field, Column, Index
+from typing import Optional
 import secrets
 
 from app.config import settings
@@ -8,11 +9,19 @@ from shared.column import DateTimeUTC
 from shared.time import get_current_time
 
 class AccessToken(SQLModel, table=True):
+    __table_args__ = (
+        # Serves sweeping expired tokens
+        Index('ix_accesstoken_expires_at', 'expires_at'),
+    )
+
     id: str = Field(primary_key=True, default_factory=lambda: AccessToken.generate_id())
     user_id: str
     created_at: datetime = Field(default_factory=get_current_time, sa_column=Column(DateTimeUTC))
     time_to_live: int
 
+    # Always created_at + time_to_live, stored so that expired tokens can be found by index
+    expires_at: datetime = Field(sa_column=Column(DateTimeUTC, nullable=False))
+
 
     @classmethod
     def generate_id(cls) -> str:
@@ -24,7 +33,39 @@ class AccessToken(SQLModel, table=True):
         return settings.OAUTH2_ACCESS_TOKEN_TIME_TO_LIVE
 
 
-    @property
-    def expires_at(self):
-        return self.created_at + timedelta(seconds=self.time_to_live)
+    @classmethod
+    def issue(
+        cls,
+        user_id: str,
+        id: Optional[str] = None,
+        created_at: Optional[datetime] = None,
+        time_to_live: Optional[int] = None
+    ) -> 'AccessToken':
+        '''
+        Creates a new token for the user, filling in its expiry
+        '''
+        created_at = created_at if created_at is not None else get_current_time()
+        time_to_live = time_to_live if time_to_live is not None else cls.default_time_to_live()
+        return cls(
+            id=id if id is not None else cls.generate_id(),
+            user_id=user_id,
+            created_at=created_at,
+            time_to_live=time_to_live,
+            expires_at=created_at + timedelta(seconds=time_to_live)
+        )
+
+
+
+class RevokedAccessToken(SQLModel, table=True):
+    '''
+    A signed access token that was logged out before it expired. Signed tokens aren't stored, so
+    they can only be revoked by listing them here until they would have expired anyway.
+    '''
+    __table_args__ = (
+        # Serves syncing the revocation list, which only concerns tokens yet to expire
+        Index('ix_revokedaccesstoken_expires_at', 'expires_at'),
+    )
 
+    # The token's unique identifier (its 'jti'), rather than the token itself
+    id: str = Field(primary_key=True)
+    expires_at: datetime = Field(sa_column=Column(DateTimeUTC, nullable=False))
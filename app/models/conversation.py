@@ -1,7 +1,8 @@
 
 from datetime import datetime
-from sqlmodel import SQLModel, Field, Column
+from sqlmodel import SQLModel, Field, Column, Index
 from pydantic import EmailStr
+from typing import Optional
 import uuid
 
 from shared.column import DateTimeUTC
@@ -16,3 +17,20 @@ class Conversation(SQLModel, table=True):
     def generate_id(cls) -> str:
         return str(uuid.uuid4())
 
+
+
+
+class ConversationSummary(SQLModel, table=True):
+    '''
+    Denormalized activity of a conversation, maintained by the message write path so that
+    conversation lists can be built and ordered by activity without touching any messages
+    '''
+    __table_args__ = (
+        # Serves conversation lists, which are ordered by most recent activity
+        Index('ix_conversationsummary_last_activity_at', 'last_activity_at', 'conversation_id'),
+    )
+
+    conversation_id: str = Field(primary_key=True)
+    last_message_id: Optional[int] = None
+    last_activity_at: datetime = Field(sa_column=Column(DateTimeUTC, nullable=False))
+    message_count: int = 0
@@ -1,12 +1,19 @@
 
 from datetime import datetime
-from sqlmodel import SQLModel, Field, Column
+from sqlmodel import SQLModel, Field, Column, Index
 from typing import Optional
 
 from shared.column import DateTimeUTC
 from shared.time import get_current_time
 
 class Membership(SQLModel, table=True):
+    __table_args__ = (
+        # A user can only be a member of a conversation once. This doubles as the index
+        # for looking up a conversation's participants.
+        Index('ix_membership_conversation_id_user_id', 'conversation_id', 'user_id', unique=True),
+        Index('ix_membership_user_id', 'user_id'),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: str
     conversation_id: str
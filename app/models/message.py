@@ -1,15 +1,50 @@
 
 from datetime import datetime
-from sqlmodel import SQLModel, Field, Column
+from sqlalchemy import DDL, event
+from sqlmodel import SQLModel, Field, Column, Index
 from typing import Optional
 
 from shared.column import DateTimeUTC
 from shared.time import get_current_time
 
 class Message(SQLModel, table=True):
+    __table_args__ = (
+        # Serves every per-conversation read: filtering on the conversation and walking IDs in order
+        Index('ix_message_conversation_id_id', 'conversation_id', 'id'),
+
+        # Serves finding the messages due for archiving without scanning the whole table
+        Index('ix_message_created_at_conversation_id', 'created_at', 'conversation_id'),
+
+        # IDs double as client cursors, so they must never be reused once allocated. This also lets
+        # each message shard's ID sequence be seeded at a distinct starting point.
+        {'sqlite_autoincrement': True}
+    )
+
     id: Optional[int] = Field(primary_key=True, default=None)
     conversation_id: str
     sender_id: str
     content: str
     created_at: datetime = Field(default_factory=get_current_time, sa_column=Column(DateTimeUTC))
 
+
+# Full-text index over message content (SQLite FTS5). It's an external-content table, so the text
+# itself is only stored once in the message table. Triggers keep it in step with the message
+# table, which covers every write path: single posts, batches, group commit and shard moves.
+# Statements are idempotent so they can also be applied to databases that predate the index.
+MESSAGE_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5("
+    "content, content='message', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+
+    "CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON message BEGIN "
+    "INSERT INTO message_fts (rowid, content) VALUES (new.id, new.content); END",
+
+    "CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON message BEGIN "
+    "INSERT INTO message_fts (message_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+
+    "CREATE TRIGGER IF NOT EXISTS message_fts_update AFTER UPDATE OF content ON message BEGIN "
+    "INSERT INTO message_fts (message_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO message_fts (rowid, content) VALUES (new.id, new.content); END"
+]
+
+for statement in MESSAGE_SEARCH_DDL:
+    event.listen(SQLModel.metadata.tables['message'], 'after_create', DDL(statement).execute_if(dialect='sqlite'))
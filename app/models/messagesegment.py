@@ -0,0 +1,53 @@
+from datetime import datetime
+from sqlalchemy import DDL, event
+from sqlmodel import SQLModel, Field, Column, Index
+from typing import Optional
+
+from shared.column import DateTimeUTC
+from shared.time import get_current_time
+
+class MessageSegment(SQLModel, table=True):
+    '''
+    An immutable, compressed file holding a contiguous run of a conversation's archived messages
+    '''
+    __table_args__ = (
+        # Serves locating a conversation's segments in ID order
+        Index('ix_messagesegment_conversation_id_first_message_id', 'conversation_id', 'first_message_id'),
+
+        # Serves retention, which drops the segments whose newest message has aged out
+        Index('ix_messagesegment_last_created_at', 'last_created_at'),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    conversation_id: str
+
+    # Location of the segment file, relative to MESSAGES_ARCHIVE_DIR
+    path: str
+
+    first_message_id: int
+    last_message_id: int
+    message_count: int
+    size: int
+    first_created_at: datetime = Field(sa_column=Column(DateTimeUTC, nullable=False))
+    last_created_at: datetime = Field(sa_column=Column(DateTimeUTC, nullable=False))
+    created_at: datetime = Field(default_factory=get_current_time, sa_column=Column(DateTimeUTC))
+
+
+# Full-text index over archived message content (SQLite FTS5), with one entry per segment: its
+# rowid is the segment's ID and its content the text of all of the segment's messages. It's
+# contentless, as the text itself lives in the compressed segments, so archiving still saves space.
+#
+# Entries can only be removed given their original text, so retention leaves a dropped segment's
+# entry behind rather than reading the segment back. Searches join through MessageSegment, so such
+# entries are never returned, and every hit is confirmed against the message's own text. Rebuilding
+# the index reclaims their space.
+ARCHIVED_SEGMENT_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS archived_segment_fts USING fts5("
+    "content, content='', tokenize='unicode61 remove_diacritics 2')"
+]
+
+# Tables of the previous, per-message index, replaced by archived_segment_fts
+LEGACY_ARCHIVED_SEARCH_TABLES = ['archived_message_fts', 'archivedmessage']
+
+for statement in ARCHIVED_SEGMENT_SEARCH_DDL:
+    event.listen(SQLModel.metadata.tables['messagesegment'], 'after_create', DDL(statement).execute_if(dialect='sqlite'))
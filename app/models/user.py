@@ -10,8 +10,8 @@ from shared.time import get_current_time
 
 class User(SQLModel, table=True):
     id: str = Field(primary_key=True, default_factory=lambda: User.generate_id())
-    username: str
-    email: EmailStr
+    username: str = Field(unique=True, index=True)
+    email: EmailStr = Field(unique=True, index=True)
     pwhash: str
     created_at: datetime = Field(default_factory=get_current_time, sa_column=Column(DateTimeUTC))
     deleted_at: Optional[datetime] = None
@@ -0,0 +1,208 @@
+
+import asyncio
+import secrets
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, Iterable, Set, Tuple
+
+from app.dto.conversation import ConversationMessageDTO
+
+
+@dataclass(frozen=True)
+class MessageEvent:
+    conversation_id: str
+    message_id: int
+
+    # JSON-encoded ConversationMessageDTO, serialized once and shared by every subscriber
+    payload: str
+
+
+
+class Subscription:
+    '''
+    A subscriber's mailbox on the bus: a bounded queue of message events for the conversations
+    it has subscribed to. Subscribers that let their queue fill up are evicted rather than being
+    allowed to grow server memory; they're expected to reconnect and catch up from storage.
+    '''
+
+    def __init__(self, max_queue_size: int):
+        self.queue: asyncio.Queue[MessageEvent] = asyncio.Queue(maxsize=max_queue_size)
+        self.conversation_ids: Set[str] = set()
+        self.evicted = False
+
+
+
+class NotificationBus:
+    '''
+    In-process notification bus for conversation activity. The bus tracks the newest message ID
+    it has seen for each conversation and allows coroutines to park until a conversation moves
+    beyond a given message.
+
+    NOTE: state is kept per-process. Messages posted through another worker process will not wake
+    requests parked here; those requests will instead pick up the message when their wait expires.
+    All methods are expected to be called from the event loop's thread.
+    '''
+
+    def __init__(self):
+        # Random per-process identifier, versions below are only meaningful alongside it
+        self.epoch = secrets.token_hex(8)
+
+        self.last_message_ids: Dict[str, int] = {}
+        self.membership_versions: Dict[str, int] = defaultdict(int)
+        self.conversation_list_versions: Dict[str, int] = defaultdict(int)
+        self.conditions: Dict[str, asyncio.Condition] = {}
+        self.waiter_counts: Dict[str, int] = defaultdict(int)
+        self.subscriptions: Dict[str, Set[Subscription]] = {}
+
+        # Strong references to in-flight notification tasks, otherwise they may be
+        # garbage-collected before they have run
+        self.pending_notifications = set()
+
+
+    def has_message_after(self, conversation_id: str, message_id: int) -> bool:
+        '''
+        Returns True if the bus has seen a message in the conversation newer than the one specified
+        '''
+        return self.last_message_ids.get(conversation_id, 0) > message_id
+
+
+    def get_conversation_version(self, conversation_id: str) -> Tuple[int, int]:
+        '''
+        Returns the conversation's (newest message ID, membership version) as seen by this process
+        '''
+        return (
+            self.last_message_ids.get(conversation_id, 0),
+            self.membership_versions.get(conversation_id, 0)
+        )
+
+
+    def get_conversation_list_version(self, user_id: str) -> int:
+        '''
+        Returns a counter that changes whenever the user's list of conversations changes
+        '''
+        return self.conversation_list_versions.get(user_id, 0)
+
+
+    def publish_membership_change(self, conversation_id: str, user_ids: Iterable[str]) -> None:
+        '''
+        Records a change to the conversation's participants, 'user_ids' being every user whose
+        conversation list is affected by it
+        '''
+        self.membership_versions[conversation_id] += 1
+        self.publish_activity(user_ids)
+
+
+    def publish_activity(self, user_ids: Iterable[str]) -> None:
+        '''
+        Records activity (e.g. a new message) that changes the specified users' conversation lists
+        '''
+        for user_id in user_ids:
+            self.conversation_list_versions[user_id] += 1
+
+
+    def publish_message(self, conversation_id: str, message: ConversationMessageDTO) -> None:
+        '''
+        Records a newly committed message, wakes any coroutines waiting on its conversation and
+        fans it out to the conversation's subscribers
+        '''
+        if message.id > self.last_message_ids.get(conversation_id, 0):
+            self.last_message_ids[conversation_id] = message.id
+
+        # Only bother the event loop if someone is actually listening
+        condition = self.conditions.get(conversation_id, None)
+        if condition is not None:
+            task = asyncio.get_running_loop().create_task(self._notify(condition))
+            self.pending_notifications.add(task)
+            task.add_done_callback(self.pending_notifications.discard)
+
+        subscriptions = self.subscriptions.get(conversation_id, None)
+        if not subscriptions:
+            return
+
+        event = MessageEvent(
+            conversation_id=conversation_id,
+            message_id=message.id,
+            payload=message.model_dump_json()
+        )
+
+        # Iterate over a copy as evictions modify the subscription set
+        for subscription in list(subscriptions):
+            try:
+                subscription.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self.evict(subscription)
+
+
+    def subscribe(self, conversation_id: str, subscription: Subscription) -> None:
+        '''
+        Starts delivering the conversation's new messages to the subscription
+        '''
+        self.subscriptions.setdefault(conversation_id, set()).add(subscription)
+        subscription.conversation_ids.add(conversation_id)
+
+
+    def unsubscribe(self, conversation_id: str, subscription: Subscription) -> None:
+        '''
+        Stops delivering the conversation's messages to the subscription
+        '''
+        subscription.conversation_ids.discard(conversation_id)
+        subscriptions = self.subscriptions.get(conversation_id, None)
+        if subscriptions is None:
+            return
+
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self.subscriptions[conversation_id]
+
+
+    def unsubscribe_all(self, subscription: Subscription) -> None:
+        '''
+        Detaches the subscription from every conversation it is subscribed to
+        '''
+        for conversation_id in list(subscription.conversation_ids):
+            self.unsubscribe(conversation_id, subscription)
+
+
+    def evict(self, subscription: Subscription) -> None:
+        '''
+        Detaches a subscriber that has fallen too far behind. Events already queued are left in
+        place, but the subscriber is flagged so its consumer can wind the connection down.
+        '''
+        subscription.evicted = True
+        self.unsubscribe_all(subscription)
+
+
+    async def wait_for_message(self, conversation_id: str, after: int, timeout: float) -> bool:
+        '''
+        Parks the caller until a message newer than 'after' is published to the conversation
+        or the timeout (in seconds) elapses. Returns True if a new message was published.
+        '''
+        condition = self.conditions.get(conversation_id, None)
+        if condition is None:
+            condition = asyncio.Condition()
+            self.conditions[conversation_id] = condition
+
+        self.waiter_counts[conversation_id] += 1
+        try:
+            async with asyncio.timeout(timeout):
+                async with condition:
+                    await condition.wait_for(lambda: self.has_message_after(conversation_id, after))
+            return True
+        except TimeoutError:
+            return False
+        finally:
+            # Drop the condition once the last waiter leaves so idle conversations cost nothing
+            self.waiter_counts[conversation_id] -= 1
+            if self.waiter_counts[conversation_id] <= 0:
+                del self.waiter_counts[conversation_id]
+                del self.conditions[conversation_id]
+
+
+    async def _notify(self, condition: asyncio.Condition) -> None:
+        async with condition:
+            condition.notify_all()
+
+
+
+# Process-wide bus instance shared by every request handled by this worker
+notification_bus = NotificationBus()
@@ -1,10 +1,12 @@
 
 from abc import ABC, abstractmethod
-from sqlmodel import Session
-from typing import Optional, List
+from datetime import datetime
+from sqlalchemy import CursorResult, delete
+from sqlmodel import Session, col, select
+from typing import Optional, List, cast
 
 from app.models.accesstoken import AccessToken
-from shared.time import get_current_time
+from app.repositories.unitofwork import commit
 
 
 class AccessTokenRepository(ABC):
@@ -34,6 +36,14 @@ class AccessTokenRepository(ABC):
         raise NotImplementedError()
 
 
+    @abstractmethod
+    def delete_expired_tokens(self, now: datetime, limit: int) -> int:
+        '''
+        Deletes up to 'limit' tokens that expired before 'now', returning the number deleted
+        '''
+        raise NotImplementedError()
+
+
 
 class InMemoryAccessTokenRepository(AccessTokenRepository):
 
@@ -46,12 +56,7 @@ class InMemoryAccessTokenRepository(AccessTokenRepository):
         Creates and adds a new AccessToken instance to the repository
         '''
 
-        token = AccessToken(
-            id=AccessToken.generate_id(),
-            user_id=user_id,
-            created_at=get_current_time(),
-            time_to_live=AccessToken.default_time_to_live()
-        )
+        token = AccessToken.issue(user_id)
 
         self.tokens[token.id] = token
         return token
@@ -76,6 +81,16 @@ class InMemoryAccessTokenRepository(AccessTokenRepository):
         del self.tokens[id]
 
 
+    def delete_expired_tokens(self, now: datetime, limit: int) -> int:
+        '''
+        Deletes up to 'limit' tokens that expired before 'now', returning the number deleted
+        '''
+        expired = [x.id for x in self.tokens.values() if x.expires_at < now][:limit]
+        for id in expired:
+            del self.tokens[id]
+        return len(expired)
+
+
 class DbAccessTokenRepository(AccessTokenRepository):
 
     def __init__(self, session: Session):
@@ -87,14 +102,9 @@ class DbAccessTokenRepository(AccessTokenRepository):
         Creates and adds a new AccessToken instance to the repository
         '''
 
-        token = AccessToken(
-            id=AccessToken.generate_id(),
-            user_id=user_id,
-            created_at=get_current_time(),
-            time_to_live=AccessToken.default_time_to_live()
-        )
+        token = AccessToken.issue(user_id)
         self.session.add(token)
-        self.session.commit()
+        commit(self.session)
         return token
 
 
@@ -108,8 +118,24 @@ class DbAccessTokenRepository(AccessTokenRepository):
     def delete_token_by_id(self, id: str) -> None:
         '''
         Deletes an access token
+        Raises: KeyError if the token cannot be found
         '''
-        token = self.session.get_user_by_id(id)
+        token = self.session.get(AccessToken, id)
+        if token is None:
+            raise KeyError('Access token cannot be found')
         self.session.delete(token)
-        self.session.commit()
+        commit(self.session)
 
+
+    def delete_expired_tokens(self, now: datetime, limit: int) -> int:
+        '''
+        Deletes up to 'limit' tokens that expired before 'now', returning the number deleted. The
+        batch is deleted by a single statement and committed straight away, so the database's
+        write lock is only held briefly.
+        '''
+        expired = select(AccessToken.id).where(col(AccessToken.expires_at) < now).limit(limit)
+        result = cast(CursorResult, self.session.execute(
+            delete(AccessToken).where(col(AccessToken.id).in_(expired)).execution_options(synchronize_session=False)
+        ))
+        commit(self.session)
+        return result.rowcount
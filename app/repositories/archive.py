@@ -0,0 +1,451 @@
+
+import os
+from datetime import datetime
+from operator import attrgetter
+from sqlalchemy import and_, column, literal_column, or_, table, text
+from sqlmodel import Session, col, func, select
+from typing import Dict, List, Optional, Sequence, Union, cast
+
+from app.models.message import Message
+from app.models.messagesegment import MessageSegment
+from app.repositories.message import (
+    MessageRepository,
+    MessageSearchHit,
+    SearchCursor,
+    SearchPosition,
+    DbMessageRepository,
+    ShardedMessageRepository,
+    compile_search_patterns,
+    fold_diacritics,
+    from_microseconds,
+    highlight_search_terms,
+    to_fts_query,
+    to_microseconds
+)
+from shared.segment import SegmentReader, SegmentRecord, write_segment
+
+
+# Source of archived hits within search results, kept clear of the hot store's (i.e. its shards)
+ARCHIVE_SEARCH_SOURCE = -1
+
+
+class ArchivedMessageRepository(MessageRepository):
+    '''
+    Decorates the hot message store with each conversation's archived history. Old messages are
+    moved out of the message table into compressed, immutable segment files, after which reads
+    stitch the two back together so that paging through history works exactly as before.
+
+    A conversation's segments always hold a contiguous run of its oldest messages: everything up
+    to and including its newest archived message. Reads only consult the hot store above that
+    point, so messages that are mid-way through being archived are never seen twice.
+
+    Archived messages remain searchable through their own full-text index, archived_segment_fts,
+    which is written along with each segment's metadata.
+    '''
+
+    def __init__(
+        self,
+        repository: Union[DbMessageRepository, ShardedMessageRepository],
+        session: Session,
+        archive_dir: str
+    ):
+        self.repository = repository
+        self.session = session
+        self.archive_dir = archive_dir
+
+
+    def get_segments(self, conversation_ids: List[str]) -> Dict[str, List[MessageSegment]]:
+        '''
+        Retrieves the segments of the specified conversations, each conversation's in ID order
+        '''
+        query = select(MessageSegment) \
+            .where(col(MessageSegment.conversation_id).in_(conversation_ids)) \
+            .order_by(col(MessageSegment.conversation_id), col(MessageSegment.first_message_id))
+
+        segments: Dict[str, List[MessageSegment]] = {}
+        for segment in self.session.execute(query).scalars().all():
+            segments.setdefault(segment.conversation_id, []).append(segment)
+        return segments
+
+
+    def create_message(
+        self,
+        conversation_id: str,
+        sender_id: str,
+        content: str,
+        created_at: Optional[datetime] = None
+    ) -> Message:
+        '''
+        Creates and adds a new message to the specified conversation
+        '''
+        return self.repository.create_message(conversation_id, sender_id, content, created_at)
+
+
+    def create_messages(
+        self,
+        conversation_id: str,
+        sender_id: str,
+        contents: List[str],
+        created_at: Optional[datetime] = None
+    ) -> List[Message]:
+        '''
+        Creates and adds a batch of messages to the specified conversation as a single operation
+        '''
+        return self.repository.create_messages(conversation_id, sender_id, contents, created_at)
+
+
+    def get_messages_for_conversation(
+        self,
+        id: str,
+        after: Optional[int] = None,
+        before: Optional[int] = None,
+        limit: Optional[int] = None
+    ) -> List[Message]:
+        '''
+        Retrieves a page of messages for the specified conversation, ordered by ascending ID
+        '''
+        segments = self.get_segments([id]).get(id, [])
+        return self._get_messages(id, segments, after, before, limit)
+
+
+    def get_messages_for_conversations(
+        self,
+        cursors: Dict[str, int],
+        limit: Optional[int] = None
+    ) -> List[Message]:
+        '''
+        Retrieves the messages following each conversation's cursor. Conversations whose cursor
+        lies within their archived history are read individually, the rest with a single read.
+        '''
+        segments_by_id = self.get_segments(list(cursors))
+
+        messages = []
+        hot_cursors = {}
+        for id, after in cursors.items():
+            segments = segments_by_id.get(id, [])
+            if segments and after < segments[-1].last_message_id:
+                messages.extend(self._get_messages(id, segments, after, None, limit))
+            else:
+                hot_cursors[id] = max(after, segments[-1].last_message_id) if segments else after
+
+        if hot_cursors:
+            messages.extend(self.repository.get_messages_for_conversations(hot_cursors, limit=limit))
+
+        messages.sort(key=attrgetter('id'))
+        return messages[:limit] if limit is not None else messages
+
+
+    def search_messages(
+        self,
+        conversation_ids: List[str],
+        query: str,
+        after: Optional[SearchCursor] = None,
+        limit: Optional[int] = None
+    ) -> List[MessageSearchHit]:
+        '''
+        Searches the specified conversations for messages containing every term of the query, in
+        both the hot store and archived history. Each ranks its hits by its own index, and the two
+        are merged in that order. Archived history is a source of its own, ARCHIVE_SEARCH_SOURCE.
+        '''
+        hits = self.repository.search_messages(conversation_ids, query, after=after, limit=limit)
+        position = after.get(ARCHIVE_SEARCH_SOURCE, None) if after is not None else None
+        hits += self._search_segments(conversation_ids, query, position, limit)
+        hits.sort(key=lambda x: (x.rank, x.message.id))
+
+        # Messages mid-way through being archived are found in both, only the first is kept
+        seen = set()
+        unique = []
+        for hit in hits:
+            key = (hit.message.conversation_id, hit.message.id)
+            if key not in seen:
+                seen.add(key)
+                unique.append(hit)
+        return unique[:limit] if limit is not None else unique
+
+
+    def _search_segments(
+        self,
+        conversation_ids: List[str],
+        query: str,
+        after: Optional[SearchPosition],
+        limit: Optional[int]
+    ) -> List[MessageSearchHit]:
+        '''
+        Searches the specified conversations' archived messages. The archived_segment_fts index
+        finds the segments holding every term, ranked by bm25(), which are then read back to find
+        the messages that do. Hits take their segment's rank, ties broken by ID.
+        '''
+        if not conversation_ids:
+            return []
+
+        fts = table('archived_segment_fts', column('rowid'))
+        rank = func.bm25(literal_column('archived_segment_fts'))
+
+        statement = (
+            select(MessageSegment, rank)
+            .join_from(MessageSegment, fts, fts.c.rowid == MessageSegment.id)
+            .where(text('archived_segment_fts MATCH :query').bindparams(query=to_fts_query(query)))
+            .where(col(MessageSegment.conversation_id).in_(conversation_ids))
+        )
+
+        if after is not None:
+            after_rank, after_id = after
+            statement = statement.where(
+                or_(rank > after_rank, and_(rank == after_rank, col(MessageSegment.last_message_id) > after_id))
+            )
+
+        statement = statement.order_by(rank, col(MessageSegment.first_message_id))
+
+        # A segment can hold every term without any one of its messages doing so, so segments are
+        # read in rank order until the page is full
+        terms = compile_search_patterns(fold_diacritics(query))
+        patterns = compile_search_patterns(query)
+        hits: List[MessageSearchHit] = []
+        for segment, segment_rank in self.session.execute(statement).all():
+            try:
+                with SegmentReader(os.path.join(self.archive_dir, segment.path)) as reader:
+                    records = reader.read()
+            except FileNotFoundError:
+                # Dropped by retention since we searched
+                continue
+
+            for record in records:
+                if after is not None and segment_rank == after[0] and record.id <= after[1]:
+                    continue
+                content = fold_diacritics(record.content)
+                if all(x.search(content) for x in terms):
+                    hits.append(
+                        MessageSearchHit(
+                            self._to_message(segment.conversation_id, record),
+                            highlight_search_terms(record.content, patterns),
+                            segment_rank,
+                            ARCHIVE_SEARCH_SOURCE
+                        )
+                    )
+
+            if limit is not None and len(hits) >= limit:
+                break
+
+        return hits[:limit] if limit is not None else hits
+
+
+    def _get_messages(
+        self,
+        id: str,
+        segments: List[MessageSegment],
+        after: Optional[int],
+        before: Optional[int],
+        limit: Optional[int]
+    ) -> List[Message]:
+        if not segments:
+            return self.repository.get_messages_for_conversation(id, after=after, before=before, limit=limit)
+
+        archived_until = segments[-1].last_message_id
+        hot_after = max(after, archived_until) if after is not None else archived_until
+
+        # Reading forwards: archived history comes first, topped up from the hot store
+        if before is None:
+            messages = []
+            if after is None or after < archived_until:
+                messages = self._read_segments(id, segments, after, None, limit, reverse=False)
+
+            remaining = limit - len(messages) if limit is not None else None
+            if remaining is None or remaining > 0:
+                messages += self.repository.get_messages_for_conversation(id, after=hot_after, limit=remaining)
+            return messages
+
+        # Reading backwards: the hot store comes first, topped up from archived history
+        messages = []
+        if before > archived_until + 1:
+            messages = self.repository.get_messages_for_conversation(id, after=hot_after, before=before, limit=limit)
+
+        remaining = limit - len(messages) if limit is not None else None
+        if (remaining is None or remaining > 0) and (after is None or after < archived_until):
+            archived_before = min(before, archived_until + 1)
+            messages = self._read_segments(id, segments, after, archived_before, remaining, reverse=True) + messages
+        return messages
+
+
+    def _read_segments(
+        self,
+        id: str,
+        segments: List[MessageSegment],
+        after: Optional[int],
+        before: Optional[int],
+        limit: Optional[int],
+        reverse: bool
+    ) -> List[Message]:
+        '''
+        Reads archived messages between 'after' and 'before' from the conversation's segments,
+        only opening the segments overlapping that range
+        '''
+        overlapping = [
+            x for x in segments
+            if (after is None or x.last_message_id > after) and (before is None or x.first_message_id < before)
+        ]
+        if reverse:
+            overlapping.reverse()
+
+        chunks: List[List[SegmentRecord]] = []
+        count = 0
+        for segment in overlapping:
+            remaining = limit - count if limit is not None else None
+            try:
+                with SegmentReader(os.path.join(self.archive_dir, segment.path)) as reader:
+                    records = reader.read(after=after, before=before, limit=remaining, reverse=reverse)
+            except FileNotFoundError:
+                # Dropped by retention since we looked the segment up
+                continue
+
+            chunks.append(records)
+            count += len(records)
+            if limit is not None and count >= limit:
+                break
+
+        if reverse:
+            chunks.reverse()
+
+        return [self._to_message(id, x) for chunk in chunks for x in chunk]
+
+
+    @staticmethod
+    def _to_message(conversation_id: str, record: SegmentRecord) -> Message:
+        return Message(
+            id=record.id,
+            conversation_id=conversation_id,
+            sender_id=record.sender_id,
+            content=record.content,
+            created_at=from_microseconds(record.created_at)
+        )
+
+
+    def archive_conversation(
+        self,
+        conversation_id: str,
+        up_to_id: int,
+        max_segment_messages: int,
+        batch_size: int
+    ) -> int:
+        '''
+        Moves the conversation's messages with IDs up to and including 'up_to_id' out of the hot
+        store and into new segments. Segments are recorded before the messages are removed from
+        the hot store, so an interrupted run loses nothing and the next run finishes the job.
+        Returns the number of messages archived.
+        '''
+        segments = self.get_segments([conversation_id]).get(conversation_id, [])
+        archived_until = segments[-1].last_message_id if segments else 0
+
+        archived = 0
+        while True:
+            # Read forwards, as a page bounded by 'before' would be anchored to the newest messages
+            messages = self.repository.get_messages_for_conversation(
+                conversation_id,
+                after=archived_until,
+                limit=max_segment_messages
+            )
+            messages = [x for x in messages if cast(int, x.id) <= up_to_id]
+            if not messages:
+                break
+
+            self._write_segment(conversation_id, messages)
+            archived_until = cast(int, messages[-1].id)
+            archived += len(messages)
+
+        # Reads already ignore hot messages at or below the newest archived one
+        if archived_until:
+            self.repository.delete_messages_up_to(conversation_id, archived_until, batch_size)
+        return archived
+
+
+    def _write_segment(self, conversation_id: str, messages: List[Message]) -> MessageSegment:
+        first_id, last_id = cast(int, messages[0].id), cast(int, messages[-1].id)
+        path = os.path.join(conversation_id, f'{first_id:020d}-{last_id:020d}.seg')
+        full_path = os.path.join(self.archive_dir, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+        size = write_segment(
+            full_path,
+            (SegmentRecord(cast(int, x.id), x.sender_id, x.content, to_microseconds(x.created_at)) for x in messages)
+        )
+
+        segment = MessageSegment(
+            conversation_id=conversation_id,
+            path=path,
+            first_message_id=first_id,
+            last_message_id=last_id,
+            message_count=len(messages),
+            size=size,
+            first_created_at=min(x.created_at for x in messages),
+            last_created_at=max(x.created_at for x in messages)
+        )
+        self.session.add(segment)
+        self.session.flush()
+
+        # Indexed in the same transaction, so a segment is searchable as soon as it's readable
+        self._index_segment(segment, messages)
+        self.session.commit()
+        return segment
+
+
+    def _index_segment(self, segment: MessageSegment, records: Sequence[Union[Message, SegmentRecord]]) -> None:
+        self.session.execute(
+            text('INSERT INTO archived_segment_fts (rowid, content) VALUES (:id, :content)'),
+            dict(id=segment.id, content='\n'.join(x.content for x in records))
+        )
+
+
+    def rebuild_search_index(self) -> int:
+        '''
+        Re-indexes every archived message from scratch, returning the number of messages indexed
+        '''
+        self.session.execute(text("INSERT INTO archived_segment_fts (archived_segment_fts) VALUES ('delete-all')"))
+
+        count = 0
+        for segment in self.session.execute(select(MessageSegment)).scalars().all():
+            try:
+                with SegmentReader(os.path.join(self.archive_dir, segment.path)) as reader:
+                    records = reader.read()
+            except FileNotFoundError:
+                continue
+
+            self._index_segment(segment, records)
+            count += len(records)
+
+        self.session.commit()
+        return count
+
+
+    def is_search_indexed(self) -> bool:
+        '''
+        Whether the archived messages have been indexed for search, i.e. unless the segments
+        predate the index
+        '''
+        has_segments = self.session.execute(select(MessageSegment.id).limit(1)).first() is not None
+        has_entries = self.session.execute(text('SELECT rowid FROM archived_segment_fts LIMIT 1')).first() is not None
+        return has_entries or not has_segments
+
+
+    def drop_segments(self, older_than: datetime) -> int:
+        '''
+        Enforces retention by deleting every segment whose newest message was created before
+        the cutoff. Whole segments are dropped at once, their metadata first so that readers stop
+        looking for them before the files disappear. Their search index entries are left behind,
+        see ARCHIVED_SEGMENT_SEARCH_DDL, so segments are never read back. Returns the number of
+        messages dropped.
+        '''
+        segments = self.session.execute(
+            select(MessageSegment).where(col(MessageSegment.last_created_at) < older_than)
+        ).scalars().all()
+
+        dropped = [(x.path, x.message_count) for x in segments]
+        for segment in segments:
+            self.session.delete(segment)
+        self.session.commit()
+
+        for path, _ in dropped:
+            try:
+                os.remove(os.path.join(self.archive_dir, path))
+            except FileNotFoundError:
+                pass
+
+        return sum(count for _, count in dropped)
@@ -1,12 +1,42 @@
 
 from abc import ABC, abstractmethod
 from datetime import datetime
-from sqlmodel import Session
-from typing import Optional, List
-
-from app.models.conversation import Conversation
+from sqlalchemy import and_, case, insert, or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, col, select
+from typing import Dict, Optional, List, Sequence, Tuple, cast
+
+from app.models.conversation import Conversation, ConversationSummary
+from app.models.membership import Membership
+from app.models.message import Message
+from app.models.user import User
+from app.repositories.membership import InMemoryMembershipRepository
+from app.repositories.unitofwork import commit, transaction
+from app.repositories.user import InMemoryUserRepository
 from shared.time import get_current_time
 
+
+# Position within a conversation list: the (last_activity_at, conversation_id) of the last
+# conversation seen. Lists are ordered by descending activity, ties broken by descending ID.
+ActivityCursor = Tuple[datetime, str]
+
+
+def summarize_messages(messages: List[Message]) -> Dict[str, Tuple[int, datetime, int]]:
+    '''
+    Tallies newly created messages into (last_message_id, last_activity_at, message_count) per conversation
+    '''
+    tallies: Dict[str, Tuple[int, datetime, int]] = {}
+    for message in messages:
+        id = cast(int, message.id)
+        last_id, last_at, count = tallies.get(message.conversation_id, (id, message.created_at, 0))
+        tallies[message.conversation_id] = (
+            max(last_id, id),
+            max(last_at, message.created_at),
+            count + 1
+        )
+    return tallies
+
+
 class ConversationRepository(ABC):
 
     @abstractmethod
@@ -14,10 +44,13 @@ class ConversationRepository(ABC):
         self,
         name: str,
         id: Optional[str] = None,
-        created_at: Optional[datetime] = None
+        created_at: Optional[datetime] = None,
+        user_ids: Sequence[str] = ()
     ) -> Conversation:
         '''
-        Creates and adds a new Conversation instance to the repository
+        Creates and adds a new Conversation instance to the repository, along with memberships for
+        the specified users
+        Raises ValueError if the conversation cannot be created, leaving nothing behind
         '''
         raise NotImplementedError()
 
@@ -39,21 +72,70 @@ class ConversationRepository(ABC):
         raise NotImplementedError()
 
 
+    @abstractmethod
+    def get_recent_conversations(
+        self,
+        ids: List[str],
+        before: Optional[ActivityCursor] = None,
+        limit: Optional[int] = None
+    ) -> List[Tuple[Conversation, ConversationSummary]]:
+        '''
+        Retrieves the specified conversations along with their summaries, most recently active first.
+        If 'before' is given, only conversations following that position in the list are returned.
+        '''
+        raise NotImplementedError()
+
+
+    @abstractmethod
+    def list_conversations_with_participants(
+        self,
+        user_id: str,
+        before: Optional[ActivityCursor] = None,
+        limit: Optional[int] = None
+    ) -> List[Tuple[Conversation, ConversationSummary, List[str]]]:
+        '''
+        Retrieves the conversations the user is a member of along with their summaries and the
+        usernames of their participants, most recently active first. If 'before' is given, only
+        conversations following that position in the list are returned.
+        '''
+        raise NotImplementedError()
+
+
+    @abstractmethod
+    def record_activity(self, messages: List[Message]) -> None:
+        '''
+        Updates the summaries of the conversations the newly created messages were posted to
+        '''
+        raise NotImplementedError()
+
+
 
 class InMemoryConversationRepository(ConversationRepository):
 
-    def __init__(self):
-        self.conversations_by_id = {}
+    def __init__(
+        self,
+        membership_repository: InMemoryMembershipRepository,
+        user_repository: InMemoryUserRepository
+    ):
+        self.conversations_by_id: Dict[str, Conversation] = {}
+        self.summaries_by_id: Dict[str, ConversationSummary] = {}
+
+        # Consulted for participants when listing a user's conversations
+        self.membership_repository = membership_repository
+        self.user_repository = user_repository
 
 
     def create_conversation(
         self,
         name: str,
         id: Optional[str] = None,
-        created_at: Optional[datetime] = None
+        created_at: Optional[datetime] = None,
+        user_ids: Sequence[str] = ()
     ) -> Conversation:
         '''
-        Creates and adds a new Conversation instance to the repository
+        Creates and adds a new Conversation instance to the repository, along with memberships for
+        the specified users
+        Raises ValueError if the conversation cannot be created, leaving nothing behind
         '''
 
         if id is None:
@@ -67,7 +149,13 @@ class InMemoryConversationRepository(ConversationRepository):
             created_at=created_at
         )
 
+        if id in self.conversations_by_id:
+            raise ValueError(f'Conversation with id={id} already exists in repository')
+
         self.conversations_by_id[id] = conversation
+        self.summaries_by_id[id] = ConversationSummary(conversation_id=id, last_activity_at=created_at)
+        for user_id in dict.fromkeys(user_ids):
+            self.membership_repository.create_membership(id, user_id)
         return conversation
 
 
@@ -84,6 +172,63 @@ class InMemoryConversationRepository(ConversationRepository):
         Raises KeyError if the conversation does not exist in the repository
         '''
         del self.conversations_by_id[id]
+        self.summaries_by_id.pop(id, None)
+
+
+    def get_recent_conversations(
+        self,
+        ids: List[str],
+        before: Optional[ActivityCursor] = None,
+        limit: Optional[int] = None
+    ) -> List[Tuple[Conversation, ConversationSummary]]:
+        '''
+        Retrieves the specified conversations along with their summaries, most recently active first
+        '''
+        summaries = [self.summaries_by_id[x] for x in ids if x in self.summaries_by_id]
+        if before is not None:
+            summaries = [x for x in summaries if (x.last_activity_at, x.conversation_id) < before]
+
+        summaries.sort(key=lambda x: (x.last_activity_at, x.conversation_id), reverse=True)
+        if limit is not None:
+            summaries = summaries[:limit]
+
+        return [(self.conversations_by_id[x.conversation_id], x) for x in summaries]
+
+
+    def list_conversations_with_participants(
+        self,
+        user_id: str,
+        before: Optional[ActivityCursor] = None,
+        limit: Optional[int] = None
+    ) -> List[Tuple[Conversation, ConversationSummary, List[str]]]:
+        '''
+        Retrieves the user's conversations along with their summaries and participants' usernames,
+        most recently active first
+        '''
+        ids = self.membership_repository.get_conversations_for_user(user_id)
+
+        rows = []
+        for conversation, summary in self.get_recent_conversations(ids, before=before, limit=limit):
+            users = [
+                self.user_repository.get_user_by_id(x)
+                for x in self.membership_repository.get_users_for_conversation(conversation.id)
+            ]
+            rows.append((conversation, summary, [x.username for x in users if x is not None]))
+        return rows
+
+
+    def record_activity(self, messages: List[Message]) -> None:
+        '''
+        Updates the summaries of the conversations the newly created messages were posted to
+        '''
+        for id, (last_id, last_at, count) in summarize_messages(messages).items():
+            summary = self.summaries_by_id.get(id, None)
+            if summary is None:
+                continue
+
+            summary.last_message_id = max(summary.last_message_id or 0, last_id)
+            summary.last_activity_at = max(summary.last_activity_at, last_at)
+            summary.message_count += count
 
 
 
@@ -96,10 +241,13 @@ class DbConversationRepository(ConversationRepository):
         self,
         name: str,
         id: Optional[str] = None,
-        created_at: Optional[datetime] = None
+        created_at: Optional[datetime] = None,
+        user_ids: Sequence[str] = ()
     ) -> Conversation:
         '''
-        Creates and adds a new Conversation instance to the repository
+        Creates and adds a new Conversation instance to the repository, along with memberships for
+        the specified users
+        Raises ValueError if the conversation cannot be created, leaving nothing behind
         '''
         if id is None:
             id = Conversation.generate_id()
@@ -111,8 +259,18 @@ class DbConversationRepository(ConversationRepository):
             name=name,
             created_at=created_at,
         )
-        self.session.add(conversation)
-        self.session.commit()
+        # Memberships are written by a single executemany, all committed together
+        try:
+            with transaction(self.session):
+                self.session.add(conversation)
+                self.session.add(ConversationSummary(conversation_id=id, last_activity_at=created_at))
+                if user_ids:
+                    self.session.execute(
+                        insert(Membership),
+                        [dict(user_id=x, conversation_id=id, created_at=created_at) for x in dict.fromkeys(user_ids)]
+                    )
+        except IntegrityError:
+            raise ValueError(f'Unable to create conversation with id={id}')
         return conversation
 
 
@@ -130,5 +288,113 @@ class DbConversationRepository(ConversationRepository):
         '''
         conversation = self.get_conversation_by_id(id)
         self.session.delete(conversation)
-        self.session.commit()
+
+        summary = self.session.get(ConversationSummary, id)
+        if summary is not None:
+            self.session.delete(summary)
+        commit(self.session)
+
+
+    def get_recent_conversations(
+        self,
+        ids: List[str],
+        before: Optional[ActivityCursor] = None,
+        limit: Optional[int] = None
+    ) -> List[Tuple[Conversation, ConversationSummary]]:
+        '''
+        Retrieves the specified conversations along with their summaries, most recently active first
+        '''
+        if not ids:
+            return []
+
+        query = (
+            select(Conversation, ConversationSummary)
+            .join(ConversationSummary, col(ConversationSummary.conversation_id) == Conversation.id)
+            .where(col(Conversation.id).in_(ids))
+        )
+        return [tuple(x) for x in self.session.execute(self._order_by_activity(query, before, limit)).all()]
+
+
+    def list_conversations_with_participants(
+        self,
+        user_id: str,
+        before: Optional[ActivityCursor] = None,
+        limit: Optional[int] = None
+    ) -> List[Tuple[Conversation, ConversationSummary, List[str]]]:
+        '''
+        Retrieves the user's conversations along with their summaries and participants' usernames,
+        most recently active first. Takes two queries however many conversations there are: one
+        for the page of conversations, another for all of their participants.
+        '''
+        query = (
+            select(Conversation, ConversationSummary)
+            .join(ConversationSummary, col(ConversationSummary.conversation_id) == Conversation.id)
+            .join(Membership, col(Membership.conversation_id) == Conversation.id)
+            .where(Membership.user_id == user_id)
+        )
+        rows = self.session.execute(self._order_by_activity(query, before, limit)).all()
+        if not rows:
+            return []
+
+        participants: Dict[str, List[str]] = {conversation.id: [] for conversation, _ in rows}
+        usernames = (
+            select(Membership.conversation_id, User.username)
+            .join(User, col(User.id) == Membership.user_id)
+            .where(col(Membership.conversation_id).in_(list(participants)))
+            .where(col(User.deleted_at).is_(None))
+            .order_by(col(Membership.id))
+        )
+        for conversation_id, username in self.session.execute(usernames):
+            participants[conversation_id].append(username)
+
+        return [(conversation, summary, participants[conversation.id]) for conversation, summary in rows]
+
+
+    @staticmethod
+    def _order_by_activity(query, before: Optional[ActivityCursor], limit: Optional[int]):
+        '''
+        Orders a query over conversation summaries most recently active first, starting after 'before'
+        '''
+        if before is not None:
+            activity, id = before
+            query = query.where(
+                or_(
+                    col(ConversationSummary.last_activity_at) < activity,
+                    and_(col(ConversationSummary.last_activity_at) == activity, col(ConversationSummary.conversation_id) < id)
+                )
+            )
+
+        query = query.order_by(
+            col(ConversationSummary.last_activity_at).desc(),
+            col(ConversationSummary.conversation_id).desc()
+        )
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+
+    def record_activity(self, messages: List[Message]) -> None:
+        '''
+        Updates the summaries of the conversations the newly created messages were posted to.
+        Updates are relative to the stored values, so concurrent writers can't lose each other's counts.
+        The updates are only flushed: callers commit them along with the messages themselves.
+        '''
+        for id, (last_id, last_at, count) in summarize_messages(messages).items():
+            self.session.execute(
+                update(ConversationSummary)
+                .where(col(ConversationSummary.conversation_id) == id)
+                .values(
+                    message_count=ConversationSummary.message_count + count,
+                    last_message_id=case(
+                        (col(ConversationSummary.last_message_id) > last_id, ConversationSummary.last_message_id),
+                        else_=last_id
+                    ),
+                    last_activity_at=case(
+                        (col(ConversationSummary.last_activity_at) > last_at, ConversationSummary.last_activity_at),
+                        else_=last_at
+                    )
+                )
+            )
+
+        self.session.flush()
 
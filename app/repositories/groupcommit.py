@@ -0,0 +1,168 @@
+
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy.orm import sessionmaker
+from typing import Dict, List, Optional, Tuple, Union
+
+from app.models.message import Message
+from app.repositories.conversation import DbConversationRepository
+from app.repositories.message import DbMessageRepository, get_shard_index
+from app.repositories.messagecache import MessageTailCache
+from shared.time import get_current_time
+
+
+logger = logging.getLogger(__name__)
+
+
+class GroupCommitMessageWriter:
+    '''
+    Coalesces message inserts from concurrent requests into shared transactions ("group commit").
+
+    Inserts are queued until either the batch is full or a short delay has passed, at which point
+    the whole batch is written with a single executemany and committed once. Each caller is only
+    resolved after the batch's commit succeeds, so durability is the same as committing alone. The
+    commit runs on a worker thread; requests arriving while it is in flight form the next batch.
+
+    When messages are sharded, one session factory is given per shard and each batch is split
+    into one transaction per shard it touches. Conversation summaries for the whole batch are then
+    updated in a single transaction, and committed messages are written through to the hot-tail
+    cache, if one is given.
+
+    NOTE: methods must be called from the event loop's thread.
+    '''
+
+    def __init__(
+        self,
+        session_factories: List[sessionmaker],
+        max_batch_size: int,
+        max_delay: float,
+        summary_session_factory: Optional[sessionmaker] = None,
+        cache: Optional[MessageTailCache] = None
+    ):
+        self.session_factories = session_factories
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.summary_session_factory = summary_session_factory
+        self.cache = cache
+
+        self.pending: List[Tuple[Message, asyncio.Future]] = []
+        self.batch_full = asyncio.Event()
+        self.flush_task: Optional[asyncio.Task] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+    async def create_message(
+        self,
+        conversation_id: str,
+        sender_id: str,
+        content: str,
+        created_at: Optional[datetime] = None
+    ) -> Message:
+        '''
+        Queues a new message for insertion, returning it once it has been committed
+        '''
+
+        if created_at is None:
+            created_at = get_current_time()
+
+        message = Message(
+            conversation_id=conversation_id,
+            sender_id=sender_id,
+            content=content,
+            created_at=created_at
+        )
+
+        # The writer's state belongs to the loop that created it; start afresh if the running loop
+        # has changed (e.g. the application was restarted within the same process)
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.loop = loop
+            self.pending = []
+            self.batch_full = asyncio.Event()
+            self.flush_task = None
+
+        future = loop.create_future()
+        self.pending.append((message, future))
+
+        if len(self.pending) >= self.max_batch_size:
+            self.batch_full.set()
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush())
+
+        return await future
+
+
+    async def _flush(self) -> None:
+        try:
+            while self.pending:
+
+                # Give concurrent requests a brief window to join the batch
+                if len(self.pending) < self.max_batch_size:
+                    try:
+                        async with asyncio.timeout(self.max_delay):
+                            await self.batch_full.wait()
+                    except TimeoutError:
+                        pass
+
+                batch = self.pending[:self.max_batch_size]
+                self.pending = self.pending[self.max_batch_size:]
+                if len(self.pending) < self.max_batch_size:
+                    self.batch_full.clear()
+
+                try:
+                    results = await asyncio.to_thread(self._commit, [x for x, _ in batch])
+                except Exception as e:
+                    results = [e] * len(batch)
+
+                # Batches commit in ID order, so the cache sees each conversation's messages in order
+                if self.cache is not None:
+                    for result in results:
+                        if not isinstance(result, Exception):
+                            self.cache.append_messages(result.conversation_id, [result])
+
+                # Callers that have since gone away are skipped, their message is committed regardless
+                for result, (_, future) in zip(results, batch):
+                    if future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+        finally:
+            self.flush_task = None
+
+
+    def _commit(self, messages: List[Message]) -> List[Union[Message, Exception]]:
+        '''
+        Commits the batch, returning each message or the exception that prevented its commit.
+        Shards commit independently, so a failure on one shard doesn't fail the others.
+        '''
+        by_shard: Dict[int, List[int]] = defaultdict(list)
+        for position, message in enumerate(messages):
+            index = get_shard_index(message.conversation_id, len(self.session_factories))
+            by_shard[index].append(position)
+
+        # IDs are assigned to the instances in place, so results line up with the batch's order
+        results: List[Union[Message, Exception]] = list(messages)
+        for index, positions in by_shard.items():
+            try:
+                with self.session_factories[index]() as session:
+                    DbMessageRepository(session).insert_messages([messages[x] for x in positions])
+            except Exception as e:
+                for position in positions:
+                    results[position] = e
+
+        # Summaries are derived data and the messages are already committed by now, so a failure
+        # here is logged rather than reported to callers (who would otherwise post them again)
+        committed = [x for x in results if not isinstance(x, Exception)]
+        if self.summary_session_factory is not None and committed:
+            try:
+                with self.summary_session_factory() as session:
+                    DbConversationRepository(session).record_activity(committed)
+                    session.commit()
+            except Exception:
+                logger.exception('Unable to update conversation summaries')
+
+        return results
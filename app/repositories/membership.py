@@ -1,10 +1,12 @@
 
 from abc import ABC, abstractmethod
 from collections import defaultdict
-from sqlmodel import Session, select
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, col, select
 from typing import Optional, List
 
 from app.models.membership import Membership
+from app.repositories.unitofwork import commit, transaction
 
 class MembershipRepository(ABC):
 
@@ -24,6 +26,14 @@ class MembershipRepository(ABC):
         raise NotImplementedError()
 
 
+    @abstractmethod
+    def get_users_for_conversation(self, conversation_id: str) -> List[str]:
+        '''
+        Returns a list of user IDs for the specified conversation
+        '''
+        raise NotImplementedError()
+
+
     @abstractmethod
     def delete_membership(self, conversation_id: str, user_id: str) -> None:
         '''
@@ -95,8 +105,11 @@ class DbMembershipRepository(MembershipRepository):
         Creates and adds a new Conversation instance to the repository
         '''
         membership = Membership(user_id=user_id, conversation_id=conversation_id)
-        self.session.add(membership)
-        self.session.commit()
+        try:
+            with transaction(self.session):
+                self.session.add(membership)
+        except IntegrityError:
+            raise ValueError('Already in conversation')
         return membership
 
 
@@ -113,7 +126,7 @@ class DbMembershipRepository(MembershipRepository):
         '''
         Returns a list of user IDs for the specified conversation
         '''
-        query = select(Membership.user_id).where(Membership.conversation_id == conversation_id)
+        query = select(Membership.user_id).where(Membership.conversation_id == conversation_id).order_by(col(Membership.id))
         results = self.session.execute(query)
         return [x[0] for x in results.all()]
 
@@ -128,10 +141,10 @@ class DbMembershipRepository(MembershipRepository):
             .where(Membership.conversation_id == conversation_id)   \
             .where(Membership.user_id == user_id)
 
-        membership = self.session.execute(query).first()
+        membership = self.session.execute(query).scalars().first()
         if membership is None:
             raise KeyError('Membership does not exist and cannot be deleted')
 
         self.session.delete(membership)
-        self.session.commit()
+        commit(self.session)
 
@@ -1,13 +1,132 @@
 
 from abc import ABC, abstractmethod
-from datetime import datetime
-from sqlmodel import select, func, Session
-from typing import Optional, List
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+from operator import attrgetter
+from sqlalchemy import and_, column, delete, literal_column, or_, table, text
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import col, insert, select, func, Session
+from typing import Callable, Dict, NamedTuple, Optional, List, Tuple, cast
+import html
+import unicodedata
+import re
+import secrets
+import sys
+import zlib
 
 from app.models.message import Message
+from app.repositories.unitofwork import commit
 from shared.time import get_current_time
 
 
+class MessageSearchHit(NamedTuple):
+    message: Message
+
+    # HTML-escaped excerpt of the message around the matching terms, which are wrapped in
+    # SEARCH_HIGHLIGHT tags
+    snippet: str
+
+    # Relevance, lower is better (FTS5's bm25() convention)
+    rank: float
+
+    # The index the hit was found in, e.g. its message shard. Ranks are computed from each index's
+    # own statistics, so they're only strictly comparable between hits from the same source.
+    source: int = 0
+
+
+# Position within a single source's hits: the (rank, message ID) of the last hit seen. Hits are
+# ordered by ascending rank, ties broken by ascending ID.
+SearchPosition = Tuple[float, int]
+
+# Position within search results, which may merge the hits of several sources: the position
+# reached within each, keyed by source. Each source resumes from its own position, so page
+# boundaries don't depend on how the sources' ranks compare.
+SearchCursor = Dict[int, SearchPosition]
+
+SEARCH_HIGHLIGHT = ('<mark>', '</mark>')
+
+
+def advance_search_cursor(after: Optional[SearchCursor], hits: List[MessageSearchHit]) -> SearchCursor:
+    '''
+    Returns the cursor following the hits of a search that resumed from 'after'
+    '''
+    cursor = dict(after) if after is not None else {}
+    for hit in hits:
+        cursor[hit.source] = (hit.rank, cast(int, hit.message.id))
+    return cursor
+
+
+def create_highlight_markers() -> Tuple[str, str]:
+    '''
+    Creates a pair of markers to delimit the matching terms within a raw snippet. They're random
+    so that message content can't forge a highlight.
+    '''
+    nonce = secrets.token_hex(8)
+    return f'\x02{nonce}\x03', f'\x03{nonce}\x02'
+
+
+def render_snippet(snippet: str, markers: Tuple[str, str]) -> str:
+    '''
+    HTML-escapes a raw snippet, then swaps its markers for the SEARCH_HIGHLIGHT tags
+    '''
+    snippet = html.escape(snippet)
+    for marker, tag in zip(markers, SEARCH_HIGHLIGHT):
+        snippet = snippet.replace(marker, tag)
+    return snippet
+
+
+def compile_search_patterns(query: str) -> List[re.Pattern]:
+    '''
+    Compiles a user's search query into a case-insensitive pattern per term, for searching
+    content outside of a full-text index
+    Raises ValueError if the query contains no searchable terms.
+    '''
+    return [
+        re.compile(r'\b' + re.escape(term) + (r'\w*' if prefix else r'\b'), re.IGNORECASE)
+        for term, prefix in parse_search_terms(query)
+    ]
+
+
+def fold_diacritics(text: str) -> str:
+    '''
+    Strips diacritics from the text, as the full-text indexes' tokenizer does, so that content
+    can be matched the same way outside of them
+    '''
+    return ''.join(x for x in unicodedata.normalize('NFKD', text) if not unicodedata.combining(x))
+
+
+def highlight_search_terms(content: str, patterns: List[re.Pattern]) -> str:
+    '''
+    Renders the whole of the content as a snippet, highlighting every match of the patterns
+    '''
+    markers = create_highlight_markers()
+    open_marker, close_marker = markers
+    for pattern in patterns:
+        content = pattern.sub(lambda x: f'{open_marker}{x.group(0)}{close_marker}', content)
+    return render_snippet(content, markers)
+
+
+def parse_search_terms(query: str) -> List[Tuple[str, bool]]:
+    '''
+    Splits a user's search query into (term, is_prefix) pairs. A trailing '*' on a term makes it
+    a prefix search; all other punctuation is treated as whitespace.
+    Raises ValueError if the query contains no searchable terms.
+    '''
+    terms = [(x.group(1).lower(), bool(x.group(2))) for x in re.finditer(r'(\w+)(\*?)', query)]
+    if not terms:
+        raise ValueError('Search query contains no terms')
+    return terms
+
+
+def to_fts_query(query: str) -> str:
+    '''
+    Converts a user's search query into an FTS5 query matching messages containing every term.
+    Terms are quoted, so the user can't inject FTS5 syntax (or syntax errors).
+    '''
+    return ' '.join(f'"{term}"' + ('*' if prefix else '') for term, prefix in parse_search_terms(query))
+
+
 class MessageRepository(ABC):
 
     @abstractmethod
@@ -25,16 +144,248 @@ class MessageRepository(ABC):
 
 
     @abstractmethod
-    def get_messages_for_conversation(self, id: str) -> List[Message]:
+    def create_messages(
+        self,
+        conversation_id: str,
+        sender_id: str,
+        contents: List[str],
+        created_at: Optional[datetime] = None
+    ) -> List[Message]:
+        '''
+        Creates and adds a batch of messages to the specified conversation as a single operation.
+        The messages are returned in the order given, with their IDs assigned in that same order.
+        '''
+        raise NotImplementedError()
+
+
+    @abstractmethod
+    def get_messages_for_conversation(
+        self,
+        id: str,
+        after: Optional[int] = None,
+        before: Optional[int] = None,
+        limit: Optional[int] = None
+    ) -> List[Message]:
+        '''
+        Retrieves a page of messages for the specified conversation, ordered by ascending ID
+        - after: only messages with an ID greater than this value are returned
+        - before: only messages with an ID less than this value are returned. The page is
+          anchored to the newest messages preceding it (i.e. paging backwards in history)
+        - limit: the maximum number of messages to return
+        '''
+        raise NotImplementedError()
+
+
+    @abstractmethod
+    def get_messages_for_conversations(
+        self,
+        cursors: Dict[str, int],
+        limit: Optional[int] = None
+    ) -> List[Message]:
         '''
-        Retrieves all messages for the specified
+        Retrieves the messages following each conversation's cursor, across several conversations
+        at once. Messages are ordered by ascending ID and 'limit' caps the total number returned.
         '''
         raise NotImplementedError()
 
 
+    @abstractmethod
+    def search_messages(
+        self,
+        conversation_ids: List[str],
+        query: str,
+        after: Optional[SearchCursor] = None,
+        limit: Optional[int] = None
+    ) -> List[MessageSearchHit]:
+        '''
+        Searches the specified conversations for messages containing every term of the query,
+        most relevant first. If 'after' is given, only hits following that position are returned.
+        Raises ValueError if the query contains no searchable terms.
+        '''
+        raise NotImplementedError()
+
+
+class ConversationLog:
+    '''
+    Compact storage for a single conversation's messages, held as parallel arrays ordered by ID.
+    IDs and timestamps live in typed arrays (8 bytes apiece) rather than as individual objects,
+    and sender IDs are interned so each participant's ID is only stored once.
+    '''
+
+    __slots__ = ('ids', 'sender_ids', 'contents', 'timestamps')
+
+    def __init__(self):
+        self.ids = array('q')
+        self.sender_ids: List[str] = []
+        self.contents: List[str] = []
+
+        # Microseconds since the epoch, UTC
+        self.timestamps = array('q')
+
+
+    def append(self, message: Message) -> None:
+        self.ids.append(message.id)
+        self.sender_ids.append(sys.intern(message.sender_id))
+        self.contents.append(message.content)
+        self.timestamps.append(to_microseconds(message.created_at))
+
+
+    def get_message(self, conversation_id: str, index: int) -> Message:
+        return Message(
+            id=self.ids[index],
+            conversation_id=conversation_id,
+            sender_id=self.sender_ids[index],
+            content=self.contents[index],
+            created_at=from_microseconds(self.timestamps[index])
+        )
+
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def to_microseconds(value: datetime) -> int:
+    delta = value.astimezone(timezone.utc) - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def from_microseconds(value: int) -> datetime:
+    return datetime.fromtimestamp(value // 1000000, timezone.utc).replace(microsecond=value % 1000000)
+
+
+
 class InMemoryMessageRepository(MessageRepository):
-    # TODO: Skipped for the sake of time but should definitely be here for testing
-    pass
+
+    def __init__(self):
+        self.conversations: Dict[str, ConversationLog] = {}
+        self.next_id = 1
+
+
+    def create_message(
+        self,
+        conversation_id: str,
+        sender_id: str,
+        content: str,
+        created_at: Optional[datetime] = None
+    ) -> Message:
+        '''
+        Creates and adds a new message to the specified conversation
+        '''
+        return self.create_messages(conversation_id, sender_id, [content], created_at)[0]
+
+
+    def create_messages(
+        self,
+        conversation_id: str,
+        sender_id: str,
+        contents: List[str],
+        created_at: Optional[datetime] = None
+    ) -> List[Message]:
+        '''
+        Creates and adds a batch of messages to the specified conversation as a single operation.
+        The messages are returned in the order given, with their IDs assigned in that same order.
+        '''
+
+        if created_at is None:
+            created_at = get_current_time()
+
+        log = self.conversations.get(conversation_id, None)
+        if log is None:
+            log = ConversationLog()
+            self.conversations[conversation_id] = log
+
+        messages = []
+        for content in contents:
+            message = Message(
+                id=self.next_id,
+                conversation_id=conversation_id,
+                sender_id=sender_id,
+                content=content,
+                created_at=created_at
+            )
+            self.next_id += 1
+
+            log.append(message)
+            messages.append(message)
+
+        return messages
+
+
+    def get_messages_for_conversation(
+        self,
+        id: str,
+        after: Optional[int] = None,
+        before: Optional[int] = None,
+        limit: Optional[int] = None
+    ) -> List[Message]:
+        '''
+        Retrieves a page of messages for the specified conversation, ordered by ascending ID
+        '''
+
+        log = self.conversations.get(id, None)
+        if log is None:
+            return []
+
+        # IDs are allocated in ascending order, so the cursors can be located by bisection
+        start = bisect_right(log.ids, after) if after is not None else 0
+        end = bisect_left(log.ids, before) if before is not None else len(log.ids)
+
+        # Paging backwards anchors the page to the newest messages preceding 'before'
+        if limit is not None:
+            if before is not None:
+                start = max(start, end - limit)
+            else:
+                end = min(end, start + limit)
+
+        return [log.get_message(id, x) for x in range(start, end)]
+
+
+    def get_messages_for_conversations(
+        self,
+        cursors: Dict[str, int],
+        limit: Optional[int] = None
+    ) -> List[Message]:
+        '''
+        Retrieves the messages following each conversation's cursor, ordered by ascending ID
+        '''
+        messages = []
+        for id, after in cursors.items():
+            messages.extend(self.get_messages_for_conversation(id, after=after, limit=limit))
+
+        messages.sort(key=attrgetter('id'))
+        return messages[:limit] if limit is not None else messages
+
+
+    def search_messages(
+        self,
+        conversation_ids: List[str],
+        query: str,
+        after: Optional[SearchCursor] = None,
+        limit: Optional[int] = None
+    ) -> List[MessageSearchHit]:
+        '''
+        Searches the specified conversations for messages containing every term of the query.
+        This scans every message in the conversations, ranking hits by how often the terms occur.
+        '''
+        patterns = compile_search_patterns(query)
+        position = after.get(0, None) if after is not None else None
+
+        hits = []
+        for id in conversation_ids:
+            log = self.conversations.get(id, None)
+            if log is None:
+                continue
+
+            for index, content in enumerate(log.contents):
+                counts = [len(x.findall(content)) for x in patterns]
+                if not all(counts):
+                    continue
+
+                snippet = highlight_search_terms(content, patterns)
+                hit = MessageSearchHit(log.get_message(id, index), snippet, -float(sum(counts)))
+                if position is None or (hit.rank, hit.message.id) > position:
+                    hits.append(hit)
+
+        hits.sort(key=lambda x: (x.rank, x.message.id))
+        return hits[:limit] if limit is not None else hits
 
 
 class DbMessageRepository(MessageRepository):
@@ -64,17 +415,403 @@ class DbMessageRepository(MessageRepository):
             created_at=created_at
         )
         self.session.add(message)
-        self.session.commit()
+        commit(self.session)
         return message
 
 
+    def create_messages(
+        self,
+        conversation_id: str,
+        sender_id: str,
+        contents: List[str],
+        created_at: Optional[datetime] = None
+    ) -> List[Message]:
+        '''
+        Creates and adds a batch of messages to the specified conversation as a single operation.
+        The messages are returned in the order given, with their IDs assigned in that same order.
+        '''
+
+        if created_at is None:
+            created_at = get_current_time()
+
+        messages = [
+            Message(conversation_id=conversation_id, sender_id=sender_id, content=x, created_at=created_at)
+            for x in contents
+        ]
+        return self.insert_messages(messages)
+
+
+    def insert_messages(self, messages: List[Message]) -> List[Message]:
+        '''
+        Inserts pre-built messages, which may span several conversations, using a single executemany
+        within one transaction. IDs are assigned in the order given and set on the instances.
+        '''
+
+        if not messages:
+            return messages
+
+        # The assigned IDs are handed back through RETURNING rather than re-selecting each row
+        rows = [x.model_dump(exclude={'id'}) for x in messages]
+        query = insert(Message).returning(col(Message.id), sort_by_parameter_order=True)
+        ids = self.session.execute(query, rows).scalars().all()
+        commit(self.session)
 
-    def get_messages_for_conversation(self, id: str, start:int = 0) -> List[Message]:
+        for message, id in zip(messages, ids):
+            message.id = id
+        return messages
+
+
+
+    def get_messages_for_conversation(
+        self,
+        id: str,
+        after: Optional[int] = None,
+        before: Optional[int] = None,
+        limit: Optional[int] = None
+    ) -> List[Message]:
         '''
-        Retrieves all messages for the specified
+        Retrieves a page of messages for the specified conversation, ordered by ascending ID
         '''
 
-        query = select(Message).where(Message.conversation_id == id).where(Message.id >= start)
+        query = select(Message).where(Message.conversation_id == id)
+        if after is not None:
+            query = query.where(col(Message.id) > after)
+
+        # Paging backwards requires walking the ID range in descending order so the
+        # limit is applied to the newest messages, we flip them back afterwards
+        if before is not None:
+            query = query.where(col(Message.id) < before).order_by(col(Message.id).desc())
+        else:
+            query = query.order_by(col(Message.id))
+
+        if limit is not None:
+            query = query.limit(limit)
+
         results = self.session.execute(query)
-        return [x[0] for x in results.all()]
+        messages = [x[0] for x in results.all()]
+        if before is not None:
+            messages.reverse()
+        return messages
+
+
+    def get_messages_for_conversations(
+        self,
+        cursors: Dict[str, int],
+        limit: Optional[int] = None
+    ) -> List[Message]:
+        '''
+        Retrieves the messages following each conversation's cursor, ordered by ascending ID.
+        Each (conversation, cursor) pair is a range on the conversation/ID index, so the whole
+        lot is gathered by a single query.
+        '''
+        if not cursors:
+            return []
+
+        query = (
+            select(Message)
+            .where(or_(*[and_(col(Message.conversation_id) == id, col(Message.id) > after) for id, after in cursors.items()]))
+            .order_by(col(Message.id))
+        )
+        if limit is not None:
+            query = query.limit(limit)
+
+        return list(self.session.execute(query).scalars().all())
+
+
+    def search_messages(
+        self,
+        conversation_ids: List[str],
+        query: str,
+        after: Optional[SearchCursor] = None,
+        limit: Optional[int] = None
+    ) -> List[MessageSearchHit]:
+        '''
+        Searches the specified conversations for messages containing every term of the query,
+        using the message_fts full-text index and ranking hits by bm25()
+        '''
+        if not conversation_ids:
+            return []
+
+        fts = table('message_fts', column('rowid'))
+        rank = func.bm25(literal_column('message_fts'))
+        markers = create_highlight_markers()
+        snippet = func.snippet(literal_column('message_fts'), 0, *markers, '…', 16)
+
+        statement = (
+            select(Message, snippet, rank)
+            .join_from(Message, fts, fts.c.rowid == Message.id)
+            .where(text('message_fts MATCH :query').bindparams(query=to_fts_query(query)))
+            .where(col(Message.conversation_id).in_(conversation_ids))
+        )
+
+        position = after.get(0, None) if after is not None else None
+        if position is not None:
+            after_rank, after_id = position
+            statement = statement.where(or_(rank > after_rank, and_(rank == after_rank, col(Message.id) > after_id)))
+
+        statement = statement.order_by(rank, col(Message.id))
+        if limit is not None:
+            statement = statement.limit(limit)
+
+        return [
+            MessageSearchHit(message, render_snippet(snippet, markers), rank)
+            for message, snippet, rank in self.session.execute(statement).all()
+        ]
+
+
+    def find_messages_created_before(self, cutoff: datetime) -> Dict[str, int]:
+        '''
+        Finds the conversations holding messages created before the cutoff, mapping each to the
+        ID of its newest such message
+        '''
+        # The unary '+' stops SQLite from grouping via the conversation index, which would scan the
+        # whole table, so it reads the range of ix_message_created_at_conversation_id instead
+        query = select(Message.conversation_id, func.max(Message.id)) \
+            .where(col(Message.created_at) < cutoff) \
+            .group_by(literal_column('+message.conversation_id'))
+        return {id: last_id for id, last_id in self.session.execute(query).all()}
+
+
+    def delete_messages_up_to(self, conversation_id: str, up_to_id: int, batch_size: int) -> int:
+        '''
+        Removes the conversation's messages with IDs up to and including the one specified, in
+        batches so as not to hold the database's write lock for long. Returns the number removed.
+        '''
+        deleted = 0
+        while True:
+            ids = self.session.execute(
+                select(Message.id)
+                .where(Message.conversation_id == conversation_id)
+                .where(col(Message.id) <= up_to_id)
+                .limit(batch_size)
+            ).scalars().all()
+            if not ids:
+                break
+
+            self.session.execute(delete(Message).where(col(Message.id).in_(ids)))
+            self.session.commit()
+            deleted += len(ids)
+
+        return deleted
+
+
+
+def get_shard_index(conversation_id: str, num_shards: int) -> int:
+    '''
+    Maps a conversation onto one of the message shards. A stable hash is required here, as
+    Python's built-in hash() for strings is salted differently in every process.
+    '''
+    return zlib.crc32(conversation_id.encode('utf-8')) % num_shards
+
+
+
+class ShardedMessageRepository(MessageRepository):
+    '''
+    Spreads messages across several databases, keyed by conversation. All of a conversation's
+    messages live on the same shard, so reads and cursors behave exactly as they would on a
+    single database. Message IDs are only unique within a shard.
+    '''
+
+    def __init__(self, get_shard_session: Callable[[int], Session], num_shards: int):
+        self.get_shard_session = get_shard_session
+        self.num_shards = num_shards
+        self.shards: Dict[int, DbMessageRepository] = {}
+
+
+    def get_shard(self, index: int) -> DbMessageRepository:
+        '''
+        Retrieves the repository for the specified shard, opening a session against it on first use
+        '''
+        shard = self.shards.get(index, None)
+        if shard is None:
+            shard = DbMessageRepository(self.get_shard_session(index))
+            self.shards[index] = shard
+        return shard
+
+
+    def get_shard_for_conversation(self, conversation_id: str) -> DbMessageRepository:
+        return self.get_shard(get_shard_index(conversation_id, self.num_shards))
+
+
+    def create_message(
+        self,
+        conversation_id: str,
+        sender_id: str,
+        content: str,
+        created_at: Optional[datetime] = None
+    ) -> Message:
+        '''
+        Creates and adds a new message to the specified conversation
+        '''
+        shard = self.get_shard_for_conversation(conversation_id)
+        return shard.create_message(conversation_id, sender_id, content, created_at)
+
+
+    def create_messages(
+        self,
+        conversation_id: str,
+        sender_id: str,
+        contents: List[str],
+        created_at: Optional[datetime] = None
+    ) -> List[Message]:
+        '''
+        Creates and adds a batch of messages to the specified conversation as a single operation
+        '''
+        shard = self.get_shard_for_conversation(conversation_id)
+        return shard.create_messages(conversation_id, sender_id, contents, created_at)
+
+
+    def get_messages_for_conversation(
+        self,
+        id: str,
+        after: Optional[int] = None,
+        before: Optional[int] = None,
+        limit: Optional[int] = None
+    ) -> List[Message]:
+        '''
+        Retrieves a page of messages for the specified conversation, ordered by ascending ID
+        '''
+        shard = self.get_shard_for_conversation(id)
+        return shard.get_messages_for_conversation(id, after=after, before=before, limit=limit)
+
+
+    def get_messages_for_conversations(
+        self,
+        cursors: Dict[str, int],
+        limit: Optional[int] = None
+    ) -> List[Message]:
+        '''
+        Retrieves the messages following each conversation's cursor, with one query per shard
+        involved. As IDs are only unique within a shard, messages are ordered by shard and then ID.
+        '''
+        by_shard: Dict[int, Dict[str, int]] = {}
+        for id, after in cursors.items():
+            by_shard.setdefault(get_shard_index(id, self.num_shards), {})[id] = after
+
+        messages: List[Message] = []
+        for index in sorted(by_shard):
+            remaining = limit - len(messages) if limit is not None else None
+            if remaining is not None and remaining <= 0:
+                break
+            messages.extend(self.get_shard(index).get_messages_for_conversations(by_shard[index], limit=remaining))
+
+        return messages
+
+
+    def search_messages(
+        self,
+        conversation_ids: List[str],
+        query: str,
+        after: Optional[SearchCursor] = None,
+        limit: Optional[int] = None
+    ) -> List[MessageSearchHit]:
+        '''
+        Searches each shard holding any of the conversations and merges the hits by rank. Each
+        shard is a source of its own, resuming from the position the cursor holds for it.
+        NOTE: bm25() is computed from each shard's own statistics, so ranks are only
+        approximately comparable between shards.
+        '''
+        by_shard: Dict[int, List[str]] = {}
+        for id in conversation_ids:
+            by_shard.setdefault(get_shard_index(id, self.num_shards), []).append(id)
+
+        hits: List[MessageSearchHit] = []
+        for index, ids in by_shard.items():
+            position = after.get(index, None) if after is not None else None
+            shard_hits = self.get_shard(index).search_messages(
+                ids,
+                query,
+                after={0: position} if position is not None else None,
+                limit=limit
+            )
+            hits.extend(x._replace(source=index) for x in shard_hits)
+
+        hits.sort(key=lambda x: (x.rank, x.message.id))
+        return hits[:limit] if limit is not None else hits
+
+
+    def find_messages_created_before(self, cutoff: datetime) -> Dict[str, int]:
+        '''
+        Finds the conversations holding messages created before the cutoff across every shard,
+        mapping each to the ID of its newest such message
+        '''
+        found = {}
+        for index in range(self.num_shards):
+            found.update(self.get_shard(index).find_messages_created_before(cutoff))
+        return found
+
+
+    def delete_messages_up_to(self, conversation_id: str, up_to_id: int, batch_size: int) -> int:
+        '''
+        Removes the conversation's messages with IDs up to and including the one specified
+        '''
+        shard = self.get_shard_for_conversation(conversation_id)
+        return shard.delete_messages_up_to(conversation_id, up_to_id, batch_size)
+
+
+    def find_misplaced_conversations(self) -> List[Tuple[str, int, int]]:
+        '''
+        Finds conversations stored on a shard other than the one they hash to, which happens when
+        the list of shards changes. Returns (conversation ID, current shard, target shard) tuples.
+        '''
+        misplaced = []
+        for index in range(self.num_shards):
+            session = self.get_shard(index).session
+            conversation_ids = session.execute(select(Message.conversation_id).distinct()).scalars()
+            for conversation_id in conversation_ids.all():
+                target = get_shard_index(conversation_id, self.num_shards)
+                if target != index:
+                    misplaced.append((conversation_id, index, target))
+
+        return misplaced
+
+
+    def move_conversation(self, conversation_id: str, source: int, target: int, batch_size: int) -> int:
+        '''
+        Moves a conversation's messages between shards in batches, preserving their IDs so that
+        clients' cursors remain valid. Messages are only removed from the source once all of them
+        have been copied, and an interrupted move resumes where it left off. Returns the number
+        of messages moved.
+        Raises ValueError if a message ID is already taken on the target shard.
+        '''
+        source_session = self.get_shard(source).session
+        target_session = self.get_shard(target).session
+
+        # Resume after anything copied by a previous, interrupted attempt
+        resume = select(func.max(Message.id)).where(Message.conversation_id == conversation_id)
+        cursor = target_session.execute(resume).scalar() or 0
+
+        while True:
+            query = select(Message) \
+                .where(Message.conversation_id == conversation_id) \
+                .where(col(Message.id) > cursor) \
+                .order_by(col(Message.id)) \
+                .limit(batch_size)
+            messages = source_session.execute(query).scalars().all()
+            if not messages:
+                break
+
+            try:
+                target_session.execute(insert(Message), [x.model_dump() for x in messages])
+                target_session.commit()
+            except IntegrityError:
+                target_session.rollback()
+                raise ValueError(f"Message ID collision on shard {target} moving '{conversation_id}'")
+
+            cursor = messages[-1].id
+            source_session.expunge_all()
+
+        # Everything has been copied, so it's now safe to remove it from the source
+        moved = 0
+        while True:
+            ids = source_session.execute(
+                select(Message.id).where(Message.conversation_id == conversation_id).limit(batch_size)
+            ).scalars().all()
+            if not ids:
+                break
+
+            source_session.execute(delete(Message).where(col(Message.id).in_(ids)))
+            source_session.commit()
+            moved += len(ids)
 
+        return moved
@@ -0,0 +1,317 @@
+
+from collections import OrderedDict, deque
+from datetime import datetime
+from operator import attrgetter
+from typing import Deque, Dict, List, Optional, Tuple, cast
+
+from app.models.message import Message
+from app.repositories.message import MessageRepository, MessageSearchHit, SearchCursor
+from app.repositories.unitofwork import AfterCommit, run_now
+
+
+# Rough per-message overhead of a cached entry on top of its content (tuple, ID, timestamp, etc.)
+_ENTRY_OVERHEAD_BYTES = 200
+
+# Number of write generations, conversations share them by hash of their ID
+_GENERATION_STRIPES = 1024
+
+
+class ConversationTail:
+    '''
+    The most recent messages of a single conversation, held in a bounded ring. The tail is
+    complete above its 'floor': every message in the conversation with an ID greater than the
+    floor is present, which is what allows reads to be answered without consulting storage.
+    '''
+
+    __slots__ = ('entries', 'floor', 'size')
+
+    def __init__(self, floor: int, max_entries: int):
+        self.entries: Deque[Tuple[int, str, str, datetime]] = deque(maxlen=max_entries)
+        self.floor = floor
+        self.size = 0
+
+
+    @property
+    def last_id(self) -> int:
+        return self.entries[-1][0] if self.entries else self.floor
+
+
+    def append(self, message: Message) -> int:
+        '''
+        Adds a message to the tail, pushing out the oldest if the ring is full. Returns the change
+        in the tail's estimated size in bytes.
+        '''
+        delta = 0
+        if len(self.entries) == self.entries.maxlen:
+            evicted = self.entries[0]
+            self.floor = evicted[0]
+            delta -= len(evicted[2]) + _ENTRY_OVERHEAD_BYTES
+
+        self.entries.append((cast(int, message.id), message.sender_id, message.content, message.created_at))
+        delta += len(message.content) + _ENTRY_OVERHEAD_BYTES
+        self.size += delta
+        return delta
+
+
+    def covers(self, after: Optional[int]) -> bool:
+        '''
+        Returns True if every message following 'after' is held by the tail
+        '''
+        return (after if after is not None else 0) >= self.floor
+
+
+
+class MessageTailCache:
+    '''
+    Process-wide cache of the most recent messages of active conversations. Conversations are
+    evicted least-recently-used first once the cache's estimated size exceeds its budget.
+
+    NOTE: the cache is populated write-through by this process. Messages written by another
+    process are invisible to it, so it must only be enabled when a single process serves writes.
+    '''
+
+    def __init__(self, max_entries_per_conversation: int, max_bytes: int):
+        self.max_entries_per_conversation = max_entries_per_conversation
+        self.max_bytes = max_bytes
+
+        self.tails: OrderedDict[str, ConversationTail] = OrderedDict()
+        self.size = 0
+
+        # Bumped by every write to a conversation, so that reads which raced with one don't seed
+        # a tail that's missing the write. Striped, rather than tracked per conversation, to keep
+        # them bounded; a collision merely skips seeding a tail.
+        self.generations = [0] * _GENERATION_STRIPES
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'conversations': len(self.tails),
+            'estimated_bytes': self.size
+        }
+
+
+    def get_generation(self, conversation_id: str) -> int:
+        return self.generations[hash(conversation_id) % _GENERATION_STRIPES]
+
+
+    def get_messages(
+        self,
+        conversation_id: str,
+        after: Optional[int] = None,
+        before: Optional[int] = None,
+        limit: Optional[int] = None
+    ) -> Optional[List[Message]]:
+        '''
+        Answers a read from the cache, following the semantics of
+        MessageRepository.get_messages_for_conversation(). Returns None on a cache miss.
+        '''
+        tail = self.tails.get(conversation_id, None)
+        if tail is None:
+            self.misses += 1
+            return None
+
+        # Gather matching entries newest-first, as polls typically only want the last few
+        entries = []
+        for entry in reversed(tail.entries):
+            if after is not None and entry[0] <= after:
+                break
+            if before is None or entry[0] < before:
+                entries.append(entry)
+        entries.reverse()
+
+        # Reads are answerable if they lie entirely above the floor. Backwards reads may also be
+        # answered when the cache alone can fill the page.
+        if tail.covers(after):
+            if limit is not None:
+                entries = entries[-limit:] if before is not None else entries[:limit]
+        elif before is not None and limit is not None and len(entries) >= limit:
+            entries = entries[-limit:]
+        else:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.tails.move_to_end(conversation_id)
+        return [
+            Message(id=id, conversation_id=conversation_id, sender_id=sender_id, content=content, created_at=created_at)
+            for id, sender_id, content, created_at in entries
+        ]
+
+
+    def append_messages(self, conversation_id: str, messages: List[Message]) -> None:
+        '''
+        Write-through of newly committed messages. Only conversations already in the cache are
+        updated, as a tail is only useful if it is complete.
+        '''
+        self._bump_generation(conversation_id)
+        tail = self.tails.get(conversation_id, None)
+        if tail is None:
+            return
+
+        for message in messages:
+            # Anything at or below the tail's newest message is already accounted for
+            if cast(int, message.id) > tail.last_id:
+                self.size += tail.append(message)
+
+        self.tails.move_to_end(conversation_id)
+        self.enforce_budget()
+
+
+    def populate(self, conversation_id: str, after: Optional[int], messages: List[Message], generation: int) -> None:
+        '''
+        Seeds a conversation's tail from a read that is known to have reached the newest message,
+        i.e. 'messages' holds every message in the conversation following 'after'. The tail is
+        only seeded if no write has occurred since 'generation' was read, before the read began.
+        '''
+        if conversation_id in self.tails or generation != self.get_generation(conversation_id):
+            return
+
+        tail = ConversationTail(after if after is not None else 0, self.max_entries_per_conversation)
+        for message in messages:
+            tail.append(message)
+
+        self.tails[conversation_id] = tail
+        self.size += tail.size
+        self.enforce_budget()
+
+
+    def invalidate(self, conversation_id: str) -> None:
+        self._bump_generation(conversation_id)
+        tail = self.tails.pop(conversation_id, None)
+        if tail is not None:
+            self.size -= tail.size
+
+
+    def enforce_budget(self) -> None:
+        while self.size > self.max_bytes and self.tails:
+            _, tail = self.tails.popitem(last=False)
+            self.size -= tail.size
+            self.evictions += 1
+
+
+    def _bump_generation(self, conversation_id: str) -> None:
+        self.generations[hash(conversation_id) % _GENERATION_STRIPES] += 1
+
+
+
+class CachedMessageRepository(MessageRepository):
+    '''
+    Decorates another MessageRepository with a MessageTailCache. Reads that fall within a cached
+    tail never reach the underlying repository; writes are passed through and then cached, once
+    'after_commit' reports they've been committed.
+    '''
+
+    def __init__(self, repository: MessageRepository, cache: MessageTailCache, after_commit: AfterCommit = run_now):
+        self.repository = repository
+        self.cache = cache
+        self.after_commit = after_commit
+
+
+    def create_message(
+        self,
+        conversation_id: str,
+        sender_id: str,
+        content: str,
+        created_at: Optional[datetime] = None
+    ) -> Message:
+        '''
+        Creates and adds a new message to the specified conversation
+        '''
+        message = self.repository.create_message(conversation_id, sender_id, content, created_at)
+        self.after_commit(lambda: self.cache.append_messages(conversation_id, [message]))
+        return message
+
+
+    def create_messages(
+        self,
+        conversation_id: str,
+        sender_id: str,
+        contents: List[str],
+        created_at: Optional[datetime] = None
+    ) -> List[Message]:
+        '''
+        Creates and adds a batch of messages to the specified conversation as a single operation
+        '''
+        messages = self.repository.create_messages(conversation_id, sender_id, contents, created_at)
+        self.after_commit(lambda: self.cache.append_messages(conversation_id, messages))
+        return messages
+
+
+    def get_messages_for_conversation(
+        self,
+        id: str,
+        after: Optional[int] = None,
+        before: Optional[int] = None,
+        limit: Optional[int] = None
+    ) -> List[Message]:
+        '''
+        Retrieves a page of messages for the specified conversation, ordered by ascending ID
+        '''
+        messages = self.cache.get_messages(id, after=after, before=before, limit=limit)
+        if messages is not None:
+            return messages
+
+        generation = self.cache.get_generation(id)
+        messages = self.repository.get_messages_for_conversation(id, after=after, before=before, limit=limit)
+
+        # A forwards read that came up short of its limit has reached the newest message,
+        # so it describes the conversation's entire tail
+        if before is None and (limit is None or len(messages) < limit):
+            self.cache.populate(id, after, messages, generation)
+
+        return messages
+
+
+    def get_messages_for_conversations(
+        self,
+        cursors: Dict[str, int],
+        limit: Optional[int] = None
+    ) -> List[Message]:
+        '''
+        Retrieves the messages following each conversation's cursor. Conversations whose cursor
+        falls within their cached tail are answered from the cache, the rest with a single read.
+        '''
+        messages = []
+        uncached = {}
+        for id, after in cursors.items():
+            cached = self.cache.get_messages(id, after=after, limit=limit)
+            if cached is None:
+                uncached[id] = after
+            else:
+                messages.extend(cached)
+
+        if uncached:
+            generations = {id: self.cache.get_generation(id) for id in uncached}
+            fetched = self.repository.get_messages_for_conversations(uncached, limit=limit)
+            messages.extend(fetched)
+
+            # If the read wasn't cut short, it reached the newest message of every conversation
+            if limit is None or len(fetched) < limit:
+                by_conversation: Dict[str, List[Message]] = {id: [] for id in uncached}
+                for message in fetched:
+                    by_conversation[message.conversation_id].append(message)
+                for id, conversation_messages in by_conversation.items():
+                    self.cache.populate(id, uncached[id], conversation_messages, generations[id])
+
+        messages.sort(key=attrgetter('id'))
+        return messages[:limit] if limit is not None else messages
+
+
+    def search_messages(
+        self,
+        conversation_ids: List[str],
+        query: str,
+        after: Optional[SearchCursor] = None,
+        limit: Optional[int] = None
+    ) -> List[MessageSearchHit]:
+        '''
+        Searches the specified conversations for messages containing every term of the query
+        '''
+        return self.repository.search_messages(conversation_ids, query, after=after, limit=limit)
@@ -0,0 +1,119 @@
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlmodel import SQLModel
+from typing import Any, Dict, Generic, NamedTuple, Optional, Type, TypeVar, cast
+
+from shared.time import get_current_time
+
+
+ModelT = TypeVar('ModelT', bound=SQLModel)
+
+
+class CachedModel(NamedTuple):
+    model_class: Type[SQLModel]
+
+    # Snapshot of the model's fields, a fresh instance is built from it upon every hit
+    fields: Dict[str, Any]
+    expires_at: datetime
+
+
+
+class ModelCache(Generic[ModelT]):
+    '''
+    Process-wide cache of model instances keyed by string, bounded in both size and age. Entries
+    expire after 'time_to_live' seconds and the least recently used are evicted once 'max_entries'
+    is reached. Subclasses keep any secondary indexes of their own in step via _on_add() and
+    _on_remove().
+    '''
+
+    def __init__(self, max_entries: int, time_to_live: int):
+        self.max_entries = max_entries
+        self.time_to_live = timedelta(seconds=time_to_live)
+
+        self.entries: OrderedDict[str, CachedModel] = OrderedDict()
+
+        # Bumped by every invalidation, so that lookups which raced with one aren't cached
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get_stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': len(self.entries)
+        }
+
+
+    def lookup(self, key: Optional[str]) -> Optional[ModelT]:
+        '''
+        Returns a fresh copy of the cached instance, or None on a cache miss
+        '''
+        entry = self.entries.get(key, None) if key is not None else None
+        if key is None or entry is None:
+            self.misses += 1
+            return None
+
+        if entry.expires_at <= get_current_time():
+            self.remove(key)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return cast(ModelT, entry.model_class(**entry.fields))
+
+
+    def insert(
+        self,
+        key: str,
+        model: ModelT,
+        generation: Optional[int] = None,
+        expires_at: Optional[datetime] = None
+    ) -> None:
+        '''
+        Caches a snapshot of the instance for up to the time to live, or until 'expires_at' if
+        that's sooner. Given a 'generation', the instance is the result of a lookup and is only
+        cached if no invalidation has occurred since it was read, before the lookup began.
+        '''
+        if generation is not None and generation != self.generation:
+            return
+
+        expiry = get_current_time() + self.time_to_live
+        if expires_at is not None:
+            expiry = min(expiry, expires_at)
+
+        self.remove(key)
+        fields = {name: getattr(model, name) for name in type(model).model_fields}
+        self.entries[key] = CachedModel(type(model), fields, expiry)
+        self._on_add(key, fields)
+
+        while len(self.entries) > self.max_entries:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+
+    def invalidate(self, key: str) -> None:
+        self.generation += 1
+        self.remove(key)
+
+
+    def remove(self, key: str) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self._on_remove(key, entry.fields)
+
+
+    def _on_add(self, key: str, fields: Dict[str, Any]) -> None:
+        pass
+
+
+    def _on_remove(self, key: str, fields: Dict[str, Any]) -> None:
+        pass
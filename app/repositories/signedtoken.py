@@ -0,0 +1,217 @@
+
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import CursorResult, delete
+from sqlmodel import Session, col, select
+from typing import Dict, NamedTuple, Optional, cast
+
+from app.models.accesstoken import AccessToken, RevokedAccessToken
+from app.repositories.accesstoken import AccessTokenRepository
+from app.repositories.unitofwork import commit
+from shared.time import get_current_time
+
+
+# Prefix of every signed token, distinguishing them from opaque tokens (which never contain a dot)
+_TOKEN_VERSION = 'v1'
+
+
+class SignedTokenClaims(NamedTuple):
+    user_id: str
+
+    # Seconds since the epoch, UTC
+    issued_at: int
+    time_to_live: int
+
+    # Unique identifier of the token, used to revoke it
+    jti: str
+
+
+
+def _encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+
+class TokenSigner:
+    '''
+    Issues and verifies self-contained access tokens: the token's claims followed by an
+    HMAC-SHA256 signature over them
+    '''
+
+    def __init__(self, secret: Optional[str]):
+        if not secret:
+            raise ValueError('Signed access tokens require OAUTH2_TOKEN_SECRET to be set')
+        self.key = secret.encode('utf-8')
+
+
+    def sign(self, claims: SignedTokenClaims) -> str:
+        payload = f'{_TOKEN_VERSION}.{_encode(json.dumps(claims, separators=(",", ":")).encode("utf-8"))}'
+        return f'{payload}.{self._signature(payload)}'
+
+
+    def verify(self, token: str) -> Optional[SignedTokenClaims]:
+        '''
+        Returns the token's claims, or None if the token is malformed or its signature is invalid
+        '''
+        payload, _, signature = token.rpartition('.')
+        if not payload.startswith(f'{_TOKEN_VERSION}.'):
+            return None
+        if not hmac.compare_digest(signature, self._signature(payload)):
+            return None
+
+        try:
+            return SignedTokenClaims(*json.loads(_decode(payload.partition('.')[2])))
+        except (ValueError, TypeError):
+            return None
+
+
+    def _signature(self, payload: str) -> str:
+        return _encode(hmac.new(self.key, payload.encode('utf-8'), hashlib.sha256).digest())
+
+
+
+class TokenRevocationList:
+    '''
+    Process-wide set of revoked, yet to expire, signed tokens. The list is re-read from the
+    database every 'sync_interval' seconds so that revocations made by other processes are
+    picked up; revocations made by this process take effect immediately.
+    '''
+
+    def __init__(self, sync_interval: int):
+        self.sync_interval = timedelta(seconds=sync_interval)
+        self.revoked: Dict[str, datetime] = {}
+        self.synced_at: Optional[datetime] = None
+
+
+    def is_revoked(self, jti: str) -> bool:
+        return jti in self.revoked
+
+
+    def sync(self, session: Session, force: bool = False) -> None:
+        '''
+        Re-reads the list from the database if it's due
+        '''
+        now = get_current_time()
+        if not force and self.synced_at is not None and now - self.synced_at < self.sync_interval:
+            return
+
+        rows = session.execute(
+            select(RevokedAccessToken.id, RevokedAccessToken.expires_at).where(RevokedAccessToken.expires_at > now)
+        ).all()
+        self.revoked = {id: expires_at for id, expires_at in rows}
+        self.synced_at = now
+
+
+    def add(self, jti: str, expires_at: datetime) -> None:
+        self.revoked[jti] = expires_at
+
+
+
+class SignedAccessTokenRepository(AccessTokenRepository):
+    '''
+    Issues signed access tokens, which are verified without a database read. Only the revocation
+    list is consulted, and it's held in memory. Tokens that aren't signed are passed on to the
+    underlying repository, so opaque tokens issued before switching modes remain valid.
+    '''
+
+    def __init__(
+        self,
+        repository: AccessTokenRepository,
+        signer: TokenSigner,
+        revocations: TokenRevocationList,
+        session: Optional[Session]
+    ):
+        self.repository = repository
+        self.signer = signer
+        self.revocations = revocations
+
+        # Where revocations are recorded, or None to only keep them in memory
+        self.session = session
+
+
+    def create_token(self, user_id: str) -> AccessToken:
+        '''
+        Issues a new signed access token for the user
+        '''
+        created_at = get_current_time().replace(microsecond=0)
+        claims = SignedTokenClaims(
+            user_id=user_id,
+            issued_at=int(created_at.timestamp()),
+            time_to_live=AccessToken.default_time_to_live(),
+            jti=secrets.token_urlsafe(16)
+        )
+
+        return AccessToken.issue(
+            user_id,
+            id=self.signer.sign(claims),
+            created_at=created_at,
+            time_to_live=claims.time_to_live
+        )
+
+
+    def get_token_by_id(self, id: str) -> Optional[AccessToken]:
+        '''
+        Verifies the specified token, returning None if it's invalid or has been revoked
+        '''
+        if not id.startswith(f'{_TOKEN_VERSION}.'):
+            return self.repository.get_token_by_id(id)
+
+        claims = self.signer.verify(id)
+        if claims is None:
+            return None
+
+        if self.session is not None:
+            self.revocations.sync(self.session)
+        if self.revocations.is_revoked(claims.jti):
+            return None
+
+        return AccessToken.issue(
+            claims.user_id,
+            id=id,
+            created_at=datetime.fromtimestamp(claims.issued_at, tz=timezone.utc),
+            time_to_live=claims.time_to_live
+        )
+
+
+    def delete_token_by_id(self, id: str) -> None:
+        '''
+        Revokes an access token
+        Raises: KeyError if the token cannot be found
+        '''
+        if not id.startswith(f'{_TOKEN_VERSION}.'):
+            return self.repository.delete_token_by_id(id)
+
+        token = self.get_token_by_id(id)
+        if token is None:
+            raise KeyError('Access token cannot be found')
+
+        jti = cast(SignedTokenClaims, self.signer.verify(id)).jti
+        if self.session is not None:
+            self.session.add(RevokedAccessToken(id=jti, expires_at=token.expires_at))
+            commit(self.session)
+        self.revocations.add(jti, token.expires_at)
+
+
+    def delete_expired_tokens(self, now: datetime, limit: int) -> int:
+        '''
+        Deletes up to 'limit' stored tokens, and up to 'limit' revocations, that expired before
+        'now', returning the number deleted
+        '''
+        deleted = self.repository.delete_expired_tokens(now, limit)
+        if self.session is None:
+            return deleted
+
+        expired = select(RevokedAccessToken.id).where(col(RevokedAccessToken.expires_at) < now).limit(limit)
+        result = cast(CursorResult, self.session.execute(
+            delete(RevokedAccessToken).where(col(RevokedAccessToken.id).in_(expired)).execution_options(synchronize_session=False)
+        ))
+        commit(self.session)
+        return deleted + result.rowcount
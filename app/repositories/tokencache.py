@@ -0,0 +1,188 @@
+
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set
+
+from app.models.accesstoken import AccessToken
+from app.models.user import User
+from app.repositories.accesstoken import AccessTokenRepository
+from app.repositories.modelcache import ModelCache
+from app.repositories.unitofwork import AfterCommit, run_now
+from app.repositories.user import UserRepository
+
+
+class AuthenticationCache(ModelCache[User]):
+    '''
+    Process-wide cache of bearer token to user, sparing authenticated requests the token and user
+    lookups. Entries expire after 'time_to_live' seconds, or with their token if that's sooner,
+    and the least recently used are evicted once 'max_entries' is reached.
+
+    NOTE: deleting tokens and updating or deleting users through this process evicts the affected
+    entries immediately. Changes made by other processes take up to 'time_to_live' to be seen.
+    '''
+
+    def __init__(self, max_entries: int, time_to_live: int):
+        super().__init__(max_entries, time_to_live)
+        self.tokens_by_user_id: Dict[str, Set[str]] = {}
+
+
+    def get_user(self, token_id: str) -> Optional[User]:
+        '''
+        Returns the user the token authenticates, or None on a cache miss
+        '''
+        return self.lookup(token_id)
+
+
+    def put(self, token: AccessToken, user: User, generation: int) -> None:
+        '''
+        Caches the result of a lookup, unless an invalidation has occurred since 'generation' was
+        read from the cache before the lookup began
+        '''
+        self.insert(token.id, user, generation, expires_at=token.expires_at)
+
+
+    def invalidate_token(self, token_id: str) -> None:
+        self.invalidate(token_id)
+
+
+    def invalidate_user(self, user_id: str) -> None:
+        self.generation += 1
+        for token_id in list(self.tokens_by_user_id.get(user_id, ())):
+            self.remove(token_id)
+
+
+    def _on_add(self, token_id: str, user: Dict[str, Any]) -> None:
+        self.tokens_by_user_id.setdefault(user['id'], set()).add(token_id)
+
+
+    def _on_remove(self, token_id: str, user: Dict[str, Any]) -> None:
+        tokens = self.tokens_by_user_id[user['id']]
+        tokens.discard(token_id)
+        if not tokens:
+            del self.tokens_by_user_id[user['id']]
+
+
+
+class InvalidatingAccessTokenRepository(AccessTokenRepository):
+    '''
+    Decorates another AccessTokenRepository, evicting deleted tokens from an AuthenticationCache.
+    Tokens are evicted again once 'after_commit' reports the deletion has been committed, as
+    lookups made in between still find them.
+    '''
+
+    def __init__(self, repository: AccessTokenRepository, cache: AuthenticationCache, after_commit: AfterCommit = run_now):
+        self.repository = repository
+        self.cache = cache
+        self.after_commit = after_commit
+
+
+    def create_token(self, user_id: str) -> AccessToken:
+        '''
+        Creates and adds a new AccessToken instance to the repository
+        '''
+        return self.repository.create_token(user_id)
+
+
+    def get_token_by_id(self, id: str) -> Optional[AccessToken]:
+        '''
+        Retrieves an access token based on the specified ID
+        '''
+        return self.repository.get_token_by_id(id)
+
+
+    def delete_token_by_id(self, id: str) -> None:
+        '''
+        Deletes an access token
+        Raises: KeyError if the token cannot be found
+        '''
+        self.repository.delete_token_by_id(id)
+        self.cache.invalidate_token(id)
+        self.after_commit(lambda: self.cache.invalidate_token(id))
+
+
+    def delete_expired_tokens(self, now: datetime, limit: int) -> int:
+        '''
+        Deletes up to 'limit' tokens that expired before 'now', returning the number deleted.
+        Cached entries never outlive their token, so there's nothing to evict.
+        '''
+        return self.repository.delete_expired_tokens(now, limit)
+
+
+
+class InvalidatingUserRepository(UserRepository):
+    '''
+    Decorates another UserRepository, evicting the tokens of updated or deleted users from an
+    AuthenticationCache. As with tokens, they're evicted again once the change has been committed.
+    '''
+
+    def __init__(self, repository: UserRepository, cache: AuthenticationCache, after_commit: AfterCommit = run_now):
+        self.repository = repository
+        self.cache = cache
+        self.after_commit = after_commit
+
+
+    def create_user(self, username: str, email: str, pwhash: str, id: Optional[str] = None):
+        '''
+        Creates and adds a new User model instance to the repository
+        '''
+        return self.repository.create_user(username=username, email=email, pwhash=pwhash, id=id)
+
+
+    def get_num_users(self) -> int:
+        '''
+        Returns the number of users currently being stored in this repository
+        '''
+        return self.repository.get_num_users()
+
+
+    def get_user_by_id(self, id: str) -> Optional[User]:
+        '''
+        Retrieves a user account based on the specified ID
+        '''
+        return self.repository.get_user_by_id(id)
+
+
+    def get_user_by_email(self, email: str) -> Optional[User]:
+        '''
+        Retrieves a user account based on the specified email address
+        '''
+        return self.repository.get_user_by_email(email)
+
+
+    def get_user_by_username(self, username: str) -> Optional[User]:
+        '''
+        Retrieves a user account based on the specified username
+        '''
+        return self.repository.get_user_by_username(username)
+
+
+    def get_users_by_ids(self, ids: List[str]) -> List[User]:
+        '''
+        Retrieves the user accounts with the specified IDs, in no particular order
+        '''
+        return self.repository.get_users_by_ids(ids)
+
+
+    def get_users_by_usernames(self, usernames: List[str]) -> List[User]:
+        '''
+        Retrieves the user accounts with the specified usernames, in no particular order
+        '''
+        return self.repository.get_users_by_usernames(usernames)
+
+
+    def update_user(self, id: str, user: User) -> None:
+        '''
+        Updates a user's data in the repository
+        '''
+        self.repository.update_user(id, user)
+        self.cache.invalidate_user(id)
+        self.after_commit(lambda: self.cache.invalidate_user(id))
+
+
+    def delete_user_by_id(self, id: str) -> None:
+        '''
+        Deletes a user
+        Raises: KeyError if the user cannot be found
+        '''
+        self.repository.delete_user_by_id(id)
+        self.cache.invalidate_user(id)
+        self.after_commit(lambda: self.cache.invalidate_user(id))
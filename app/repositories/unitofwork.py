@@ -0,0 +1,80 @@
+
+from contextlib import contextmanager
+from sqlalchemy import Engine, event
+from sqlmodel import Session
+from typing import Callable, Iterator
+
+
+# Schedules a callback to run once the caller's writes have been committed
+AfterCommit = Callable[[Callable[[], None]], None]
+
+
+def run_now(callback: Callable[[], None]) -> None:
+    '''
+    The AfterCommit of code outside of a unit of work, where every write is committed as it's made
+    '''
+    callback()
+
+
+def begin_unit_of_work(session: Session) -> None:
+    '''
+    Marks the session as taking part in a unit of work: repositories using it only flush their
+    writes, leaving whoever owns the session to commit them all at once
+    '''
+    session.info['unit_of_work'] = True
+
+
+def end_unit_of_work(session: Session) -> None:
+    session.info.pop('unit_of_work', None)
+
+
+def in_unit_of_work(session: Session) -> bool:
+    return session.info.get('unit_of_work', False)
+
+
+def commit(session: Session) -> None:
+    '''
+    Commits a repository's writes, or within a unit of work only flushes them
+    '''
+    if in_unit_of_work(session):
+        session.flush()
+    else:
+        session.commit()
+
+
+@contextmanager
+def transaction(session: Session) -> Iterator[None]:
+    '''
+    Scope of a repository write that may fail, e.g. on a unique constraint. The write is committed
+    on success and rolled back on failure. Within a unit of work it's made within a savepoint
+    instead, so a failure only undoes this write rather than the whole unit.
+    '''
+    if in_unit_of_work(session):
+        with session.begin_nested():
+            yield
+        return
+
+    try:
+        yield
+        session.commit()
+    except:
+        session.rollback()
+        raise
+
+
+def enable_savepoints(engine: Engine) -> None:
+    '''
+    SQLite's Python driver only begins transactions ahead of writes, and never ahead of a
+    SAVEPOINT, so releasing a savepoint would commit everything written so far. Taking over
+    from the driver and beginning transactions ourselves lets savepoints nest as expected.
+    '''
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(connection, _):
+        connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def on_begin(connection):
+        connection.exec_driver_sql('BEGIN')
@@ -1,16 +1,18 @@
 
 from abc import ABC, abstractmethod
-from sqlmodel import select, func, Session
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import col, select, func, Session
 from typing import Optional, List
 
 from app.models.user import User
+from app.repositories.unitofwork import commit, transaction
 from shared.time import get_current_time
 
 
 class UserRepository(ABC):
 
     @abstractmethod
-    def create_user(self, id: str, username: str, email: str, pwhash: str):
+    def create_user(self, username: str, email: str, pwhash: str, id: Optional[str] = None):
         '''
         Creates and adds a new User model instance to the repository
         '''
@@ -49,6 +51,24 @@ class UserRepository(ABC):
         raise NotImplementedError()
 
 
+    @abstractmethod
+    def get_users_by_ids(self, ids: List[str]) -> List[User]:
+        '''
+        Retrieves the user accounts with the specified IDs, in no particular order. IDs that
+        cannot be found are left out.
+        '''
+        raise NotImplementedError()
+
+
+    @abstractmethod
+    def get_users_by_usernames(self, usernames: List[str]) -> List[User]:
+        '''
+        Retrieves the user accounts with the specified usernames, in no particular order.
+        Usernames that cannot be found are left out.
+        '''
+        raise NotImplementedError()
+
+
     @abstractmethod
     def update_user(self, id: str, user: User) -> None:
         '''
@@ -148,6 +168,22 @@ class InMemoryUserRepository(UserRepository):
         return self.get_user_by_id(id)
 
 
+    def get_users_by_ids(self, ids: List[str]) -> List[User]:
+        '''
+        Retrieves the user accounts with the specified IDs, in no particular order
+        '''
+        users = [self.get_user_by_id(x) for x in dict.fromkeys(ids)]
+        return [x for x in users if x is not None]
+
+
+    def get_users_by_usernames(self, usernames: List[str]) -> List[User]:
+        '''
+        Retrieves the user accounts with the specified usernames, in no particular order
+        '''
+        users = [self.get_user_by_username(x) for x in dict.fromkeys(usernames)]
+        return [x for x in users if x is not None]
+
+
     def update_user(self, id: str, user: User) -> None:
         '''
         Updates a user's data in the repository.
@@ -215,8 +251,11 @@ class DbUserRepository(UserRepository):
             deleted_at=None
         )
 
-        self.session.add(user)
-        self.session.commit()
+        try:
+            with transaction(self.session):
+                self.session.add(user)
+        except IntegrityError:
+            raise ValueError(f"User with username '{username}' or email address '{email}' already exists")
         return user
 
 
@@ -254,6 +293,24 @@ class DbUserRepository(UserRepository):
         return user if user is None else user[0]
 
 
+    def get_users_by_ids(self, ids: List[str]) -> List[User]:
+        '''
+        Retrieves the user accounts with the specified IDs, in no particular order
+        '''
+        if not ids:
+            return []
+        return list(self.session.execute(select(User).where(col(User.id).in_(set(ids)))).scalars())
+
+
+    def get_users_by_usernames(self, usernames: List[str]) -> List[User]:
+        '''
+        Retrieves the user accounts with the specified usernames, in no particular order
+        '''
+        if not usernames:
+            return []
+        return list(self.session.execute(select(User).where(col(User.username).in_(set(usernames)))).scalars())
+
+
     def update_user(self, id: str, user: User) -> None:
         '''
         Updates a user's data in the repository.
@@ -261,8 +318,17 @@ class DbUserRepository(UserRepository):
         - KeyError if the user cannot be found
         - ValueError if the 'id' field changes
         '''
-        self.session.add(user)
-        self.session.commit()
+        if user.id != id:
+            raise ValueError('Cannot change id')
+        if self.get_user_by_id(id) is None:
+            raise KeyError(f"User with id '{id}' cannot be found")
+
+        # Merged rather than added, the instance may have been detached (e.g. by a cache)
+        try:
+            with transaction(self.session):
+                self.session.merge(user)
+        except IntegrityError:
+            raise ValueError('Another user exists with that username or email address')
 
 
     def delete_user_by_id(self, id: str) -> None:
@@ -271,6 +337,8 @@ class DbUserRepository(UserRepository):
         Raises: KeyError if the user cannot be found
         '''
         user = self.get_user_by_id(id)
+        if user is None:
+            raise KeyError(f"User with id '{id}' cannot be found")
         self.session.delete(user)
-        self.session.commit()
+        commit(self.session)
 
@@ -0,0 +1,223 @@
+
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from app.models.user import User
+from app.repositories.modelcache import ModelCache
+from app.repositories.unitofwork import AfterCommit, run_now
+from app.repositories.user import UserRepository
+
+
+class UserCache(ModelCache[User]):
+    '''
+    Process-wide cache of users, indexed by ID, username and email address. Entries expire after
+    'time_to_live' seconds and the least recently used are evicted once 'max_entries' is reached.
+
+    NOTE: users written through this process are cached write-through and are always current.
+    Changes made by other processes take up to 'time_to_live' to be seen.
+    '''
+
+    def __init__(self, max_entries: int, time_to_live: int):
+        super().__init__(max_entries, time_to_live)
+        self.ids_by_username: Dict[str, str] = {}
+        self.ids_by_email: Dict[str, str] = {}
+
+
+    def get_user_by_id(self, id: Optional[str]) -> Optional[User]:
+        '''
+        Returns the user with the specified ID, or None on a cache miss
+        '''
+        return self.lookup(id)
+
+
+    def get_user_by_username(self, username: str) -> Optional[User]:
+        return self.lookup(self.ids_by_username.get(username, None))
+
+
+    def get_user_by_email(self, email: str) -> Optional[User]:
+        return self.lookup(self.ids_by_email.get(email, None))
+
+
+    def put(self, user: User, generation: int) -> None:
+        '''
+        Caches the result of a lookup, unless a write has occurred since 'generation' was read
+        from the cache before the lookup began
+        '''
+        if generation == self.generation:
+            self._add(user)
+
+
+    def store(self, user: User) -> None:
+        '''
+        Caches a user that has just been written
+        '''
+        self.generation += 1
+        self._add(user)
+
+
+    def _add(self, user: User) -> None:
+        # Deleted users are never returned by repositories, so they're not cached either
+        if user.deleted_at is not None:
+            self.remove(user.id)
+        else:
+            self.insert(user.id, user)
+
+
+    def _on_add(self, id: str, user: Dict[str, Any]) -> None:
+        self.ids_by_username[user['username']] = id
+        self.ids_by_email[user['email']] = id
+
+
+    def _on_remove(self, id: str, user: Dict[str, Any]) -> None:
+        if self.ids_by_username.get(user['username'], None) == id:
+            del self.ids_by_username[user['username']]
+        if self.ids_by_email.get(user['email'], None) == id:
+            del self.ids_by_email[user['email']]
+
+
+
+class CachedUserRepository(UserRepository):
+    '''
+    Decorates another UserRepository with a UserCache, written through by every change once
+    'after_commit' reports it's been committed. Cached users are returned as fresh, detached
+    instances.
+
+    Within a unit of work, users written through this repository are pending until the unit
+    commits. Lookups of pending users bypass the cache in both directions: they see this unit's
+    own changes, and those changes aren't cached before they're committed, as a rollback would
+    otherwise leave them behind.
+    '''
+
+    def __init__(self, repository: UserRepository, cache: UserCache, after_commit: AfterCommit = run_now):
+        self.repository = repository
+        self.cache = cache
+        self.after_commit = after_commit
+        self.pending_ids: Set[str] = set()
+
+
+    def create_user(self, username: str, email: str, pwhash: str, id: Optional[str] = None):
+        '''
+        Creates and adds a new User model instance to the repository
+        Raises a ValueError exception upon ID collision
+        '''
+        user = self.repository.create_user(username=username, email=email, pwhash=pwhash, id=id)
+        self.pending_ids.add(user.id)
+        self.after_commit(lambda: self._committed(user.id, user))
+        return user
+
+
+    def get_num_users(self) -> int:
+        '''
+        Returns the number of users currently being stored in this repository
+        '''
+        return self.repository.get_num_users()
+
+
+    def get_user_by_id(self, id: str) -> Optional[User]:
+        '''
+        Retrieves a user account based on the specified ID
+        '''
+        return self._get_one(id, self.cache.get_user_by_id, self.repository.get_user_by_id)
+
+
+    def get_user_by_email(self, email: str) -> Optional[User]:
+        '''
+        Retrieves a user account based on the specified email address
+        '''
+        return self._get_one(email, self.cache.get_user_by_email, self.repository.get_user_by_email)
+
+
+    def get_user_by_username(self, username: str) -> Optional[User]:
+        '''
+        Retrieves a user account based on the specified username
+        '''
+        return self._get_one(username, self.cache.get_user_by_username, self.repository.get_user_by_username)
+
+
+    def get_users_by_ids(self, ids: List[str]) -> List[User]:
+        '''
+        Retrieves the user accounts with the specified IDs, in no particular order. Those that
+        aren't cached are retrieved with a single lookup.
+        '''
+        return self._get_many(ids, self.cache.get_user_by_id, self.repository.get_users_by_ids)
+
+
+    def get_users_by_usernames(self, usernames: List[str]) -> List[User]:
+        '''
+        Retrieves the user accounts with the specified usernames, in no particular order. Those
+        that aren't cached are retrieved with a single lookup.
+        '''
+        return self._get_many(usernames, self.cache.get_user_by_username, self.repository.get_users_by_usernames)
+
+
+    def update_user(self, id: str, user: User) -> None:
+        '''
+        Updates a user's data in the repository.
+        Raises:
+        - KeyError if the user cannot be found
+        - ValueError if the 'id' field changes
+        '''
+        # Evicted straight away, so this process doesn't serve the old user while the change is pending
+        self.cache.invalidate(id)
+        self.repository.update_user(id, user)
+        self.pending_ids.add(id)
+        self.after_commit(lambda: self._committed(id, user))
+
+
+    def delete_user_by_id(self, id: str) -> None:
+        '''
+        Deletes a user
+        Raises: KeyError if the user cannot be found
+        '''
+        self.cache.invalidate(id)
+        self.repository.delete_user_by_id(id)
+        self.pending_ids.add(id)
+        self.after_commit(lambda: self._committed(id, None))
+
+
+    def _committed(self, id: str, user: Optional[User]) -> None:
+        self.pending_ids.discard(id)
+        if user is not None:
+            self.cache.store(user)
+        else:
+            self.cache.invalidate(id)
+
+
+    def _get_one(
+        self,
+        key: str,
+        get_cached: Callable[[str], Optional[User]],
+        get_stored: Callable[[str], Optional[User]]
+    ) -> Optional[User]:
+        user = get_cached(key)
+        if user is not None and user.id not in self.pending_ids:
+            return user
+
+        generation = self.cache.generation
+        user = get_stored(key)
+        if user is not None and user.id not in self.pending_ids:
+            self.cache.put(user, generation)
+        return user
+
+
+    def _get_many(
+        self,
+        keys: List[str],
+        get_cached: Callable[[str], Optional[User]],
+        get_stored: Callable[[List[str]], List[User]]
+    ) -> List[User]:
+        users, missing = [], []
+        for key in dict.fromkeys(keys):
+            user = get_cached(key)
+            if user is not None and user.id not in self.pending_ids:
+                users.append(user)
+            else:
+                missing.append(key)
+
+        if missing:
+            generation = self.cache.generation
+            stored = get_stored(missing)
+            for user in stored:
+                if user.id not in self.pending_ids:
+                    self.cache.put(user, generation)
+            users.extend(stored)
+        return users
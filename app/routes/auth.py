@@ -3,23 +3,36 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from typing import Annotated, Any
 
-from app.dependencies import get_engine, AppDependencyCollection
+from app.config import settings
+from app.dependencies import get_async_engine, AccessTokenDependency, AsyncAppDependencyCollection
 from app.dto.auth import LoginResponseDTO, RegisterRequestDTO
 from app.dto.user import PublicUserDTO
+from app.hashing import PasswordHashingBusyError
 from app.services.auth import AuthService
 
 router = APIRouter(prefix='/auth', tags=['auth'])
 
 
+def _service_unavailable() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="too many requests, try again shortly",
+        headers={'Retry-After': str(settings.PASSWORD_HASHING_RETRY_AFTER)}
+    )
+
+
 @router.post('/login', response_model=LoginResponseDTO)
 async def login(
-    app_engine: Annotated[AppDependencyCollection, Depends(get_engine)],
+    app_engine: Annotated[AsyncAppDependencyCollection, Depends(get_async_engine, scope='function')],
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()]
 ) -> Any:
-    token = AuthService(app_engine).login_user(
-        username=form_data.username,
-        password=form_data.password
-    )
+    try:
+        token = await AuthService(app_engine).login_user(
+            username=form_data.username,
+            password=form_data.password
+        )
+    except PasswordHashingBusyError:
+        raise _service_unavailable()
 
     if token is None:
         raise HTTPException(status.HTTP_403_FORBIDDEN, detail="invalid username or password")
@@ -31,18 +44,30 @@ async def login(
     )
 
 
+@router.post('/logout', status_code=status.HTTP_204_NO_CONTENT)
+async def logout(
+    app_engine: Annotated[AsyncAppDependencyCollection, Depends(get_async_engine, scope='function')],
+    token: AccessTokenDependency
+) -> None:
+    try:
+        await AuthService(app_engine).logout_user(token)
+    except KeyError:
+        raise HTTPException(status.HTTP_403_FORBIDDEN, detail="forbidden")
+
+
 @router.post('/register', response_model=PublicUserDTO)
 async def login(
-    app_engine: Annotated[AppDependencyCollection, Depends(get_engine)],
+    app_engine: Annotated[AsyncAppDependencyCollection, Depends(get_async_engine, scope='function')],
     form_data: RegisterRequestDTO
 ) -> Any:
     try:
-        user = AuthService(app_engine).register_new_user(
+        user = await AuthService(app_engine).register_new_user(
             username=form_data.username,
             email=form_data.email,
             password=form_data.password
         )
         return user
+    except PasswordHashingBusyError:
+        raise _service_unavailable()
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e.args[0]))
-
@@ -1,90 +1,294 @@
 
-from fastapi import APIRouter, Depends
-from typing import Any, Annotated, List
+import asyncio
+import hashlib
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
+from fastapi.responses import StreamingResponse
+from typing import Any, Annotated, AsyncIterator, Dict, List, Optional, cast
 
 router = APIRouter(prefix='/conversations', tags=['conversations'])
 
-from app.dependencies import get_engine, AppDependencyCollection, CurrentUserDependency
+from app.config import settings
+from app.dependencies import (
+    get_async_engine,
+    open_async_engine,
+    AsyncAppDependencyCollection,
+    CurrentUserDependency
+)
 from app.dto.conversation import (
     PublicConversationDTO,
     NewConversationRequestDTO,
     SendMessageDTO,
-    ConversationMessageDTO
+    BatchMessagesResponseDTO,
+    ConversationMessagePageDTO,
+    ConversationPageDTO,
+    ConversationPollDTO
 )
+from app.models.user import User
+from app.notifications import NotificationBus, Subscription
 from app.services.conversation import ConversationService
 
 
-@router.get('/')
+def _make_etag(bus: NotificationBus, *parts: Any) -> str:
+    '''
+    Derives an ETag from the versions (and request parameters) a response depends upon. The bus's
+    epoch is mixed in, so ETags issued before a restart are never mistaken for current ones.
+    '''
+    digest = hashlib.blake2b(repr((bus.epoch, *parts)).encode(), digest_size=12).hexdigest()
+    return f'"{digest}"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    candidates = [x.strip().removeprefix('W/') for x in if_none_match.split(',')]
+    return etag in candidates or '*' in candidates
+
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+
+
+@router.get('/', response_model=ConversationPageDTO)
 async def list_conversations(
-    app_engine: Annotated[AppDependencyCollection, Depends(get_engine)],
-    current_user: CurrentUserDependency
+    app_engine: Annotated[AsyncAppDependencyCollection, Depends(get_async_engine, scope='function')],
+    current_user: CurrentUserDependency,
+    http_response: Response,
+    cursor: Optional[str] = None,
+    limit: Annotated[int, Query(ge=1)] = settings.CONVERSATIONS_PAGE_DEFAULT_LIMIT,
+    if_none_match: Annotated[Optional[str], Header()] = None
 ) -> Any:
-    service = ConversationService(app_engine)
-    ids = app_engine.membership_repository.get_conversations_for_user(current_user.id)
-    conversations = [app_engine.conversation_repository.get_conversation_by_id(x) for x in ids]
-
-    response = {}
-    for conversation in conversations:
-        response[conversation.id] = {
-            'name': conversation.name,
-            'participants': service.get_conversation_member_names(conversation.id)
-        }
+    '''
+    The user's conversations along with a summary of their activity, most recently active first
+    '''
+    if settings.CONDITIONAL_GET_ENABLED:
+        bus = app_engine.notification_bus
+        etag = _make_etag(
+            bus, 'conversations', current_user.id, bus.get_conversation_list_version(current_user.id), cursor, limit
+        )
+        if _etag_matches(if_none_match, etag):
+            return _not_modified(etag)
+        http_response.headers['ETag'] = etag
+        http_response.headers['Cache-Control'] = 'private, no-cache'
 
-    return response
+    try:
+        return await app_engine.run_sync(
+            ConversationService(app_engine).list_conversations_for_user,
+            current_user,
+            cursor=cursor,
+            limit=limit
+        )
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="invalid cursor")
 
 
 @router.post('/', response_model=PublicConversationDTO)
 async def new_conversation(
-    app_engine: Annotated[AppDependencyCollection, Depends(get_engine)],
+    app_engine: Annotated[AsyncAppDependencyCollection, Depends(get_async_engine, scope='function')],
     current_user: CurrentUserDependency,
     body: NewConversationRequestDTO
 ) -> Any:
     service = ConversationService(app_engine)
-    conversation = service.start_new_conversation(
-        name=body.name,
-        users=body.participants
-    )
+    try:
+        conversation = await app_engine.run_sync(
+            service.start_new_conversation,
+            name=body.name,
+            users=body.participants
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e.args[0]))
 
     return PublicConversationDTO(
         name=conversation.name,
-        participants=service.get_conversation_member_names(conversation.id)
+        participants=await app_engine.run_sync(service.get_conversation_member_names, conversation.id)
     )
 
 
 
-@router.get('/{id}/messages')
+@router.post('/poll', response_model=ConversationPollDTO)
+async def poll_conversations(
+    app_engine: Annotated[AsyncAppDependencyCollection, Depends(get_async_engine, scope='function')],
+    current_user: CurrentUserDependency,
+    body: Dict[str, int]
+) -> Any:
+    '''
+    Retrieves new messages for several conversations at once. The body maps each conversation ID
+    to the newest message ID the client has seen in it (or 0 for none).
+    '''
+    if len(body) > settings.MESSAGES_POLL_MAX_CONVERSATIONS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f'polls are limited to {settings.MESSAGES_POLL_MAX_CONVERSATIONS} conversations'
+        )
+
+    return await app_engine.run_sync(ConversationService(app_engine).poll_conversations, current_user, body)
+
+
+@router.get('/{id}/messages', response_model=ConversationMessagePageDTO)
 async def get_messages_for_conversation(
-    app_engine: Annotated[AppDependencyCollection, Depends(get_engine)],
+    app_engine: Annotated[AsyncAppDependencyCollection, Depends(get_async_engine, scope='function')],
     current_user: CurrentUserDependency,
+    http_response: Response,
     id: str,
-    start: int = 0
-) -> List[ConversationMessageDTO]:
-    messages = ConversationService(app_engine).get_messages_for_conversation(id, start=start)
+    after: Optional[int] = None,
+    before: Optional[int] = None,
+    limit: Annotated[int, Query(ge=1)] = settings.MESSAGES_PAGE_DEFAULT_LIMIT,
+    wait: Annotated[float, Query(ge=0)] = 0,
+    start: Annotated[Optional[int], Query(deprecated=True)] = None,
+    if_none_match: Annotated[Optional[str], Header()] = None
+) -> Any:
+    # 'start' predates cursor pagination and is inclusive, so map it onto the equivalent cursor
+    if start is not None and after is None:
+        after = start - 1
+
+    # Long-polls park rather than answering 'nothing new', so they're never conditional. Versions
+    # are read before querying, so a response can only ever be newer than its ETag suggests.
+    if settings.CONDITIONAL_GET_ENABLED and wait == 0:
+        bus = app_engine.notification_bus
+        etag = _make_etag(
+            bus, 'messages', current_user.id, id, *bus.get_conversation_version(id), after, before, limit
+        )
+        if _etag_matches(if_none_match, etag):
+            return _not_modified(etag)
+        http_response.headers['ETag'] = etag
+        http_response.headers['Cache-Control'] = 'private, no-cache'
 
-    # NOTE: This is a greedy approach, only create the lookup table for usernames if there's new messages
-    # present. This reduces computational workload when clients are polling.
-    if messages:
-        # TODO : this can be sped up and simplified substantially with caching
-        participants = app_engine.membership_repository.get_users_for_conversation(id)
-        names = [app_engine.user_repository.get_user_by_id(x).username for x in participants]
-        participant_names = dict(zip(participants, names))
+    try:
+        # Long-polling only makes sense when reading forwards towards the newest messages
+        if wait > 0 and before is None:
+            return await ConversationService(app_engine).poll_messages_for_conversation(
+                id,
+                user=current_user,
+                after=after,
+                limit=limit,
+                wait=wait
+            )
 
-        return [ConversationMessageDTO(**x.model_dump(), sender=participant_names[x.sender_id]) for x in messages]
-    else:
-        return []
+        return await app_engine.run_sync(
+            ConversationService(app_engine).get_messages_for_conversation,
+            id,
+            user=current_user,
+            after=after,
+            before=before,
+            limit=limit
+        )
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="forbidden")
 
 
 @router.post('/{id}/messages')
 async def send_message_to_conversation(
-    app_engine: Annotated[AppDependencyCollection, Depends(get_engine)],
+    app_engine: Annotated[AsyncAppDependencyCollection, Depends(get_async_engine, scope='function')],
     current_user: CurrentUserDependency,
     id: str,
     body: SendMessageDTO
 ) -> Any:
-    message = ConversationService(app_engine).post_message_to_conversation(
-        id=id,
-        sender=current_user,
-        content=body.content
-    )
+    try:
+        message = await ConversationService(app_engine).post_message_to_conversation(
+            id=id,
+            sender=current_user,
+            content=body.content
+        )
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="forbidden")
+
     return message
 
+
+@router.post('/{id}/messages:batch', response_model=BatchMessagesResponseDTO)
+async def send_messages_to_conversation(
+    app_engine: Annotated[AsyncAppDependencyCollection, Depends(get_async_engine, scope='function')],
+    current_user: CurrentUserDependency,
+    id: str,
+    body: List[SendMessageDTO]
+) -> Any:
+    if len(body) > settings.MESSAGES_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f'batches are limited to {settings.MESSAGES_BATCH_MAX_SIZE} messages'
+        )
+
+    try:
+        messages = await app_engine.run_sync(
+            ConversationService(app_engine).post_messages_to_conversation,
+            id=id,
+            sender=current_user,
+            contents=[x.content for x in body]
+        )
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="forbidden")
+
+    return BatchMessagesResponseDTO(ids=[cast(int, x.id) for x in messages])
+
+
+@router.get('/{id}/stream')
+async def stream_conversation(
+    app_engine: Annotated[AsyncAppDependencyCollection, Depends(get_async_engine, scope='function')],
+    current_user: CurrentUserDependency,
+    id: str,
+    after: Optional[int] = None,
+    last_event_id: Annotated[Optional[int], Header()] = None
+) -> StreamingResponse:
+    '''
+    Server-Sent Events stream of the conversation's new messages. Each event's ID is the message ID,
+    so reconnecting clients (or those passing 'after') are first replayed the messages they missed.
+    '''
+    try:
+        await app_engine.run_sync(ConversationService(app_engine).check_membership, id, current_user)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="forbidden")
+
+    # Subscribe before replaying history so nothing posted in the meantime slips through the cracks
+    subscription = Subscription(max_queue_size=settings.STREAM_SUBSCRIBER_QUEUE_SIZE)
+    app_engine.notification_bus.subscribe(id, subscription)
+    await app_engine.run_sync(app_engine.release)
+
+    resume_from = last_event_id if last_event_id is not None else after
+    return StreamingResponse(
+        _stream_events(id, current_user, resume_from, app_engine.notification_bus, subscription),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+def _format_event(message_id: int, payload: str) -> str:
+    return f'id: {message_id}\nevent: message\ndata: {payload}\n\n'
+
+
+async def _stream_events(
+    id: str,
+    user: User,
+    resume_from: Optional[int],
+    bus: NotificationBus,
+    subscription: Subscription
+) -> AsyncIterator[str]:
+    try:
+        # Ask clients to back off for a few seconds before reconnecting
+        yield 'retry: 3000\n\n'
+
+        # Catch the client up on anything it missed while disconnected
+        replayed_until = resume_from
+        if resume_from is not None:
+            async with open_async_engine() as engine:
+                service = ConversationService(engine)
+                async for message in service.replay_messages_for_conversation(id, user, resume_from):
+                    replayed_until = message.id
+                    yield _format_event(message.id, message.model_dump_json())
+
+        # Then relay live messages until the client goes away or falls too far behind. Evicted
+        # clients are disconnected and are expected to reconnect using their Last-Event-ID.
+        while not subscription.evicted:
+            try:
+                async with asyncio.timeout(settings.STREAM_HEARTBEAT_INTERVAL):
+                    event = await subscription.queue.get()
+            except TimeoutError:
+                yield ': heartbeat\n\n'
+                continue
+
+            # Skip anything we've already sent during the replay
+            if replayed_until is not None and event.message_id <= replayed_until:
+                continue
+            yield _format_event(event.message_id, event.payload)
+
+    finally:
+        bus.unsubscribe_all(subscription)
@@ -0,0 +1,69 @@
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from typing import Any, Annotated, Optional
+
+from app.config import settings
+from app.dependencies import get_async_engine, AsyncAppDependencyCollection, CurrentUserDependency
+from app.dto.conversation import MessageSearchPageDTO
+from app.repositories.message import SearchCursor, parse_search_terms
+from app.services.conversation import ConversationService, decode_search_cursor
+
+router = APIRouter(tags=['search'])
+
+
+def _parse_search(q: str, cursor: Optional[str]) -> Optional[SearchCursor]:
+    '''
+    Validates a search request, returning its decoded cursor
+    '''
+    try:
+        parse_search_terms(q)
+        return decode_search_cursor(cursor) if cursor is not None else None
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e.args[0]))
+
+
+@router.get('/search', response_model=MessageSearchPageDTO)
+async def search_messages(
+    app_engine: Annotated[AsyncAppDependencyCollection, Depends(get_async_engine, scope='function')],
+    current_user: CurrentUserDependency,
+    q: str,
+    cursor: Optional[str] = None,
+    limit: Annotated[int, Query(ge=1)] = settings.SEARCH_PAGE_DEFAULT_LIMIT
+) -> Any:
+    '''
+    Searches the messages of every conversation the user belongs to
+    '''
+    after = _parse_search(q, cursor)
+    return await app_engine.run_sync(
+        ConversationService(app_engine).search_messages,
+        current_user,
+        q,
+        after=after,
+        limit=limit
+    )
+
+
+@router.get('/conversations/{id}/search', response_model=MessageSearchPageDTO)
+async def search_conversation(
+    app_engine: Annotated[AsyncAppDependencyCollection, Depends(get_async_engine, scope='function')],
+    current_user: CurrentUserDependency,
+    id: str,
+    q: str,
+    cursor: Optional[str] = None,
+    limit: Annotated[int, Query(ge=1)] = settings.SEARCH_PAGE_DEFAULT_LIMIT
+) -> Any:
+    '''
+    Searches the messages of a single conversation
+    '''
+    after = _parse_search(q, cursor)
+    try:
+        return await app_engine.run_sync(
+            ConversationService(app_engine).search_messages,
+            current_user,
+            q,
+            conversation_id=id,
+            after=after,
+            limit=limit
+        )
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="forbidden")
@@ -0,0 +1,29 @@
+from fastapi import APIRouter, HTTPException, status
+from typing import Any, Dict
+
+from app.config import settings
+from app.dependencies import (
+    authentication_cache,
+    message_cache,
+    password_hashing_pool,
+    user_cache,
+    CurrentUserDependency
+)
+
+router = APIRouter(prefix='/stats', tags=['stats'])
+
+
+@router.get('/')
+async def get_stats(current_user: CurrentUserDependency) -> Dict[str, Any]:
+    '''
+    Operational counters for this worker process
+    '''
+    if not settings.STATS_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="not found")
+
+    return {
+        'authentication_cache': authentication_cache.get_stats(),
+        'message_cache': message_cache.get_stats(),
+        'password_hashing': password_hashing_pool.get_stats(),
+        'user_cache': user_cache.get_stats()
+    }
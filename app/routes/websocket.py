@@ -0,0 +1,223 @@
+
+import asyncio
+import json
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect, status
+from pydantic import BaseModel, ValidationError
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Type
+
+from app.config import settings
+from app.dependencies import get_user_from_token, open_async_engine
+from app.dto.websocket import AuthFrameDTO, SendFrameDTO, SubscribeFrameDTO, UnsubscribeFrameDTO
+from app.models.user import User
+from app.notifications import NotificationBus, Subscription
+from app.services.conversation import ConversationService
+
+router = APIRouter(tags=['websocket'])
+
+
+@router.websocket('/ws')
+async def websocket_gateway(websocket: WebSocket) -> None:
+    '''
+    Bidirectional messaging gateway. A client authenticates once, either with an 'Authorization'
+    bearer header on the handshake or with an 'auth' frame, after which it may subscribe to any
+    number of its conversations and send messages to them over the same socket.
+    '''
+    await websocket.accept()
+
+    try:
+        authenticated = await _authenticate(websocket)
+        if authenticated is None:
+            return
+
+        user, bus = authenticated
+        await WebSocketConnection(websocket, user, bus).run()
+
+    except WebSocketDisconnect:
+        pass
+
+
+async def _authenticate(websocket: WebSocket) -> Optional[Tuple[User, NotificationBus]]:
+    '''
+    Resolves the user behind the connection's bearer token. The connection is closed and None
+    is returned if the client fails to present a valid token in time.
+    '''
+
+    scheme, _, token = websocket.headers.get('authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        try:
+            async with asyncio.timeout(settings.WEBSOCKET_AUTH_TIMEOUT):
+                frame = AuthFrameDTO.model_validate_json(await websocket.receive_text())
+            token = frame.token
+        except (TimeoutError, ValidationError):
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason='unauthenticated')
+            return None
+
+    # The user outlives the session for the life of the connection, its fields stay loaded as
+    # async sessions don't expire them on commit
+    async with open_async_engine() as engine:
+        try:
+            user = await engine.run_sync(get_user_from_token, engine, token)
+        except HTTPException as e:
+            reason = e.detail
+        else:
+            return user, engine.notification_bus
+
+    await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=reason)
+    return None
+
+
+
+class WebSocketConnection:
+    '''
+    A single authenticated websocket client. The connection's subscription collects messages for
+    every conversation the client follows; a relay task forwards them to the socket while the
+    main loop services the client's requests. Database work runs on the asyncio engine, so it
+    never blocks the event loop, and connections are only held while querying: never across
+    writes to the socket, which can stall on a slow client.
+    '''
+
+    def __init__(self, websocket: WebSocket, user: User, bus: NotificationBus):
+        self.websocket = websocket
+        self.user = user
+        self.bus = bus
+        self.subscription = Subscription(max_queue_size=settings.STREAM_SUBSCRIBER_QUEUE_SIZE)
+
+        # Serializes writes to the socket, so history being replayed to the client can't be
+        # interleaved with live messages for the same conversation
+        self.send_lock = asyncio.Lock()
+
+        # Newest message replayed per conversation, live messages at or below this were already sent
+        self.replayed_until: Dict[str, int] = {}
+
+
+    async def run(self) -> None:
+        await self.send_json({'type': 'ready', 'user': self.user.username})
+
+        tasks = [
+            asyncio.create_task(self.receive_frames()),
+            asyncio.create_task(self.relay_messages())
+        ]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.bus.unsubscribe_all(self.subscription)
+
+
+    async def receive_frames(self) -> None:
+        handlers: Dict[str, Tuple[Type[BaseModel], Callable[[Any], Awaitable[None]]]] = {
+            'subscribe': (SubscribeFrameDTO, self.subscribe),
+            'unsubscribe': (UnsubscribeFrameDTO, self.unsubscribe),
+            'send': (SendFrameDTO, self.send_message)
+        }
+
+        while True:
+            text = await self.websocket.receive_text()
+            try:
+                frame = json.loads(text)
+                dto_class, handler = handlers[frame['type']]
+                dto = dto_class.model_validate(frame)
+            except (ValueError, TypeError, KeyError):
+                await self.send_json({'type': 'error', 'detail': 'malformed frame'})
+                continue
+
+            await handler(dto)
+
+
+    async def relay_messages(self) -> None:
+        while not self.subscription.evicted:
+            event = await self.subscription.queue.get()
+            async with self.send_lock:
+                if event.message_id <= self.replayed_until.get(event.conversation_id, 0):
+                    continue
+
+                await self.websocket.send_text(_message_frame(event.conversation_id, event.payload))
+
+        # The client fell too far behind; it should reconnect and resume from its last message
+        await self.websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason='too slow')
+
+
+    async def subscribe(self, frame: SubscribeFrameDTO) -> None:
+        conversation_id = frame.conversation_id
+        if len(self.subscription.conversation_ids) >= settings.WEBSOCKET_MAX_SUBSCRIPTIONS:
+            await self.send_error(frame, 'too many subscriptions')
+            return
+
+        async with open_async_engine() as engine:
+            service = ConversationService(engine)
+            try:
+                await engine.run_sync(service.check_membership, conversation_id, self.user)
+                allowed = True
+            except ValueError:
+                allowed = False
+
+            # No connection is held across writes to the socket, the replay checks one out again
+            # for each page it reads
+            await engine.run_sync(engine.release)
+            if not allowed:
+                await self.send_error(frame, 'forbidden')
+                return
+
+            # Subscribe before replaying so messages posted during the replay are not lost,
+            # the send lock holds them back until the replay has finished
+            async with self.send_lock:
+                self.bus.subscribe(conversation_id, self.subscription)
+                await self.websocket.send_text(
+                    json.dumps({'type': 'subscribed', 'conversation_id': conversation_id})
+                )
+
+                if frame.after is not None:
+                    replay = service.replay_messages_for_conversation(conversation_id, self.user, frame.after)
+                    async for message in replay:
+                        await self.websocket.send_text(
+                            _message_frame(conversation_id, message.model_dump_json())
+                        )
+                        self.replayed_until[conversation_id] = message.id
+
+
+    async def unsubscribe(self, frame: UnsubscribeFrameDTO) -> None:
+        self.bus.unsubscribe(frame.conversation_id, self.subscription)
+        self.replayed_until.pop(frame.conversation_id, None)
+        await self.send_json({'type': 'unsubscribed', 'conversation_id': frame.conversation_id})
+
+
+    async def send_message(self, frame: SendFrameDTO) -> None:
+        try:
+            async with open_async_engine(settings.DB_UNIT_OF_WORK) as engine:
+                message = await ConversationService(engine).post_message_to_conversation(
+                    id=frame.conversation_id,
+                    sender=self.user,
+                    content=frame.content
+                )
+        except ValueError:
+            await self.send_error(frame, 'forbidden')
+            return
+
+        message_id = message.id
+
+        await self.send_json({
+            'type': 'ack',
+            'ref': frame.ref,
+            'conversation_id': frame.conversation_id,
+            'id': message_id
+        })
+
+
+    async def send_error(self, frame: BaseModel, detail: str) -> None:
+        await self.send_json({'type': 'error', 'ref': getattr(frame, 'ref', None), 'detail': detail})
+
+
+    async def send_json(self, data: Dict[str, Any]) -> None:
+        async with self.send_lock:
+            await self.websocket.send_text(json.dumps(data))
+
+
+def _message_frame(conversation_id: str, payload: str) -> str:
+    '''
+    Wraps a serialized ConversationMessageDTO in the websocket envelope. Payloads from the bus are
+    serialized once and shared by every subscriber, so they're spliced in rather than re-encoded.
+    '''
+    return f'{{"type":"message","conversation_id":{json.dumps(conversation_id)},"data":{payload}}}'
@@ -6,15 +6,17 @@ from app.dependencies import AppDependencyCollection
 from app.models.accesstoken import AccessToken
 from app.models.user import User
 
-from shared.password import hash_password, verify_password
-
 class AuthService:
+    '''
+    Password hashing is offloaded to the engine's password hasher, so these methods are async.
+    Logging in and registering raise PasswordHashingBusyError when the hasher is saturated.
+    '''
 
     def __init__(self, engine: AppDependencyCollection):
         self.engine = engine
 
 
-    def login_user(self, username: str, password: str) -> Optional[AccessToken]:
+    async def login_user(self, username: str, password: str) -> Optional[AccessToken]:
         '''
         Implements OAuth2's "resource-owner password grant" flow, allowing a user to provide their
         username and password in order to retrieve an access & refresh token pair.
@@ -24,20 +26,28 @@ class AuthService:
         '''
 
         # Retrieve the user account specified
-        user = self.engine.user_repository.get_user_by_username(username)
+        user = await self.engine.run_sync(self.engine.user_repository.get_user_by_username, username)
         if user is None:
             return None
 
         # Verify the provided password
-        if not verify_password(password, user.pwhash):
+        if not await self.engine.password_hasher.verify_password(password, user.pwhash):
             return None
 
         # If execution reaches here, the user has been authenticated! We can issue tokens
-        token = self.engine.token_repository.create_token(user.id)
+        token = await self.engine.run_sync(self.engine.token_repository.create_token, user.id)
         return token
 
 
-    def register_new_user(self, username: str, email: str, password: str) -> User:
+    async def logout_user(self, token: str) -> None:
+        '''
+        Revokes the specified access token
+        Raises KeyError if the token cannot be found
+        '''
+        await self.engine.run_sync(self.engine.token_repository.delete_token_by_id, token)
+
+
+    async def register_new_user(self, username: str, email: str, password: str) -> User:
         '''
         Creates a new user account
         '''
@@ -47,14 +57,13 @@ class AuthService:
         except EmailNotValidError as e:
             raise ValueError(f"'{email}' is not a valid email address: {str(e.args[0])}")
 
-        # TODO : check for duplicate user names
-
-        user = engine.user_repository.create_user(
+        pwhash = await self.engine.password_hasher.hash_password(password)
+        user = await self.engine.run_sync(
+            self.engine.user_repository.create_user,
             id=User.generate_id(),
             username=username,
             email=email,
-            pwhash=hash_password(password)
+            pwhash=pwhash
         )
 
         return user
-
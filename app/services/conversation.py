@@ -1,65 +1,448 @@
 
-from typing import Optional, List
+import math
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, Iterable, Optional, List, cast
 
+from app.config import settings
 from app.dependencies import AppDependencyCollection
+from app.dto.conversation import (
+    ConversationMessageDTO,
+    ConversationMessagePageDTO,
+    ConversationPageDTO,
+    ConversationPollDTO,
+    ConversationSummaryDTO,
+    MessageSearchHitDTO,
+    MessageSearchPageDTO
+)
 from app.models.conversation import Conversation
 from app.models.membership import Membership
 from app.models.message import Message
 from app.models.user import User
+from app.repositories.conversation import ActivityCursor
+from app.repositories.message import SearchCursor, advance_search_cursor
+
+
+def to_message_dto(message: Message, sender_name: str) -> ConversationMessageDTO:
+    '''
+    Converts a message into its public representation. Attributes are read individually rather
+    than via model_dump() as freshly committed instances have their attributes expired.
+    '''
+    return ConversationMessageDTO(
+        id=cast(int, message.id),
+        created_at=message.created_at,
+        sender=sender_name,
+        sender_id=message.sender_id,
+        content=message.content
+    )
+
+
+_CURSOR_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Shown as the sender of messages whose sender's account has since been deleted
+DELETED_USER_NAME = '[deleted]'
+
+def encode_activity_cursor(cursor: ActivityCursor) -> str:
+    '''
+    Encodes a position within a conversation list as an opaque string for clients
+    '''
+    activity, id = cursor
+    return f'{(activity - _CURSOR_EPOCH) // timedelta(microseconds=1)}:{id}'
+
+
+def decode_activity_cursor(cursor: str) -> ActivityCursor:
+    '''
+    Reverses encode_activity_cursor()
+    Raises ValueError if the cursor is malformed
+    '''
+    microseconds, separator, id = cursor.partition(':')
+    if not separator or not id:
+        raise ValueError('Malformed cursor')
+    try:
+        return _CURSOR_EPOCH + timedelta(microseconds=int(microseconds)), id
+    except (OverflowError, TypeError):
+        raise ValueError('Malformed cursor')
+
+
+def encode_search_cursor(cursor: SearchCursor) -> str:
+    '''
+    Encodes a position within search results as an opaque string for clients
+    '''
+    return ','.join(f'{source}:{rank!r}:{id}' for source, (rank, id) in sorted(cursor.items()))
+
+
+def decode_search_cursor(cursor: str) -> SearchCursor:
+    '''
+    Reverses encode_search_cursor()
+    Raises ValueError if the cursor is malformed
+    '''
+    decoded: SearchCursor = {}
+    for position in cursor.split(','):
+        parts = position.split(':')
+        if len(parts) != 3:
+            raise ValueError('Malformed cursor')
+        try:
+            source, rank, id = int(parts[0]), float(parts[1]), int(parts[2])
+        except ValueError:
+            raise ValueError('Malformed cursor')
+
+        # NaN and infinite ranks are meaningless, no hit can follow them in rank order
+        if not math.isfinite(rank):
+            raise ValueError('Malformed cursor')
+        decoded[source] = (rank, id)
+
+    return decoded
+
 
 
 class ConversationService:
+    '''
+    Synchronous methods access the database directly, so async callers should invoke them via
+    the engine's run_sync(). Async methods take care of this themselves.
+    '''
 
     def __init__(self, engine: AppDependencyCollection):
         self.engine = engine
 
 
-    def start_new_conversation(self, name: str, users: List[str]) -> Optional[Conversation]:
+    def start_new_conversation(self, name: str, users: List[str]) -> Conversation:
         '''
-        Creates a new conversation and adds the specified users to it
+        Creates a new conversation and adds the specified users to it, all in one transaction
         '''
 
-        # Gather and validate our user accounts
+        # Gather and validate our user accounts with a single lookup
+        # Duplicates are dropped as a user can only be a member of a conversation once
+        found = {x.username: x.id for x in self.engine.user_repository.get_users_by_usernames(users)}
         user_ids = []
-        for username in users:
-            user = self.engine.user_repository.get_user_by_username(username)
-            if not user:
+        for username in dict.fromkeys(users):
+            if username not in found:
                 raise ValueError(f"No user with name '{username}'")
-            user_ids.append(user.id)
+            user_ids.append(found[username])
 
-        # Create the new conversation
-        conversation = self.engine.conversation_repository.create_conversation(name)
-
-        # Add the specified users as members of this conversation
-        for user_id in user_ids:
-            self.engine.membership_repository.create_membership(conversation.id, user_id)
+        # Create the new conversation with the specified users as its members
+        conversation = self.engine.conversation_repository.create_conversation(name, user_ids=user_ids)
+        self.engine.after_commit(
+            lambda: self.engine.notification_bus.publish_membership_change(conversation.id, user_ids)
+        )
 
         # Finished
         return conversation
 
 
+    def list_conversations_for_user(
+        self,
+        user: User,
+        cursor: Optional[str] = None,
+        limit: int = settings.CONVERSATIONS_PAGE_DEFAULT_LIMIT
+    ) -> ConversationPageDTO:
+        '''
+        Retrieves a page of the user's conversations, most recently active first. Pages are bounded
+        by the server-side limit regardless of what the client requests.
+        Raises ValueError if the cursor is malformed
+        '''
+        before = decode_activity_cursor(cursor) if cursor is not None else None
+
+        # Fetch a single extra row so we can tell whether another page follows this one
+        limit = max(1, min(limit, settings.CONVERSATIONS_PAGE_MAX_LIMIT))
+        rows = self.engine.conversation_repository.list_conversations_with_participants(
+            user.id,
+            before=before,
+            limit=limit + 1
+        )
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        conversations = [
+            ConversationSummaryDTO(
+                id=conversation.id,
+                name=conversation.name,
+                participants=participants,
+                last_message_id=summary.last_message_id,
+                last_activity_at=summary.last_activity_at,
+                message_count=summary.message_count
+            )
+            for conversation, summary, participants in rows
+        ]
+
+        next_cursor = None
+        if has_more:
+            last = rows[-1][1]
+            next_cursor = encode_activity_cursor((last.last_activity_at, last.conversation_id))
+
+        return ConversationPageDTO(conversations=conversations, next_cursor=next_cursor, has_more=has_more)
+
+
     def get_conversation_member_names(self, id: str) -> List[str]:
         user_ids = self.engine.membership_repository.get_users_for_conversation(id)
-        return [self.engine.user_repository.get_user_by_id(x).username for x in user_ids]
+        names = self.get_usernames(user_ids)
+        return [names[x] for x in user_ids if x in names]
+
 
+    def get_usernames(self, user_ids: Iterable[str]) -> Dict[str, str]:
+        '''
+        Maps each of the specified user IDs to its username with a single lookup. Users that no
+        longer exist are mapped to a placeholder.
+        '''
+        user_ids = list(dict.fromkeys(user_ids))
+        names = dict.fromkeys(user_ids, DELETED_USER_NAME)
+        names.update({x.id: x.username for x in self.engine.user_repository.get_users_by_ids(user_ids)})
+        return names
 
-    def post_message_to_conversation(self, id: str, sender: User, content: str) -> Message:
 
-        # Check to ensure the sender is actually allowed in the conversation
-        members = self.engine.membership_repository.get_users_for_conversation(id)
-        if sender.id not in members:
+    def check_membership(self, id: str, user: User) -> List[str]:
+        '''
+        Returns the IDs of the conversation's participants, provided the specified user is one of them
+        Raises ValueError if the user is not a member of the conversation
+        '''
+        participants = self.engine.membership_repository.get_users_for_conversation(id)
+        if user.id not in participants:
             raise ValueError(f'{user.username} is not a member of this conversation')
 
-        # Otherwise, post the message
-        message = self.engine.message_repository.create_message(
-            conversation_id=id,
-            sender_id=sender.id,
-            content=content
-        )
+        return participants
+
+
+    async def post_message_to_conversation(self, id: str, sender: User, content: str) -> Message:
+
+        # Check to ensure the sender is actually allowed in the conversation
+        participants = await self.engine.run_sync(self.check_membership, id, sender)
+
+        # Otherwise, post the message. With group commit the message is queued alongside those
+        # of other requests, so release our connection rather than hold it while we wait. The
+        # writer also takes care of the conversation's summary.
+        if self.engine.message_writer is not None:
+            await self.engine.run_sync(self.engine.release)
+            message = await self.engine.message_writer.create_message(
+                conversation_id=id,
+                sender_id=sender.id,
+                content=content
+            )
+        else:
+            message = await self.engine.run_sync(self._create_message, id, sender, content)
+
+        # Wake up anyone waiting on this conversation, once the message can be read
+        dto = to_message_dto(message, sender.username)
+        self.engine.after_commit(lambda: self._publish(id, [dto], participants))
         return message
 
 
-    def get_messages_for_conversation(self, id: str, start: int = 0):
-        messages = self.engine.message_repository.get_messages_for_conversation(id, start)
+    def _create_message(self, id: str, sender: User, content: str) -> Message:
+        with self.engine.transaction():
+            message = self.engine.message_repository.create_message(
+                conversation_id=id,
+                sender_id=sender.id,
+                content=content
+            )
+            self.engine.conversation_repository.record_activity([message])
+        return message
+
+
+    def post_messages_to_conversation(self, id: str, sender: User, contents: List[str]) -> List[Message]:
+        '''
+        Posts a batch of messages to the conversation in a single transaction along with the
+        conversation's summary, checking the sender's membership once for the entire batch.
+        Where messages are sharded, the batch and the summary commit separately to their own
+        databases.
+        Raises ValueError if the sender is not a member of the conversation
+        '''
+
+        participants = self.check_membership(id, sender)
+        with self.engine.transaction():
+            messages = self.engine.message_repository.create_messages(
+                conversation_id=id,
+                sender_id=sender.id,
+                contents=contents
+            )
+            self.engine.conversation_repository.record_activity(messages)
+
+        dtos = [to_message_dto(x, sender.username) for x in messages]
+        self.engine.after_commit(lambda: self._publish(id, dtos, participants))
         return messages
 
+
+    def _publish(self, id: str, messages: List[ConversationMessageDTO], participants: List[str]) -> None:
+        for message in messages:
+            self.engine.notification_bus.publish_message(id, message)
+        self.engine.notification_bus.publish_activity(participants)
+
+
+    def get_messages_for_conversation(
+        self,
+        id: str,
+        user: User,
+        after: Optional[int] = None,
+        before: Optional[int] = None,
+        limit: int = settings.MESSAGES_PAGE_DEFAULT_LIMIT
+    ) -> ConversationMessagePageDTO:
+        '''
+        Retrieves a page of messages on behalf of the specified user. Pages are bounded by the
+        server-side limit regardless of what the client requests.
+        Raises ValueError if the user is not a member of the conversation
+        '''
+
+        self.check_membership(id, user)
+
+        # Fetch a single extra row so we can tell whether another page follows this one
+        limit = max(1, min(limit, settings.MESSAGES_PAGE_MAX_LIMIT))
+        messages = self.engine.message_repository.get_messages_for_conversation(
+            id,
+            after=after,
+            before=before,
+            limit=limit + 1
+        )
+
+        # The surplus row sits on the far side of the page relative to the direction we're reading
+        has_more = len(messages) > limit
+        if has_more:
+            messages = messages[1:] if before is not None else messages[:limit]
+
+        # The cursor continues in the direction of travel. Readers moving forwards always get a
+        # cursor back (even on an empty page) so they can keep polling from where they left off.
+        if before is not None:
+            next_cursor = messages[0].id if has_more else None
+        else:
+            next_cursor = messages[-1].id if messages else after
+
+        # Names are only looked up for the senders on this page, which includes former members.
+        # Empty pages (the common case for polling clients) need no lookup at all.
+        dtos = []
+        if messages:
+            sender_names = self.get_usernames(x.sender_id for x in messages)
+            dtos = [to_message_dto(x, sender_names[x.sender_id]) for x in messages]
+
+        return ConversationMessagePageDTO(messages=dtos, next_cursor=next_cursor, has_more=has_more)
+
+
+    def poll_conversations(self, user: User, cursors: Dict[str, int]) -> ConversationPollDTO:
+        '''
+        Retrieves the messages following each cursor for several of the user's conversations at once.
+        Conversations the user is not a member of are left out of the response. The total number
+        of messages is capped; if 'has_more' is set, polling again with the returned cursors
+        picks up where this response left off.
+        '''
+
+        # A single lookup authorizes every conversation in the request
+        member_of = set(self.engine.membership_repository.get_conversations_for_user(user.id))
+        cursors = {id: after for id, after in cursors.items() if id in member_of}
+
+        limit = settings.MESSAGES_POLL_MAX_TOTAL
+        messages = self.engine.message_repository.get_messages_for_conversations(cursors, limit=limit + 1)
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+
+        sender_names = self.get_usernames(x.sender_id for x in messages) if messages else {}
+
+        dtos: Dict[str, List[ConversationMessageDTO]] = {id: [] for id in cursors}
+        for message in messages:
+            dtos[message.conversation_id].append(to_message_dto(message, sender_names[message.sender_id]))
+
+        # The cap applies across conversations, so when it's hit any of them may have more to come
+        pages = {
+            id: ConversationMessagePageDTO(
+                messages=page,
+                next_cursor=page[-1].id if page else cursors[id],
+                has_more=has_more
+            )
+            for id, page in dtos.items()
+        }
+        return ConversationPollDTO(conversations=pages, has_more=has_more)
+
+
+    def search_messages(
+        self,
+        user: User,
+        query: str,
+        conversation_id: Optional[str] = None,
+        after: Optional[SearchCursor] = None,
+        limit: int = settings.SEARCH_PAGE_DEFAULT_LIMIT
+    ) -> MessageSearchPageDTO:
+        '''
+        Searches the user's messages, either within a single conversation or across every
+        conversation they belong to, most relevant first
+        Raises ValueError if the user is not a member of the specified conversation
+        '''
+        if conversation_id is not None:
+            self.check_membership(conversation_id, user)
+            conversation_ids = [conversation_id]
+        else:
+            conversation_ids = self.engine.membership_repository.get_conversations_for_user(user.id)
+
+        # Fetch a single extra row so we can tell whether another page follows this one
+        limit = max(1, min(limit, settings.SEARCH_PAGE_MAX_LIMIT))
+        hits = self.engine.message_repository.search_messages(conversation_ids, query, after=after, limit=limit + 1)
+        has_more = len(hits) > limit
+        hits = hits[:limit]
+
+        sender_names = self.get_usernames(x.message.sender_id for x in hits) if hits else {}
+
+        results = [
+            MessageSearchHitDTO(
+                conversation_id=x.message.conversation_id,
+                message=to_message_dto(x.message, sender_names[x.message.sender_id]),
+                snippet=x.snippet,
+                rank=x.rank
+            )
+            for x in hits
+        ]
+
+        next_cursor = encode_search_cursor(advance_search_cursor(after, hits)) if has_more else None
+        return MessageSearchPageDTO(results=results, next_cursor=next_cursor, has_more=has_more)
+
+
+    async def poll_messages_for_conversation(
+        self,
+        id: str,
+        user: User,
+        after: Optional[int] = None,
+        limit: int = settings.MESSAGES_PAGE_DEFAULT_LIMIT,
+        wait: float = 0
+    ) -> ConversationMessagePageDTO:
+        '''
+        Long-polling variant of get_messages_for_conversation: when there's nothing new to return,
+        the caller is parked for up to 'wait' seconds until a new message is posted.
+        Raises ValueError if the user is not a member of the conversation
+        '''
+
+        page = await self.engine.run_sync(self.get_messages_for_conversation, id, user, after=after, limit=limit)
+        wait = min(wait, settings.MESSAGES_LONG_POLL_MAX_WAIT)
+        if page.messages or wait <= 0:
+            return page
+
+        # Don't hold a pooled connection hostage while we're parked
+        await self.engine.run_sync(self.engine.release)
+
+        cursor = page.next_cursor if page.next_cursor is not None else 0
+        if await self.engine.notification_bus.wait_for_message(id, after=cursor, timeout=wait):
+            page = await self.engine.run_sync(self.get_messages_for_conversation, id, user, after=after, limit=limit)
+
+        return page
+
+
+    async def replay_messages_for_conversation(
+        self,
+        id: str,
+        user: User,
+        after: Optional[int] = None
+    ) -> AsyncIterator[ConversationMessageDTO]:
+        '''
+        Yields every message in the conversation following 'after', one page at a time. The
+        database connection is released between pages so slow consumers don't hold one hostage.
+        Raises ValueError if the user is not a member of the conversation
+        '''
+
+        cursor = after
+        while True:
+            page = await self.engine.run_sync(
+                self.get_messages_for_conversation,
+                id,
+                user,
+                after=cursor,
+                limit=settings.MESSAGES_PAGE_MAX_LIMIT
+            )
+            await self.engine.run_sync(self.engine.release)
+
+            for message in page.messages:
+                yield message
+
+            if not page.has_more:
+                return
+            cursor = page.next_cursor
@@ -0,0 +1,43 @@
+import asyncio
+import logging
+
+from app.dependencies import open_async_engine
+from shared.time import get_current_time
+
+
+logger = logging.getLogger(__name__)
+
+
+async def sweep_expired_tokens(batch_size: int, batch_pause: float) -> int:
+    '''
+    Deletes every expired access token, returning the number deleted. Tokens are deleted in
+    batches of 'batch_size', each its own short transaction, pausing 'batch_pause' seconds in
+    between so that other writers get hold of the database's write lock.
+    '''
+    total = 0
+    while True:
+        async with open_async_engine() as engine:
+            deleted = await engine.run_sync(
+                engine.token_repository.delete_expired_tokens,
+                get_current_time(),
+                batch_size
+            )
+
+        total += deleted
+        if deleted < batch_size:
+            return total
+        await asyncio.sleep(batch_pause)
+
+
+async def run_token_sweeper(interval: int, batch_size: int, batch_pause: float) -> None:
+    '''
+    Sweeps expired access tokens every 'interval' seconds, until cancelled
+    '''
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            deleted = await sweep_expired_tokens(batch_size, batch_pause)
+            if deleted:
+                logger.info('Deleted %d expired access tokens', deleted)
+        except Exception:
+            logger.exception('Unable to delete expired access tokens')
@@ -0,0 +1,77 @@
+import pytest
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import event, text
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Session, SQLModel, create_engine, select
+from typing import Iterator
+
+from app.models.accesstoken import AccessToken
+from app.repositories.accesstoken import DbAccessTokenRepository
+from main import upgrade_access_tokens
+from shared.time import get_current_time
+
+###################################################################################################
+#
+#   Fixtures
+#
+###################################################################################################
+
+
+@pytest.fixture(scope='function')
+def engine():
+    return create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+
+
+@pytest.fixture(scope='function')
+def session(engine) -> Iterator[Session]:
+    SQLModel.metadata.create_all(engine, tables=[SQLModel.metadata.tables['accesstoken']])
+    with Session(engine) as session:
+        yield session
+
+
+
+###################################################################################################
+#
+#   Tests
+#
+###################################################################################################
+
+def test_expired_tokens_are_deleted_in_batches(engine, session: Session):
+    repository = DbAccessTokenRepository(session)
+    live = repository.create_token('user')
+    for _ in range(3):
+        session.add(AccessToken.issue('user', created_at=get_current_time() - timedelta(hours=1), time_to_live=60))
+    session.commit()
+
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+    assert repository.delete_expired_tokens(get_current_time(), limit=2) == 2
+    assert repository.delete_expired_tokens(get_current_time(), limit=2) == 1
+    assert repository.delete_expired_tokens(get_current_time(), limit=2) == 0
+    assert session.execute(select(AccessToken.id)).scalars().all() == [live.id]
+
+    # Each batch is a single statement, bounded by the subquery's LIMIT
+    deletes = [x for x in statements if x.startswith('DELETE')]
+    assert len(deletes) == 3
+    assert all('LIMIT' in x for x in deletes)
+
+
+def test_upgrade_backfills_expiry(engine):
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                'CREATE TABLE accesstoken ('
+                'id VARCHAR PRIMARY KEY, user_id VARCHAR, created_at DATETIME, time_to_live INTEGER)'
+            )
+        )
+        connection.execute(
+            text("INSERT INTO accesstoken VALUES ('token', 'user', '2025-08-19 15:00:00.250000', 90)")
+        )
+
+    upgrade_access_tokens(engine)
+    upgrade_access_tokens(engine)
+
+    with Session(engine) as session:
+        token = session.get(AccessToken, 'token')
+    assert token.expires_at == datetime(2025, 8, 19, 15, 1, 30, 250000, tzinfo=timezone.utc)
@@ -0,0 +1,39 @@
+import pytest
+from datetime import timedelta
+
+from app.repositories.accesstoken import AccessTokenRepository, InMemoryAccessTokenRepository
+from shared.time import get_current_time
+
+###################################################################################################
+#
+#   Fixtures
+#
+###################################################################################################
+
+
+@pytest.fixture(scope='function')
+def repository() -> InMemoryAccessTokenRepository:
+    return InMemoryAccessTokenRepository()
+
+
+
+###################################################################################################
+#
+#   Tests
+#
+###################################################################################################
+
+def test_expiry_is_stored(repository: AccessTokenRepository):
+    token = repository.create_token('user')
+    assert token.expires_at == token.created_at + timedelta(seconds=token.time_to_live)
+
+
+def test_expired_tokens_are_deleted_in_batches(repository: InMemoryAccessTokenRepository):
+    live = repository.create_token('user')
+    for _ in range(3):
+        token = repository.create_token('user')
+        token.expires_at = token.created_at - timedelta(seconds=1)
+
+    assert repository.delete_expired_tokens(get_current_time(), limit=2) == 2
+    assert repository.delete_expired_tokens(get_current_time(), limit=2) == 1
+    assert list(repository.tokens) == [live.id]
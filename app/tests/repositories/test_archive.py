@@ -0,0 +1,107 @@
+import pytest
+from datetime import timedelta
+from sqlalchemy import text
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Session, SQLModel, create_engine
+from typing import Iterator
+
+from app.repositories import archive
+from app.repositories.archive import ArchivedMessageRepository
+from app.repositories.message import DbMessageRepository, advance_search_cursor
+from shared.time import get_current_time
+
+###################################################################################################
+#
+#   Fixtures
+#
+###################################################################################################
+
+
+@pytest.fixture(scope='module')
+def test_conversation_id() -> str:
+    return 'testconversation'
+
+
+@pytest.fixture(scope='function')
+def session() -> Iterator[Session]:
+    engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+@pytest.fixture(scope='function')
+def repository(session: Session, test_conversation_id: str, tmp_path) -> ArchivedMessageRepository:
+    hot = DbMessageRepository(session)
+    old = get_current_time() - timedelta(days=365)
+    for x in range(10):
+        hot.create_message(test_conversation_id, 'sender', f'old message {x}', created_at=old)
+        hot.create_message('otherconversation', 'sender', f'other message {x}', created_at=old)
+    hot.create_message(test_conversation_id, 'sender', 'new message')
+
+    return ArchivedMessageRepository(hot, session, str(tmp_path))
+
+
+
+###################################################################################################
+#
+#   Tests
+#
+###################################################################################################
+
+def test_search_covers_archived_messages(repository: ArchivedMessageRepository, test_conversation_id: str):
+    cutoff = get_current_time() - timedelta(days=1)
+    for id, up_to_id in repository.repository.find_messages_created_before(cutoff).items():
+        repository.archive_conversation(id, up_to_id, max_segment_messages=4, batch_size=3)
+
+    hits = repository.search_messages([test_conversation_id], 'message', limit=6)
+    assert len(hits) == 6
+    assert all(x.message.conversation_id == test_conversation_id for x in hits)
+
+    rest = repository.search_messages([test_conversation_id], 'message', after=advance_search_cursor(None, hits))
+    contents = sorted(x.message.content for x in hits + rest)
+    assert contents == sorted([f'old message {x}' for x in range(10)] + ['new message'])
+
+    hits = repository.search_messages([test_conversation_id], 'old 7')
+    assert [x.snippet for x in hits] == ['<mark>old</mark> message <mark>7</mark>']
+
+
+def test_search_matches_messages_not_segments(repository: ArchivedMessageRepository):
+    cutoff = get_current_time() - timedelta(days=1)
+    contents = ['caf\u00e9 opens', 'closes late', 'cafe closes']
+    repository.repository.create_messages('mixedconversation', 'sender', contents, created_at=cutoff - timedelta(days=1))
+    for id, up_to_id in repository.repository.find_messages_created_before(cutoff).items():
+        repository.archive_conversation(id, up_to_id, max_segment_messages=10, batch_size=10)
+
+    # The segment holds both terms, but only one of its messages does
+    hits = repository.search_messages(['mixedconversation'], 'cafe closes')
+    assert [x.message.content for x in hits] == ['cafe closes']
+
+    # Diacritics are ignored, as by the index
+    hits = repository.search_messages(['mixedconversation'], 'caf\u00e9')
+    assert [x.message.content for x in hits] == ['caf\u00e9 opens', 'cafe closes']
+
+
+def test_dropped_segments_leave_search(
+    repository: ArchivedMessageRepository,
+    test_conversation_id: str,
+    monkeypatch: pytest.MonkeyPatch
+):
+    cutoff = get_current_time() - timedelta(days=1)
+    for id, up_to_id in repository.repository.find_messages_created_before(cutoff).items():
+        repository.archive_conversation(id, up_to_id, max_segment_messages=4, batch_size=3)
+
+    # Dropping segments never reads them back
+    with monkeypatch.context() as patch:
+        patch.setattr(archive, 'SegmentReader', None)
+        assert repository.drop_segments(cutoff) == 20
+
+    assert repository.search_messages([test_conversation_id], 'old') == []
+    assert repository.search_messages(['otherconversation'], 'other') == []
+    assert [x.message.content for x in repository.search_messages([test_conversation_id], 'message')] == ['new message']
+
+    # Their index entries are left behind until the index is rebuilt
+    query = "SELECT rowid FROM archived_segment_fts WHERE archived_segment_fts MATCH 'old'"
+    assert len(repository.session.execute(text(query)).all()) == 3
+    assert repository.rebuild_search_index() == 0
+    assert repository.session.execute(text(query)).all() == []
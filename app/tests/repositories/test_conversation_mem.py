@@ -0,0 +1,93 @@
+import pytest
+from datetime import datetime, timedelta, timezone
+
+from app.models.message import Message
+from app.repositories.conversation import ConversationRepository, InMemoryConversationRepository
+from app.repositories.membership import InMemoryMembershipRepository
+from app.repositories.user import InMemoryUserRepository
+
+###################################################################################################
+#
+#   Fixtures
+#
+###################################################################################################
+
+
+@pytest.fixture(scope='module')
+def start_time() -> datetime:
+    return datetime(2025, 8, 19, 15, 0, 0, tzinfo=timezone.utc)
+
+
+@pytest.fixture(scope='function')
+def populated_repository(start_time: datetime) -> ConversationRepository:
+    '''
+    Three conversations created a minute apart: 'a', then 'b', then 'c'
+    '''
+    repo = InMemoryConversationRepository(InMemoryMembershipRepository(), InMemoryUserRepository())
+    for x, id in enumerate(['a', 'b', 'c']):
+        repo.create_conversation(id, id=id, created_at=start_time + timedelta(minutes=x))
+    return repo
+
+
+
+###################################################################################################
+#
+#   Tests
+#
+###################################################################################################
+
+def test_recent_conversations_by_creation(populated_repository: ConversationRepository):
+    rows = populated_repository.get_recent_conversations(['a', 'b', 'c'])
+    assert [x.id for x, _ in rows] == ['c', 'b', 'a']
+    assert all(summary.message_count == 0 for _, summary in rows)
+
+
+def test_record_activity(populated_repository: ConversationRepository, start_time: datetime):
+    populated_repository.record_activity([
+        Message(id=7, conversation_id='a', sender_id='s', content='x', created_at=start_time + timedelta(hours=1)),
+        Message(id=8, conversation_id='a', sender_id='s', content='y', created_at=start_time + timedelta(hours=1))
+    ])
+
+    rows = populated_repository.get_recent_conversations(['a', 'b', 'c'])
+    assert [x.id for x, _ in rows] == ['a', 'c', 'b']
+    assert rows[0][1].last_message_id == 8
+    assert rows[0][1].message_count == 2
+
+
+def test_recent_conversations_paging(populated_repository: ConversationRepository):
+    first = populated_repository.get_recent_conversations(['a', 'b', 'c'], limit=2)
+    last = first[-1][1]
+
+    rest = populated_repository.get_recent_conversations(
+        ['a', 'b', 'c'],
+        before=(last.last_activity_at, last.conversation_id)
+    )
+    assert [x.id for x, _ in first + rest] == ['c', 'b', 'a']
+
+
+def test_conversations_with_participants(populated_repository: InMemoryConversationRepository):
+    users = populated_repository.user_repository
+    memberships = populated_repository.membership_repository
+    alice = users.create_user(username='alice', email='alice@example.com', pwhash='')
+    bob = users.create_user(username='bob', email='bob@example.com', pwhash='')
+    for id in ['a', 'c']:
+        memberships.create_membership(id, alice.id)
+    memberships.create_membership('c', bob.id)
+
+    rows = populated_repository.list_conversations_with_participants(alice.id)
+    assert [(x.id, names) for x, _, names in rows] == [('c', ['alice', 'bob']), ('a', ['alice'])]
+
+    rows = populated_repository.list_conversations_with_participants(alice.id, limit=1)
+    assert [x.id for x, _, _ in rows] == ['c']
+
+    users.delete_user_by_id(bob.id)
+    rows = populated_repository.list_conversations_with_participants(alice.id, limit=1)
+    assert [names for _, _, names in rows] == [['alice']]
+
+
+def test_create_conversation_with_members(populated_repository: InMemoryConversationRepository):
+    conversation = populated_repository.create_conversation('d', id='d', user_ids=['x', 'y', 'x'])
+    assert populated_repository.membership_repository.get_users_for_conversation(conversation.id) == ['x', 'y']
+
+    with pytest.raises(ValueError):
+        populated_repository.create_conversation('again', id='d', user_ids=['z'])
@@ -0,0 +1,228 @@
+import asyncio
+import pytest
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Session, SQLModel, create_engine, select
+from typing import Dict, List, Union
+
+from app.models.conversation import ConversationSummary
+from app.models.message import Message
+from app.repositories.groupcommit import GroupCommitMessageWriter
+from app.repositories.message import get_shard_index
+from app.repositories.messagecache import MessageTailCache
+from shared.time import get_current_time
+
+###################################################################################################
+#
+#   Fixtures
+#
+###################################################################################################
+
+
+def make_session_factory() -> sessionmaker:
+    engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    return sessionmaker(engine, class_=Session)
+
+
+class RecordingWriter(GroupCommitMessageWriter):
+    '''
+    Records the batches handed to the worker thread
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batches: List[List[str]] = []
+
+    def _commit(self, messages: List[Message]) -> List[Union[Message, Exception]]:
+        self.batches.append([x.content for x in messages])
+        return super()._commit(messages)
+
+
+class FailingSessionFactory:
+    '''
+    Stands in for a shard that is down, failing the first 'failures' transactions opened on it
+    '''
+
+    def __init__(self, session_factory: sessionmaker, failures: int):
+        self.session_factory = session_factory
+        self.failures = failures
+
+    def __call__(self) -> Session:
+        if self.failures > 0:
+            self.failures -= 1
+            raise RuntimeError('shard unavailable')
+        return self.session_factory()
+
+
+class RecordingCache(MessageTailCache):
+    '''
+    Records every message written through to the cache, whether or not a tail holds it
+    '''
+
+    def __init__(self):
+        super().__init__(max_entries_per_conversation=50, max_bytes=1024 * 1024)
+        self.appended: List[Message] = []
+
+    def append_messages(self, conversation_id: str, messages: List[Message]) -> None:
+        self.appended.extend(messages)
+        super().append_messages(conversation_id, messages)
+
+
+@pytest.fixture(scope='module')
+def shard_conversation_ids() -> List[str]:
+    '''
+    One conversation per shard, for a pair of shards
+    '''
+    ids: Dict[int, str] = {}
+    for x in range(100):
+        ids.setdefault(get_shard_index(f'conversation {x}', 2), f'conversation {x}')
+    return [ids[0], ids[1]]
+
+
+@pytest.fixture(scope='function')
+def summary_session_factory(shard_conversation_ids: List[str]) -> sessionmaker:
+    factory = make_session_factory()
+    with factory() as session:
+        for id in shard_conversation_ids:
+            session.add(ConversationSummary(conversation_id=id, last_activity_at=get_current_time()))
+        session.commit()
+    return factory
+
+
+def get_summaries(session_factory: sessionmaker) -> Dict[str, ConversationSummary]:
+    with session_factory() as session:
+        return {x.conversation_id: x for x in session.exec(select(ConversationSummary)).all()}
+
+
+def get_contents(session_factory: sessionmaker) -> List[str]:
+    with session_factory() as session:
+        return [x.content for x in session.exec(select(Message).order_by(Message.id)).all()]   # type: ignore
+
+
+
+###################################################################################################
+#
+#   Tests
+#
+###################################################################################################
+
+def test_concurrent_posts_share_a_batch(shard_conversation_ids: List[str]):
+    shard = make_session_factory()
+    writer = RecordingWriter([shard], max_batch_size=10, max_delay=0.05)
+    conversation_id = shard_conversation_ids[0]
+
+    async def scenario():
+        return await asyncio.gather(*(
+            writer.create_message(conversation_id, 'sender', f'message {x}') for x in range(5)
+        ))
+
+    messages = asyncio.run(scenario())
+    assert writer.batches == [[f'message {x}' for x in range(5)]]
+    assert [x.content for x in messages] == [f'message {x}' for x in range(5)]
+    assert len({x.id for x in messages}) == 5
+    assert get_contents(shard) == [f'message {x}' for x in range(5)]
+
+
+def test_full_batches_are_split(shard_conversation_ids: List[str]):
+    shard = make_session_factory()
+    writer = RecordingWriter([shard], max_batch_size=2, max_delay=0.05)
+    conversation_id = shard_conversation_ids[0]
+
+    async def scenario():
+        return await asyncio.gather(*(
+            writer.create_message(conversation_id, 'sender', f'message {x}') for x in range(5)
+        ))
+
+    asyncio.run(scenario())
+    assert writer.batches == [['message 0', 'message 1'], ['message 2', 'message 3'], ['message 4']]
+    assert get_contents(shard) == [f'message {x}' for x in range(5)]
+
+
+def test_failed_batch_only_fails_its_own_callers(shard_conversation_ids: List[str]):
+    shard = make_session_factory()
+    writer = RecordingWriter([FailingSessionFactory(shard, failures=1)], max_batch_size=2, max_delay=0.05)   # type: ignore
+    conversation_id = shard_conversation_ids[0]
+
+    async def scenario():
+        return await asyncio.gather(*(
+            writer.create_message(conversation_id, 'sender', f'message {x}') for x in range(4)
+        ), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert len(writer.batches) == 2
+    assert [isinstance(x, RuntimeError) for x in results] == [True, True, False, False]
+    assert get_contents(shard) == ['message 2', 'message 3']
+
+
+def test_failed_shard_does_not_fail_the_others(shard_conversation_ids: List[str], summary_session_factory: sessionmaker):
+    shards = [make_session_factory(), make_session_factory()]
+    writer = RecordingWriter(
+        [shards[0], FailingSessionFactory(shards[1], failures=1)],   # type: ignore
+        max_batch_size=10,
+        max_delay=0.05,
+        summary_session_factory=summary_session_factory
+    )
+    healthy, failing = shard_conversation_ids
+
+    async def scenario():
+        return await asyncio.gather(
+            writer.create_message(healthy, 'sender', 'healthy 0'),
+            writer.create_message(failing, 'sender', 'failing 0'),
+            writer.create_message(healthy, 'sender', 'healthy 1'),
+            return_exceptions=True
+        )
+
+    results = asyncio.run(scenario())
+    assert len(writer.batches) == 1
+    assert isinstance(results[1], RuntimeError)
+    assert [x.content for x in results if isinstance(x, Message)] == ['healthy 0', 'healthy 1']
+    assert get_contents(shards[0]) == ['healthy 0', 'healthy 1']
+    assert get_contents(shards[1]) == []
+
+    summaries = get_summaries(summary_session_factory)
+    assert summaries[healthy].message_count == 2
+    assert summaries[failing].message_count == 0
+    assert summaries[failing].last_message_id is None
+
+
+def test_committed_messages_are_cached_and_summarized_once(shard_conversation_ids: List[str], summary_session_factory: sessionmaker):
+    shards = [make_session_factory(), make_session_factory()]
+    cache = RecordingCache()
+    writer = RecordingWriter(
+        [shards[0], FailingSessionFactory(shards[1], failures=1)],   # type: ignore
+        max_batch_size=3,
+        max_delay=0.05,
+        summary_session_factory=summary_session_factory,
+        cache=cache
+    )
+
+    # Both conversations start out empty, with complete (empty) tails
+    for id in shard_conversation_ids:
+        cache.populate(id, None, [], cache.get_generation(id))
+
+    async def scenario():
+        return await asyncio.gather(*(
+            writer.create_message(shard_conversation_ids[x % 2], 'sender', f'message {x}') for x in range(8)
+        ), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert len(writer.batches) == 3
+
+    # Only the first batch's messages to the failing shard are lost
+    committed = [x for x in results if isinstance(x, Message)]
+    assert len(committed) == 7
+    assert isinstance(results[1], RuntimeError)
+
+    assert sorted(x.content for x in cache.appended) == sorted(x.content for x in committed)
+
+    summaries = get_summaries(summary_session_factory)
+    for id in shard_conversation_ids:
+        expected = [x for x in committed if x.conversation_id == id]
+
+        cached = cache.get_messages(id)
+        assert cached is not None
+        assert [x.id for x in cached] == [x.id for x in expected]
+
+        assert summaries[id].message_count == len(expected)
+        assert summaries[id].last_message_id == expected[-1].id
@@ -0,0 +1,136 @@
+
+import pytest
+from datetime import datetime, timezone
+from typing import cast
+
+from app.repositories.message import MessageRepository, InMemoryMessageRepository, advance_search_cursor, to_fts_query
+
+###################################################################################################
+#
+#   Fixtures
+#
+###################################################################################################
+
+
+@pytest.fixture(scope='module')
+def test_conversation_id() -> str:
+    return 'testconversation'
+
+
+@pytest.fixture(scope='function')
+def empty_repository() -> MessageRepository:
+    return InMemoryMessageRepository()
+
+
+@pytest.fixture(scope='function')
+def populated_repository(test_conversation_id: str) -> MessageRepository:
+    '''
+    Ten messages in the test conversation, interleaved with messages from another conversation
+    so that the test conversation's IDs are not contiguous
+    '''
+    repo = InMemoryMessageRepository()
+    for x in range(10):
+        repo.create_message(test_conversation_id, 'sender', f'message {x}')
+        repo.create_message('otherconversation', 'sender', f'other {x}')
+    return repo
+
+
+
+###################################################################################################
+#
+#   Tests
+#
+###################################################################################################
+
+def test_create_message(empty_repository: MessageRepository, test_conversation_id: str):
+    created_at = datetime(2025, 8, 19, 15, 0, 0, 123456, tzinfo=timezone.utc)
+    message = empty_repository.create_message(test_conversation_id, 'sender', 'hello', created_at)
+
+    retrieved = empty_repository.get_messages_for_conversation(test_conversation_id)
+    assert len(retrieved) == 1
+    assert retrieved[0].id == message.id
+    assert retrieved[0].content == 'hello'
+    assert retrieved[0].created_at == created_at
+
+
+def test_create_messages(empty_repository: MessageRepository, test_conversation_id: str):
+    messages = empty_repository.create_messages(test_conversation_id, 'sender', ['a', 'b', 'c'])
+    assert [x.content for x in messages] == ['a', 'b', 'c']
+    assert [x.id for x in messages] == sorted(cast(int, x.id) for x in messages)
+
+
+def test_get_messages_for_unknown_conversation(populated_repository: MessageRepository):
+    assert populated_repository.get_messages_for_conversation('nosuchconversation') == []
+
+
+def test_get_messages_after(populated_repository: MessageRepository, test_conversation_id: str):
+    everything = populated_repository.get_messages_for_conversation(test_conversation_id)
+    assert len(everything) == 10
+
+    page = populated_repository.get_messages_for_conversation(
+        test_conversation_id,
+        after=everything[3].id,
+        limit=2
+    )
+    assert [x.content for x in page] == ['message 4', 'message 5']
+
+
+def test_get_messages_before(populated_repository: MessageRepository, test_conversation_id: str):
+    everything = populated_repository.get_messages_for_conversation(test_conversation_id)
+
+    page = populated_repository.get_messages_for_conversation(
+        test_conversation_id,
+        before=everything[5].id,
+        limit=2
+    )
+    assert [x.content for x in page] == ['message 3', 'message 4']
+
+
+def test_get_messages_between(populated_repository: MessageRepository, test_conversation_id: str):
+    everything = populated_repository.get_messages_for_conversation(test_conversation_id)
+
+    page = populated_repository.get_messages_for_conversation(
+        test_conversation_id,
+        after=everything[1].id,
+        before=everything[4].id
+    )
+    assert [x.content for x in page] == ['message 2', 'message 3']
+
+
+def test_get_messages_for_conversations(populated_repository: MessageRepository, test_conversation_id: str):
+    ours = populated_repository.get_messages_for_conversation(test_conversation_id)
+    theirs = populated_repository.get_messages_for_conversation('otherconversation')
+
+    messages = populated_repository.get_messages_for_conversations(
+        {test_conversation_id: cast(int, ours[7].id), 'otherconversation': cast(int, theirs[7].id)},
+        limit=3
+    )
+    assert [x.content for x in messages] == ['message 8', 'other 8', 'message 9']
+
+
+def test_search_messages(populated_repository: MessageRepository, test_conversation_id: str):
+    populated_repository.create_message(test_conversation_id, 'sender', 'message message')
+
+    hits = populated_repository.search_messages([test_conversation_id], 'MESSAGE', limit=2)
+    assert [x.message.content for x in hits] == ['message message', 'message 0']
+    assert hits[0].snippet == '<mark>message</mark> <mark>message</mark>'
+
+    rest = populated_repository.search_messages(
+        [test_conversation_id],
+        'mess*',
+        after=advance_search_cursor(None, hits)
+    )
+    assert [x.message.content for x in rest] == [f'message {x}' for x in range(1, 10)]
+
+
+def test_search_snippet_is_escaped(empty_repository: MessageRepository, test_conversation_id: str):
+    empty_repository.create_message(test_conversation_id, 'sender', 'hello world <mark>0</mark> & <b>')
+
+    hits = empty_repository.search_messages([test_conversation_id], 'hello')
+    assert hits[0].snippet == '<mark>hello</mark> world &lt;mark&gt;0&lt;/mark&gt; &amp; &lt;b&gt;'
+
+
+def test_fts_query_is_quoted():
+    assert to_fts_query('quick OR "brown fox*') == '"quick" "or" "brown" "fox"*'
+    with pytest.raises(ValueError):
+        to_fts_query('!?')
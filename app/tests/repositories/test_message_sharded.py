@@ -0,0 +1,138 @@
+import pytest
+import zlib
+from sqlalchemy import Engine
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Session, SQLModel, create_engine, select
+from typing import Dict, List, Optional, Tuple, cast
+
+from app.models.message import Message
+from app.repositories.message import SearchCursor, ShardedMessageRepository, advance_search_cursor, get_shard_index
+
+###################################################################################################
+#
+#   Fixtures
+#
+###################################################################################################
+
+
+@pytest.fixture(scope='function')
+def shard_engines() -> List[Engine]:
+    engines = []
+    for _ in range(3):
+        engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+        SQLModel.metadata.create_all(engine)
+        engines.append(engine)
+    return engines
+
+
+def make_repository(engines: List[Engine]) -> ShardedMessageRepository:
+    return ShardedMessageRepository(lambda x: Session(engines[x]), len(engines))
+
+
+def get_conversation_ids_by_shard(engine: Engine) -> Dict[str, List[int]]:
+    with Session(engine) as session:
+        found: Dict[str, List[int]] = {}
+        for message in session.exec(select(Message).order_by(Message.id)).all():   # type: ignore
+            found.setdefault(message.conversation_id, []).append(cast(int, message.id))
+        return found
+
+
+def find_conversation_id(shard: int, num_shards: int) -> str:
+    return next(f'conversation {x}' for x in range(1000) if get_shard_index(f'conversation {x}', num_shards) == shard)
+
+
+
+###################################################################################################
+#
+#   Tests
+#
+###################################################################################################
+
+def test_shards_are_chosen_by_crc32():
+    # Placement must agree between processes and releases, so it's pinned to crc32
+    assert zlib.crc32(b'testconversation') == 2337091497
+    assert get_shard_index('testconversation', 3) == 2337091497 % 3
+    assert get_shard_index('testconversation', 1) == 0
+    assert all(get_shard_index(f'conversation {x}', 3) == zlib.crc32(f'conversation {x}'.encode()) % 3 for x in range(50))
+
+
+def test_messages_are_stored_on_their_shard(shard_engines: List[Engine]):
+    repository = make_repository(shard_engines)
+    for shard in range(3):
+        repository.create_message(find_conversation_id(shard, 3), 'sender', f'message {shard}')
+
+    for shard, engine in enumerate(shard_engines):
+        assert list(get_conversation_ids_by_shard(engine)) == [find_conversation_id(shard, 3)]
+
+
+def test_interrupted_move_resumes(shard_engines: List[Engine], monkeypatch: pytest.MonkeyPatch):
+    source = make_repository(shard_engines[:1])
+    conversation_id = find_conversation_id(2, 3)
+    ids = [x.id for x in source.create_messages(conversation_id, 'sender', [f'message {x}' for x in range(5)])]
+
+    # The move fails after committing its second batch to the target...
+    repository = make_repository(shard_engines)
+    target_session = repository.get_shard(2).session
+    commit = target_session.commit
+    commits: List[bool] = []
+
+    def failing_commit():
+        if len(commits) == 2:
+            raise RuntimeError('connection lost')
+        commit()
+        commits.append(True)
+
+    monkeypatch.setattr(target_session, 'commit', failing_commit)
+    with pytest.raises(RuntimeError):
+        repository.move_conversation(conversation_id, 0, 2, batch_size=2)
+    target_session.rollback()
+
+    # ...leaving the source untouched and the copied messages on the target
+    assert get_conversation_ids_by_shard(shard_engines[0]) == {conversation_id: ids}
+    assert get_conversation_ids_by_shard(shard_engines[2]) == {conversation_id: ids[:4]}
+
+    # Running it again only copies what's left, and keeps every message's ID
+    repository = make_repository(shard_engines)
+    assert repository.move_conversation(conversation_id, 0, 2, batch_size=2) == 5
+    assert get_conversation_ids_by_shard(shard_engines[0]) == {}
+    assert get_conversation_ids_by_shard(shard_engines[2]) == {conversation_id: ids}
+
+
+def test_move_refuses_to_overwrite_ids(shard_engines: List[Engine]):
+    moving = find_conversation_id(2, 3)
+    staying = 'staying'
+
+    source = make_repository(shard_engines[:1])
+    source.create_message(moving, 'sender', 'moving')
+
+    # The target has already allocated the same ID to a message of its own
+    with Session(shard_engines[2]) as session:
+        session.add(Message(id=1, conversation_id=staying, sender_id='sender', content='staying'))
+        session.commit()
+
+    repository = make_repository(shard_engines)
+    with pytest.raises(ValueError):
+        repository.move_conversation(moving, 0, 2, batch_size=10)
+
+    assert get_conversation_ids_by_shard(shard_engines[0]) == {moving: [1]}
+    assert get_conversation_ids_by_shard(shard_engines[2]) == {staying: [1]}
+
+
+def test_search_pages_resume_each_shard(shard_engines: List[Engine]):
+    # Both shards allocate IDs from 1 and hold identical messages, so their hits tie on (rank, ID)
+    repository = make_repository(shard_engines[:2])
+    conversation_ids = [find_conversation_id(0, 2), find_conversation_id(1, 2)]
+    for id in conversation_ids:
+        repository.create_messages(id, 'sender', [f'message {x}' for x in range(3)])
+
+    seen: List[Tuple[str, int]] = []
+    after: Optional[SearchCursor] = None
+    while True:
+        hits = repository.search_messages(conversation_ids, 'message', after=after, limit=1)
+        if not hits:
+            break
+        seen.extend((x.message.conversation_id, cast(int, x.message.id)) for x in hits)
+        after = advance_search_cursor(after, hits)
+
+    assert sorted(seen) == sorted((id, x) for id in conversation_ids for x in range(1, 4))
+    assert after is not None and sorted(after) == [0, 1]
@@ -0,0 +1,114 @@
+import pytest
+from typing import List, Optional
+
+from app.models.message import Message
+from app.repositories.message import InMemoryMessageRepository
+from app.repositories.messagecache import CachedMessageRepository, MessageTailCache
+
+###################################################################################################
+#
+#   Fixtures
+#
+###################################################################################################
+
+
+@pytest.fixture(scope='module')
+def test_conversation_id() -> str:
+    return 'testconversation'
+
+
+@pytest.fixture(scope='function')
+def backing_repository(test_conversation_id: str) -> InMemoryMessageRepository:
+    repo = InMemoryMessageRepository()
+    for x in range(10):
+        repo.create_message(test_conversation_id, 'sender', f'message {x}')
+    return repo
+
+
+@pytest.fixture(scope='function')
+def cache() -> MessageTailCache:
+    return MessageTailCache(max_entries_per_conversation=5, max_bytes=1024 * 1024)
+
+
+@pytest.fixture(scope='function')
+def cached_repository(backing_repository: InMemoryMessageRepository, cache: MessageTailCache) -> CachedMessageRepository:
+    return CachedMessageRepository(backing_repository, cache)
+
+
+
+###################################################################################################
+#
+#   Tests
+#
+###################################################################################################
+
+def test_miss_then_hit(cached_repository: CachedMessageRepository, cache: MessageTailCache, test_conversation_id: str):
+    everything = cached_repository.get_messages_for_conversation(test_conversation_id, limit=50)
+    assert cache.get_stats()['misses'] == 1
+
+    page = cached_repository.get_messages_for_conversation(test_conversation_id, after=everything[7].id, limit=50)
+    assert [x.content for x in page] == ['message 8', 'message 9']
+    assert cache.get_stats()['hits'] == 1
+
+
+def test_reads_below_ring_miss(cached_repository: CachedMessageRepository, cache: MessageTailCache, test_conversation_id: str):
+    everything = cached_repository.get_messages_for_conversation(test_conversation_id, limit=50)
+
+    # Only the newest five messages are held, so older reads go to the backing repository
+    page = cached_repository.get_messages_for_conversation(test_conversation_id, after=everything[2].id, limit=50)
+    assert [x.content for x in page] == [f'message {x}' for x in range(3, 10)]
+    assert cache.get_stats()['hits'] == 0
+
+    # ...unless the cache alone can fill a backwards page
+    page = cached_repository.get_messages_for_conversation(test_conversation_id, before=everything[9].id, limit=3)
+    assert [x.content for x in page] == ['message 6', 'message 7', 'message 8']
+    assert cache.get_stats()['hits'] == 1
+
+
+def test_write_through(cached_repository: CachedMessageRepository, cache: MessageTailCache, test_conversation_id: str):
+    everything = cached_repository.get_messages_for_conversation(test_conversation_id, limit=50)
+
+    cached_repository.create_messages(test_conversation_id, 'sender', ['new 0', 'new 1'])
+    page = cached_repository.get_messages_for_conversation(test_conversation_id, after=everything[-1].id, limit=50)
+    assert [x.content for x in page] == ['new 0', 'new 1']
+    assert cache.get_stats()['hits'] == 1
+
+
+def test_lru_eviction(backing_repository: InMemoryMessageRepository, test_conversation_id: str):
+    cache = MessageTailCache(max_entries_per_conversation=5, max_bytes=1200)
+    repo = CachedMessageRepository(backing_repository, cache)
+    repo.create_message('other', 'sender', 'other message')
+
+    repo.get_messages_for_conversation('other')
+    repo.get_messages_for_conversation(test_conversation_id)
+    assert cache.get_stats()['evictions'] == 1
+    assert list(cache.tails) == [test_conversation_id]
+
+
+def test_reads_racing_a_commit_are_not_cached(cache: MessageTailCache, test_conversation_id: str):
+    class RacingRepository(InMemoryMessageRepository):
+        def get_messages_for_conversation(
+            self,
+            id: str,
+            after: Optional[int] = None,
+            before: Optional[int] = None,
+            limit: Optional[int] = None
+        ) -> List[Message]:
+            messages = super().get_messages_for_conversation(id, after=after, before=before, limit=limit)
+
+            # Another request commits a message after the read has taken its snapshot
+            if not racing:
+                racing.append(repo.create_message(id, 'sender', 'racing message'))
+            return messages
+
+    racing: List[Message] = []
+    repo = CachedMessageRepository(RacingRepository(), cache)
+    repo.repository.create_message(test_conversation_id, 'sender', 'message')
+
+    assert [x.content for x in repo.get_messages_for_conversation(test_conversation_id)] == ['message']
+    assert cache.tails == {}
+
+    page = repo.get_messages_for_conversation(test_conversation_id)
+    assert [x.content for x in page] == ['message', 'racing message']
+    assert [x.content for x in repo.get_messages_for_conversation(test_conversation_id)] == ['message', 'racing message']
+    assert cache.get_stats()['hits'] == 1
@@ -0,0 +1,67 @@
+import pytest
+from datetime import timedelta
+from typing import List
+
+from app.models.user import User
+from app.repositories.modelcache import ModelCache
+from shared.time import get_current_time
+
+###################################################################################################
+#
+#   Fixtures
+#
+###################################################################################################
+
+
+@pytest.fixture(scope='function')
+def cache() -> ModelCache[User]:
+    return ModelCache[User](max_entries=2, time_to_live=60)
+
+
+@pytest.fixture(scope='function')
+def users() -> List[User]:
+    return [User(id=x, username=x, email=f'{x}@example.com', pwhash='') for x in 'abc']
+
+
+
+###################################################################################################
+#
+#   Tests
+#
+###################################################################################################
+
+def test_hits_are_fresh_copies(cache: ModelCache[User], users: List[User]):
+    cache.insert('a', users[0])
+
+    user = cache.lookup('a')
+    assert user is not None
+    user.username = 'changed'
+
+    user = cache.lookup('a')
+    assert user is not None and user.username == 'a'
+    assert cache.lookup('b') is None
+    assert cache.get_stats()['hit_ratio'] == 2 / 3
+
+
+def test_lru_eviction(cache: ModelCache[User], users: List[User]):
+    for user in users[:2]:
+        cache.insert(user.id, user)
+    cache.lookup('a')
+    cache.insert('c', users[2])
+
+    assert cache.get_stats()['evictions'] == 1
+    assert list(cache.entries) == ['a', 'c']
+
+
+def test_expiry(cache: ModelCache[User], users: List[User]):
+    cache.insert('a', users[0], expires_at=get_current_time() - timedelta(seconds=1))
+    assert cache.lookup('a') is None
+    assert cache.entries == {}
+
+
+def test_lookups_racing_an_invalidation_are_not_cached(cache: ModelCache[User], users: List[User]):
+    generation = cache.generation
+    cache.invalidate('a')
+
+    cache.insert('a', users[0], generation)
+    assert cache.lookup('a') is None
@@ -0,0 +1,82 @@
+import pytest
+
+from app.repositories.accesstoken import InMemoryAccessTokenRepository
+from app.repositories.signedtoken import (
+    SignedAccessTokenRepository,
+    SignedTokenClaims,
+    TokenRevocationList,
+    TokenSigner
+)
+
+###################################################################################################
+#
+#   Fixtures
+#
+###################################################################################################
+
+
+@pytest.fixture(scope='function')
+def signer() -> TokenSigner:
+    return TokenSigner('test secret')
+
+
+@pytest.fixture(scope='function')
+def opaque_repository() -> InMemoryAccessTokenRepository:
+    return InMemoryAccessTokenRepository()
+
+
+@pytest.fixture(scope='function')
+def repository(signer: TokenSigner, opaque_repository: InMemoryAccessTokenRepository) -> SignedAccessTokenRepository:
+    return SignedAccessTokenRepository(opaque_repository, signer, TokenRevocationList(sync_interval=10), None)
+
+
+
+###################################################################################################
+#
+#   Tests
+#
+###################################################################################################
+
+def test_sign_and_verify(signer: TokenSigner):
+    claims = SignedTokenClaims(user_id='user', issued_at=1000, time_to_live=60, jti='abc')
+    token = signer.sign(claims)
+
+    assert signer.verify(token) == claims
+    assert signer.verify(token[:-2] + 'xx') is None
+    assert TokenSigner('another secret').verify(token) is None
+    assert signer.verify('not.a.token') is None
+
+
+def test_requires_a_secret():
+    with pytest.raises(ValueError):
+        TokenSigner(None)
+
+
+def test_tokens_round_trip(repository: SignedAccessTokenRepository):
+    token = repository.create_token('user')
+
+    found = repository.get_token_by_id(token.id)
+    assert found is not None
+    assert found.user_id == 'user'
+    assert found.expires_at == token.expires_at
+
+
+def test_revocation(repository: SignedAccessTokenRepository):
+    token = repository.create_token('user')
+    repository.delete_token_by_id(token.id)
+
+    assert repository.get_token_by_id(token.id) is None
+    with pytest.raises(KeyError):
+        repository.delete_token_by_id(token.id)
+
+
+def test_opaque_tokens_are_passed_through(
+    repository: SignedAccessTokenRepository,
+    opaque_repository: InMemoryAccessTokenRepository
+):
+    token = opaque_repository.create_token('user')
+    found = repository.get_token_by_id(token.id)
+    assert found is not None and found.user_id == 'user'
+
+    repository.delete_token_by_id(token.id)
+    assert repository.get_token_by_id(token.id) is None
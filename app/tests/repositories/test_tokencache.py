@@ -0,0 +1,96 @@
+import pytest
+from datetime import timedelta
+
+from app.models.accesstoken import AccessToken
+from app.models.user import User
+from app.repositories.accesstoken import InMemoryAccessTokenRepository
+from app.repositories.tokencache import (
+    AuthenticationCache,
+    InvalidatingAccessTokenRepository,
+    InvalidatingUserRepository
+)
+from app.repositories.user import InMemoryUserRepository
+from shared.time import get_current_time
+
+###################################################################################################
+#
+#   Fixtures
+#
+###################################################################################################
+
+
+@pytest.fixture(scope='function')
+def cache() -> AuthenticationCache:
+    return AuthenticationCache(max_entries=2, time_to_live=60)
+
+
+@pytest.fixture(scope='function')
+def user_repository(cache: AuthenticationCache) -> InvalidatingUserRepository:
+    return InvalidatingUserRepository(InMemoryUserRepository(), cache)
+
+
+@pytest.fixture(scope='function')
+def token_repository(cache: AuthenticationCache) -> InvalidatingAccessTokenRepository:
+    return InvalidatingAccessTokenRepository(InMemoryAccessTokenRepository(), cache)
+
+
+@pytest.fixture(scope='function')
+def user(user_repository: InvalidatingUserRepository) -> User:
+    return user_repository.create_user(username='alice', email='alice@example.com', pwhash='')
+
+
+
+###################################################################################################
+#
+#   Tests
+#
+###################################################################################################
+
+def test_hit_and_miss(cache: AuthenticationCache, token_repository: InvalidatingAccessTokenRepository, user: User):
+    token = token_repository.create_token(user.id)
+    assert cache.get_user(token.id) is None
+
+    cache.put(token, user, cache.generation)
+    cached = cache.get_user(token.id)
+    assert cached is not None and cached.username == 'alice'
+    assert cache.get_stats()['hit_ratio'] == 0.5
+
+
+def test_entries_expire_with_their_token(cache: AuthenticationCache, user: User):
+    token = AccessToken.issue(user.id, created_at=get_current_time() - timedelta(seconds=10), time_to_live=5)
+
+    cache.put(token, user, cache.generation)
+    assert cache.get_user(token.id) is None
+
+
+def test_invalidation(
+    cache: AuthenticationCache,
+    token_repository: InvalidatingAccessTokenRepository,
+    user_repository: InvalidatingUserRepository,
+    user: User
+):
+    first = token_repository.create_token(user.id)
+    second = token_repository.create_token(user.id)
+    cache.put(first, user, cache.generation)
+    cache.put(second, user, cache.generation)
+
+    token_repository.delete_token_by_id(first.id)
+    assert cache.get_user(first.id) is None
+    assert cache.get_user(second.id) is not None
+
+    user_repository.delete_user_by_id(user.id)
+    assert cache.get_user(second.id) is None
+    assert cache.tokens_by_user_id == {}
+
+
+def test_lookups_racing_an_invalidation_are_not_cached(
+    cache: AuthenticationCache,
+    token_repository: InvalidatingAccessTokenRepository,
+    user: User
+):
+    token = token_repository.create_token(user.id)
+    generation = cache.generation
+
+    token_repository.delete_token_by_id(token.id)
+    cache.put(token, user, generation)
+    assert cache.get_user(token.id) is None
@@ -0,0 +1,57 @@
+import pytest
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Session, SQLModel, create_engine, select
+from typing import Iterator
+
+from app.models.user import User
+from app.repositories.unitofwork import begin_unit_of_work, enable_savepoints
+from app.repositories.user import DbUserRepository
+
+###################################################################################################
+#
+#   Fixtures
+#
+###################################################################################################
+
+
+@pytest.fixture(scope='function')
+def engine():
+    engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+    enable_savepoints(engine)
+    SQLModel.metadata.create_all(engine, tables=[SQLModel.metadata.tables['user']])
+    return engine
+
+
+@pytest.fixture(scope='function')
+def session(engine) -> Iterator[Session]:
+    session = Session(engine)
+    begin_unit_of_work(session)
+    yield session
+    session.close()
+
+
+
+###################################################################################################
+#
+#   Tests
+#
+###################################################################################################
+
+def test_writes_wait_for_the_commit(session: Session):
+    repository = DbUserRepository(session)
+    repository.create_user(username='alice', email='alice@example.com', pwhash='')
+
+    session.rollback()
+    assert session.execute(select(User)).first() is None
+
+
+def test_failed_writes_only_undo_themselves(engine, session: Session):
+    repository = DbUserRepository(session)
+    repository.create_user(username='alice', email='alice@example.com', pwhash='')
+    with pytest.raises(ValueError):
+        repository.create_user(username='alice', email='alice@example.org', pwhash='')
+    repository.create_user(username='bob', email='bob@example.com', pwhash='')
+    session.commit()
+
+    with Session(engine) as other:
+        assert sorted(x.username for x in other.execute(select(User)).scalars()) == ['alice', 'bob']
@@ -103,6 +103,12 @@ def test_get_user_by_bad_username(populated_repository: UserRepository, test_use
     assert retrieved is None
 
 
+def test_get_users_in_bulk(populated_repository: UserRepository, test_user_id: str, test_user_name: str):
+    assert [x.id for x in populated_repository.get_users_by_ids([test_user_id, 'missing', test_user_id])] == [test_user_id]
+    assert [x.id for x in populated_repository.get_users_by_usernames([test_user_name, 'missing'])] == [test_user_id]
+    assert populated_repository.get_users_by_ids([]) == []
+
+
 def test_update_user(populated_repository: UserRepository, test_user_id: str):
     user = populated_repository.get_user_by_id(test_user_id)
     user.pwhash = 'yetanotherhash'
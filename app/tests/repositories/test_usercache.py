@@ -0,0 +1,92 @@
+import pytest
+from typing import Callable, List
+
+from app.models.user import User
+from app.repositories.user import InMemoryUserRepository
+from app.repositories.usercache import CachedUserRepository, UserCache
+
+###################################################################################################
+#
+#   Fixtures
+#
+###################################################################################################
+
+
+@pytest.fixture(scope='function')
+def cache() -> UserCache:
+    return UserCache(max_entries=2, time_to_live=60)
+
+
+@pytest.fixture(scope='function')
+def repository(cache: UserCache) -> CachedUserRepository:
+    return CachedUserRepository(InMemoryUserRepository(), cache)
+
+
+
+###################################################################################################
+#
+#   Tests
+#
+###################################################################################################
+
+def test_lookups_are_cached_by_every_index(cache: UserCache, repository: CachedUserRepository):
+    user = repository.create_user(username='alice', email='alice@example.com', pwhash='')
+
+    found = [
+        repository.get_user_by_id(user.id),
+        repository.get_user_by_username('alice'),
+        repository.get_user_by_email('alice@example.com')
+    ]
+    assert [x.id if x is not None else None for x in found] == [user.id] * 3
+    assert repository.get_user_by_username('bob') is None
+    assert cache.get_stats()['hits'] == 3
+    assert cache.get_stats()['misses'] == 1
+
+
+def test_bulk_lookups_only_fetch_misses(cache: UserCache, repository: CachedUserRepository):
+    alice = repository.create_user(username='alice', email='alice@example.com', pwhash='')
+    bob = repository.repository.create_user(username='bob', email='bob@example.com', pwhash='')
+
+    users = repository.get_users_by_ids([alice.id, bob.id, 'missing'])
+    assert sorted(x.username for x in users) == ['alice', 'bob']
+    assert cache.get_stats()['hits'] == 1
+    assert bob.id in cache.entries
+
+
+def test_writes_are_written_through(cache: UserCache, repository: CachedUserRepository):
+    user = repository.create_user(username='alice', email='alice@example.com', pwhash='')
+
+    user = User(**{**user.model_dump(), 'email': 'alice@example.org'})
+    repository.update_user(user.id, user)
+    assert repository.get_user_by_email('alice@example.org') is not None
+    assert cache.get_user_by_email('alice@example.com') is None
+
+    repository.delete_user_by_id(user.id)
+    assert repository.get_user_by_id(user.id) is None
+    assert cache.entries == {}
+
+
+def test_evicted_users_leave_the_indexes(cache: UserCache, repository: CachedUserRepository):
+    for x in 'abc':
+        repository.create_user(username=x, email=f'{x}@example.com', pwhash='')
+
+    assert sorted(cache.ids_by_username) == ['b', 'c']
+    assert sorted(cache.ids_by_email) == ['b@example.com', 'c@example.com']
+
+
+def test_uncommitted_users_are_not_cached(cache: UserCache):
+    callbacks: List[Callable[[], None]] = []
+    repository = CachedUserRepository(InMemoryUserRepository(), cache, callbacks.append)
+    user = repository.create_user(username='alice', email='alice@example.com', pwhash='')
+
+    user = User(**{**user.model_dump(), 'email': 'alice@example.org'})
+    repository.update_user(user.id, user)
+    assert repository.get_user_by_email('alice@example.org') is not None
+    assert repository.get_users_by_ids([user.id])[0].email == 'alice@example.org'
+    assert cache.entries == {}
+
+    # Rolling back drops the callbacks, leaving nothing cached. Committing runs them.
+    for callback in callbacks:
+        callback()
+    assert cache.get_user_by_email('alice@example.org') is not None
+    assert repository.pending_ids == set()
@@ -0,0 +1,58 @@
+
+import asyncio
+import threading
+import pytest
+
+from app.hashing import PasswordHashingBusyError, PasswordHashingPool
+
+###################################################################################################
+#
+#   Fixtures
+#
+###################################################################################################
+
+
+@pytest.fixture(scope='function')
+def pool() -> PasswordHashingPool:
+    # A budget smaller than a single hash still gets one worker
+    return PasswordHashingPool(max_memory=0, max_queue_size=1)
+
+
+###################################################################################################
+#
+#   Tests
+#
+###################################################################################################
+
+def test_hash_and_verify(pool: PasswordHashingPool):
+    async def scenario():
+        hashed = await pool.hash_password('password')
+        return await pool.verify_password('password', hashed), await pool.verify_password('wrong', hashed)
+
+    assert asyncio.run(scenario()) == (True, False)
+
+    stats = pool.get_stats()
+    assert stats['workers'] == 1
+    assert stats['completed'] == 3
+    assert stats['pending'] == 0
+    assert stats['hash_seconds_total'] > 0
+
+
+def test_rejects_when_queue_is_full(pool: PasswordHashingPool):
+    release = threading.Event()
+
+    async def scenario():
+        # One request occupies the worker and another waits in the queue
+        running = asyncio.create_task(pool._run(release.wait))
+        queued = asyncio.create_task(pool._run(release.wait))
+        await asyncio.sleep(0)
+
+        with pytest.raises(PasswordHashingBusyError):
+            await pool.hash_password('password')
+
+        release.set()
+        return await running, await queued
+
+    assert asyncio.run(scenario()) == (True, True)
+    assert pool.get_stats()['rejected'] == 1
+    assert pool.get_stats()['queue_wait_seconds_max'] > 0
@@ -0,0 +1,96 @@
+
+import asyncio
+import pytest
+
+from app.dto.conversation import ConversationMessageDTO
+from app.notifications import NotificationBus, Subscription
+from shared.time import get_current_time
+
+###################################################################################################
+#
+#   Fixtures
+#
+###################################################################################################
+
+
+@pytest.fixture(scope='function')
+def bus() -> NotificationBus:
+    return NotificationBus()
+
+
+def make_message(id: int) -> ConversationMessageDTO:
+    return ConversationMessageDTO(
+        id=id,
+        created_at=get_current_time(),
+        sender='test',
+        sender_id='test-id',
+        content=f'message {id}'
+    )
+
+
+
+###################################################################################################
+#
+#   Tests
+#
+###################################################################################################
+
+def test_publish_fans_out_to_subscribers(bus: NotificationBus):
+    first = Subscription(max_queue_size=4)
+    second = Subscription(max_queue_size=4)
+    bus.subscribe('convo', first)
+    bus.subscribe('convo', second)
+
+    bus.publish_message('convo', make_message(1))
+
+    event = first.queue.get_nowait()
+    assert event.message_id == 1
+    assert second.queue.get_nowait() is event
+
+
+def test_publish_evicts_slow_subscribers(bus: NotificationBus):
+    subscription = Subscription(max_queue_size=1)
+    bus.subscribe('convo', subscription)
+
+    bus.publish_message('convo', make_message(1))
+    bus.publish_message('convo', make_message(2))
+
+    assert subscription.evicted
+    assert 'convo' not in bus.subscriptions
+
+
+def test_unsubscribe_all(bus: NotificationBus):
+    subscription = Subscription(max_queue_size=4)
+    bus.subscribe('first', subscription)
+    bus.subscribe('second', subscription)
+
+    bus.unsubscribe_all(subscription)
+
+    assert bus.subscriptions == {}
+    assert subscription.conversation_ids == set()
+
+
+def test_wait_for_message_wakes_on_publish(bus: NotificationBus):
+    async def scenario():
+        waiter = asyncio.create_task(bus.wait_for_message('convo', after=0, timeout=5))
+        await asyncio.sleep(0)
+        bus.publish_message('convo', make_message(1))
+        return await waiter
+
+    assert asyncio.run(scenario()) is True
+    assert bus.conditions == {}
+
+
+def test_wait_for_message_times_out(bus: NotificationBus):
+    assert asyncio.run(bus.wait_for_message('convo', after=0, timeout=0.01)) is False
+
+
+def test_versions_track_activity(bus: NotificationBus):
+    assert bus.get_conversation_version('a') == (0, 0)
+
+    bus.publish_message('a', make_message(5))
+    bus.publish_membership_change('a', ['alice', 'bob'])
+    assert bus.get_conversation_version('a') == (5, 1)
+    assert bus.get_conversation_version('b') == (0, 0)
+    assert bus.get_conversation_list_version('alice') == 1
+    assert bus.get_conversation_list_version('carol') == 0
@@ -0,0 +1,128 @@
+import pytest
+from sqlalchemy import Engine, text
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Session, SQLModel, create_engine
+from typing import List
+
+from app.models.message import Message
+from app.repositories.message import ShardedMessageRepository, get_shard_index
+from main import MESSAGE_SHARD_ID_SPACING, rebalance_messages, setup_message_shards
+
+###################################################################################################
+#
+#   Fixtures
+#
+###################################################################################################
+
+
+def make_engine() -> Engine:
+    return create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+
+
+@pytest.fixture(scope='function')
+def shard_engines() -> List[Engine]:
+    engines = [make_engine() for _ in range(3)]
+    setup_message_shards(engines, upgrade=False)
+    return engines
+
+
+@pytest.fixture(scope='module')
+def conversation_ids() -> List[str]:
+    return [f'conversation {x}' for x in range(20)]
+
+
+def make_repository(engines: List[Engine]) -> ShardedMessageRepository:
+    return ShardedMessageRepository(lambda x: Session(engines[x]), len(engines))
+
+
+def get_sequence(engine: Engine) -> int:
+    with engine.connect() as connection:
+        return connection.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'message'")).scalar_one()
+
+
+
+###################################################################################################
+#
+#   Tests
+#
+###################################################################################################
+
+def test_rebalance_after_adding_a_shard(shard_engines: List[Engine], conversation_ids: List[str], capsys: pytest.CaptureFixture):
+    # Conversations written while there were two shards...
+    before = make_repository(shard_engines[:2])
+    for id in conversation_ids:
+        before.create_messages(id, 'sender', ['first', 'second'])
+
+    # ...are moved onto the shard they belong to once there are three
+    repository = make_repository(shard_engines)
+    misplaced = [x for x in conversation_ids if get_shard_index(x, 2) != get_shard_index(x, 3)]
+    assert misplaced
+
+    rebalance_messages(repository, batch_size=1)
+    assert capsys.readouterr().out.count('moved 2 messages') == len(misplaced)
+    assert repository.find_misplaced_conversations() == []
+
+    for id in conversation_ids:
+        assert [x.content for x in repository.get_messages_for_conversation(id)] == ['first', 'second']
+
+    # Messages posted since don't collide with the ones moved in
+    for id in conversation_ids:
+        repository.create_message(id, 'sender', 'third')
+        assert [x.content for x in repository.get_messages_for_conversation(id)] == ['first', 'second', 'third']
+
+
+def test_rebalance_dry_run_moves_nothing(shard_engines: List[Engine], conversation_ids: List[str], capsys: pytest.CaptureFixture):
+    before = make_repository(shard_engines[:2])
+    for id in conversation_ids:
+        before.create_message(id, 'sender', 'message')
+
+    repository = make_repository(shard_engines)
+    misplaced = repository.find_misplaced_conversations()
+
+    rebalance_messages(repository, batch_size=10, dry_run=True)
+    output = capsys.readouterr().out
+    assert all(f"Conversation '{id}': shard {source} -> {target}" in output for id, source, target in misplaced)
+    assert 'moved' not in output
+    assert repository.find_misplaced_conversations() == misplaced
+
+
+def test_shard_sequences_are_seeded(shard_engines: List[Engine]):
+    assert [get_sequence(x) for x in shard_engines] == [x * MESSAGE_SHARD_ID_SPACING for x in range(3)]
+
+
+def test_existing_shard_sequences_are_moved_into_range():
+    # The second shard's message table already exists and has allocated IDs of its own
+    engines = [make_engine(), make_engine()]
+    SQLModel.metadata.create_all(engines[1], tables=[SQLModel.metadata.tables['message']])
+    with Session(engines[1]) as session:
+        session.add(Message(conversation_id='existing', sender_id='sender', content='existing'))
+        session.commit()
+
+    setup_message_shards(engines, upgrade=True)
+    setup_message_shards(engines, upgrade=True)
+    assert get_sequence(engines[1]) == MESSAGE_SHARD_ID_SPACING
+
+    repository = make_repository(engines[1:])
+    message = repository.create_message('existing', 'sender', 'new')
+    assert message.id == MESSAGE_SHARD_ID_SPACING + 1
+
+
+def test_sequence_problems_are_reported(capsys: pytest.CaptureFixture):
+    engines = [make_engine(), make_engine()]
+
+    # The first shard has run into the second's range...
+    SQLModel.metadata.create_all(engines[0], tables=[SQLModel.metadata.tables['message']])
+    with Session(engines[0]) as session:
+        session.add(Message(id=MESSAGE_SHARD_ID_SPACING + 1, conversation_id='c', sender_id='sender', content='message'))
+        session.commit()
+
+    # ...and the second's table can't be seeded at all
+    with engines[1].begin() as connection:
+        connection.execute(
+            text('CREATE TABLE message (id INTEGER PRIMARY KEY, conversation_id VARCHAR, sender_id VARCHAR, content VARCHAR, created_at DATETIME)')
+        )
+
+    setup_message_shards(engines, upgrade=True)
+    output = capsys.readouterr().out
+    assert 'The ID sequence of message shard 0 has reached the range of shard 1' in output
+    assert 'Unable to seed the ID sequence of message shard 1' in output
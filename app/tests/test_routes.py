@@ -0,0 +1,481 @@
+import asyncio
+import httpx
+import json
+import pytest
+import time
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from sqlmodel import Session, SQLModel, create_engine
+from typing import Any, Dict, List, MutableMapping, Optional
+
+import main
+from app import dependencies
+from app.config import settings
+from shared.password import hash_password
+
+###################################################################################################
+#
+#   Fixtures
+#
+###################################################################################################
+
+
+@pytest.fixture(scope='function', autouse=True)
+def database(tmp_path, monkeypatch: pytest.MonkeyPatch) -> None:
+    '''
+    Points the application at a fresh database for each test
+    '''
+    url = f'sqlite:///{tmp_path}/test.sqlite'
+    engine = create_engine(url)
+    SQLModel.metadata.create_all(engine)
+
+    # Every test runs in its own event loop, so async connections mustn't outlive it in a pool
+    async_engine = create_async_engine(dependencies.get_async_url(url), poolclass=NullPool)
+
+    monkeypatch.setattr(dependencies, 'SessionFactory', sessionmaker(bind=engine, class_=Session, autoflush=False))
+    monkeypatch.setattr(
+        dependencies,
+        'AsyncSessionFactory',
+        async_sessionmaker(bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+    )
+
+
+def make_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url='http://test')
+
+
+async def register(client: httpx.AsyncClient, username: str) -> Dict[str, str]:
+    '''
+    Creates and logs in a user, returning the headers that authenticate as them. Users are created
+    directly, as registering checks that the email address's domain exists.
+    '''
+    with dependencies.open_engine() as engine:
+        engine.user_repository.create_user(
+            username=username,
+            email=f'{username}@example.com',
+            pwhash=hash_password('password')
+        )
+
+    response = await client.post('/auth/login', data={'username': username, 'password': 'password'})
+    return {'Authorization': f"Bearer {response.json()['access_token']}"}
+
+
+async def start_conversation(client: httpx.AsyncClient, headers: Dict[str, str], participants: List[str]) -> str:
+    response = await client.post('/conversations/', json={'name': 'test', 'participants': participants}, headers=headers)
+    assert response.status_code == 200
+
+    response = await client.get('/conversations/', headers=headers)
+    return response.json()['conversations'][0]['id']
+
+
+async def post_messages(client: httpx.AsyncClient, headers: Dict[str, str], id: str, count: int) -> List[int]:
+    ids = []
+    for x in range(count):
+        response = await client.post(f'/conversations/{id}/messages', json={'content': f'message {x}'}, headers=headers)
+        ids.append(response.json()['id'])
+    return ids
+
+
+class EventStream:
+    '''
+    Drives a Server-Sent Events response directly through the ASGI interface, as HTTP test
+    clients only return once the response is complete. Clearing 'reading' makes the client stall.
+    '''
+
+    def __init__(self, path: str, headers: Dict[str, str]):
+        self.scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode(),
+            'root_path': '',
+            'query_string': b'',
+            'headers': [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+            'client': ('127.0.0.1', 1234),
+            'server': ('test', 80)
+        }
+        self.messages: asyncio.Queue = asyncio.Queue()
+        self.buffer = ''
+        self.status: Optional[int] = None
+        self.requested = False
+        self.started = asyncio.Event()
+        self.reading = asyncio.Event()
+        self.reading.set()
+        self.disconnected = asyncio.Event()
+        self.task = asyncio.create_task(main.app(self.scope, self.receive, self.send))
+
+
+    async def receive(self) -> Dict[str, Any]:
+        if not self.requested:
+            self.requested = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await self.disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+
+    async def send(self, message: MutableMapping[str, Any]) -> None:
+        self.started.set()
+        await self.reading.wait()
+        await self.messages.put(message)
+
+
+    async def read_events(self, count: int) -> List[Dict[str, str]]:
+        '''
+        Reads the next 'count' message events, skipping anything else (e.g. heartbeats)
+        '''
+        events: List[Dict[str, str]] = []
+        while len(events) < count:
+            while '\n\n' not in self.buffer:
+                message = await asyncio.wait_for(self.messages.get(), 5)
+                if message['type'] == 'http.response.start':
+                    self.status = message['status']
+                else:
+                    self.buffer += message.get('body', b'').decode()
+
+            block, self.buffer = self.buffer.split('\n\n', 1)
+            fields = dict(x.split(': ', 1) for x in block.split('\n') if ': ' in x and not x.startswith(':'))
+            if fields.get('event', None) == 'message':
+                events.append(fields)
+        return events
+
+
+    async def close(self) -> None:
+        self.disconnected.set()
+        await asyncio.wait_for(self.task, 5)
+
+
+
+###################################################################################################
+#
+#   Pagination
+#
+###################################################################################################
+
+def test_pages_follow_cursors_forwards():
+    async def scenario():
+        async with make_client() as client:
+            alice = await register(client, 'alice')
+            id = await start_conversation(client, alice, ['alice'])
+            ids = await post_messages(client, alice, id, 7)
+
+            seen, after, pages = [], None, 0
+            while True:
+                params = {'limit': 3} if after is None else {'limit': 3, 'after': after}
+                page = (await client.get(f'/conversations/{id}/messages', params=params, headers=alice)).json()
+                seen.extend(x['id'] for x in page['messages'])
+                after, pages = page['next_cursor'], pages + 1
+                if not page['has_more']:
+                    break
+
+            assert seen == ids
+            assert pages == 3
+
+            # Readers at the end are handed their own cursor back, to poll from
+            page = (await client.get(f'/conversations/{id}/messages', params={'after': after}, headers=alice)).json()
+            assert page == {'messages': [], 'next_cursor': ids[-1], 'has_more': False}
+
+    asyncio.run(scenario())
+
+
+def test_pages_follow_cursors_backwards():
+    async def scenario():
+        async with make_client() as client:
+            alice = await register(client, 'alice')
+            id = await start_conversation(client, alice, ['alice'])
+            ids = await post_messages(client, alice, id, 7)
+
+            page = (await client.get(f'/conversations/{id}/messages', params={'before': ids[6], 'limit': 2}, headers=alice)).json()
+            assert [x['id'] for x in page['messages']] == ids[4:6]
+            assert page['has_more'] and page['next_cursor'] == ids[4]
+
+            seen = [x['id'] for x in page['messages']]
+            while page['has_more']:
+                page = (await client.get(
+                    f'/conversations/{id}/messages', params={'before': page['next_cursor'], 'limit': 2}, headers=alice
+                )).json()
+                seen = [x['id'] for x in page['messages']] + seen
+
+            assert seen == ids[:6]
+            assert page['next_cursor'] is None
+
+    asyncio.run(scenario())
+
+
+def test_pages_are_bounded(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(settings, 'MESSAGES_PAGE_MAX_LIMIT', 2)
+
+    async def scenario():
+        async with make_client() as client:
+            alice = await register(client, 'alice')
+            id = await start_conversation(client, alice, ['alice'])
+            ids = await post_messages(client, alice, id, 3)
+
+            page = (await client.get(f'/conversations/{id}/messages', params={'limit': 50}, headers=alice)).json()
+            assert [x['id'] for x in page['messages']] == ids[:2]
+            assert page['has_more']
+
+            response = await client.get(f'/conversations/{id}/messages', params={'limit': 0}, headers=alice)
+            assert response.status_code == 422
+
+    asyncio.run(scenario())
+
+
+
+###################################################################################################
+#
+#   Long-polling
+#
+###################################################################################################
+
+def test_long_poll_wakes_on_new_message():
+    async def scenario():
+        async with make_client() as client:
+            alice = await register(client, 'alice')
+            bob = await register(client, 'bob')
+            id = await start_conversation(client, alice, ['alice', 'bob'])
+            ids = await post_messages(client, alice, id, 1)
+
+            async def poll():
+                started = time.monotonic()
+                response = await client.get(f'/conversations/{id}/messages', params={'after': ids[0], 'wait': 10}, headers=bob)
+                return response.json(), time.monotonic() - started
+
+            async def post():
+                await asyncio.sleep(0.2)
+                return await post_messages(client, alice, id, 1)
+
+            (page, elapsed), posted = await asyncio.gather(poll(), post())
+            assert [x['id'] for x in page['messages']] == posted
+            assert elapsed < 5
+
+    asyncio.run(scenario())
+
+
+def test_long_poll_times_out_empty():
+    async def scenario():
+        async with make_client() as client:
+            alice = await register(client, 'alice')
+            id = await start_conversation(client, alice, ['alice'])
+            ids = await post_messages(client, alice, id, 1)
+
+            started = time.monotonic()
+            response = await client.get(f'/conversations/{id}/messages', params={'after': ids[0], 'wait': 0.3}, headers=alice)
+            assert time.monotonic() - started >= 0.3
+            assert response.json() == {'messages': [], 'next_cursor': ids[0], 'has_more': False}
+
+    asyncio.run(scenario())
+
+
+
+###################################################################################################
+#
+#   Streaming
+#
+###################################################################################################
+
+def test_stream_replays_from_last_event_id():
+    async def scenario():
+        async with make_client() as client:
+            alice = await register(client, 'alice')
+            bob = await register(client, 'bob')
+            id = await start_conversation(client, alice, ['alice', 'bob'])
+            ids = await post_messages(client, alice, id, 3)
+
+            stream = EventStream(f'/conversations/{id}/stream', {**bob, 'Last-Event-ID': str(ids[0])})
+            replayed = await stream.read_events(2)
+            assert stream.status == 200
+            assert [int(x['id']) for x in replayed] == ids[1:]
+
+            # Live messages follow the replay
+            posted = await post_messages(client, alice, id, 1)
+            live = await stream.read_events(1)
+            assert [int(x['id']) for x in live] == posted
+            assert json.loads(live[0]['data'])['content'] == 'message 0'
+
+            await stream.close()
+            assert id not in dependencies.notification_bus.subscriptions
+
+    asyncio.run(scenario())
+
+
+def test_stream_evicts_slow_subscribers(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(settings, 'STREAM_SUBSCRIBER_QUEUE_SIZE', 2)
+
+    async def scenario():
+        async with make_client() as client:
+            alice = await register(client, 'alice')
+            bob = await register(client, 'bob')
+            id = await start_conversation(client, alice, ['alice', 'bob'])
+
+            # Bob subscribes but stops reading, so his queue overflows
+            stream = EventStream(f'/conversations/{id}/stream', bob)
+            stream.reading.clear()
+            await asyncio.wait_for(stream.started.wait(), 5)
+            ids = await post_messages(client, alice, id, 3)
+            assert id not in dependencies.notification_bus.subscriptions
+
+            # His stream ends as soon as he catches up, and he resumes from storage
+            stream.reading.set()
+            await asyncio.wait_for(stream.task, 5)
+
+            stream = EventStream(f'/conversations/{id}/stream', {**bob, 'Last-Event-ID': '0'})
+            assert [int(x['id']) for x in await stream.read_events(3)] == ids
+            await stream.close()
+
+    asyncio.run(scenario())
+
+
+def test_stream_requires_membership():
+    async def scenario():
+        async with make_client() as client:
+            alice = await register(client, 'alice')
+            carol = await register(client, 'carol')
+            id = await start_conversation(client, alice, ['alice'])
+
+            response = await client.get(f'/conversations/{id}/stream', headers=carol)
+            assert response.status_code == 403
+
+    asyncio.run(scenario())
+
+
+
+###################################################################################################
+#
+#   Posting
+#
+###################################################################################################
+
+def test_only_members_can_post():
+    async def scenario():
+        async with make_client() as client:
+            alice = await register(client, 'alice')
+            carol = await register(client, 'carol')
+            id = await start_conversation(client, alice, ['alice'])
+
+            response = await client.post(f'/conversations/{id}/messages', json={'content': 'hello'}, headers=carol)
+            assert response.status_code == 403
+
+            response = await client.post(f'/conversations/{id}/messages:batch', json=[{'content': 'hello'}], headers=carol)
+            assert response.status_code == 403
+
+            page = (await client.get(f'/conversations/{id}/messages', headers=alice)).json()
+            assert page['messages'] == []
+
+    asyncio.run(scenario())
+
+
+def test_batches_are_posted_in_order():
+    async def scenario():
+        async with make_client() as client:
+            alice = await register(client, 'alice')
+            id = await start_conversation(client, alice, ['alice'])
+            before = await post_messages(client, alice, id, 1)
+
+            response = await client.post(
+                f'/conversations/{id}/messages:batch', json=[{'content': f'batch {x}'} for x in range(5)], headers=alice
+            )
+            assert response.status_code == 200
+            ids = response.json()['ids']
+            assert len(ids) == 5 and ids == sorted(ids) and ids[0] > before[0]
+
+            page = (await client.get(f'/conversations/{id}/messages', params={'after': before[0]}, headers=alice)).json()
+            assert [(x['id'], x['content']) for x in page['messages']] == [(x, f'batch {n}') for n, x in enumerate(ids)]
+
+    asyncio.run(scenario())
+
+
+def test_batches_are_bounded(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(settings, 'MESSAGES_BATCH_MAX_SIZE', 3)
+
+    async def scenario():
+        async with make_client() as client:
+            alice = await register(client, 'alice')
+            id = await start_conversation(client, alice, ['alice'])
+
+            response = await client.post(f'/conversations/{id}/messages:batch', json=[{'content': 'x'}] * 4, headers=alice)
+            assert response.status_code == 400
+
+            response = await client.post(f'/conversations/{id}/messages:batch', json=[{'content': 'x'}] * 3, headers=alice)
+            assert response.status_code == 200
+
+            page = (await client.get(f'/conversations/{id}/messages', headers=alice)).json()
+            assert len(page['messages']) == 3
+
+    asyncio.run(scenario())
+
+
+
+###################################################################################################
+#
+#   Searching
+#
+###################################################################################################
+
+def test_search_pages_follow_cursors():
+    async def scenario():
+        async with make_client() as client:
+            alice = await register(client, 'alice')
+            id = await start_conversation(client, alice, ['alice'])
+            ids = await post_messages(client, alice, id, 5)
+
+            seen, cursor = [], None
+            while True:
+                params: Dict[str, Any] = {'q': 'message', 'limit': 2}
+                if cursor is not None:
+                    params['cursor'] = cursor
+                page = (await client.get(f'/conversations/{id}/search', params=params, headers=alice)).json()
+                seen.extend(x['message']['id'] for x in page['results'])
+                if not page['has_more']:
+                    break
+                cursor = page['next_cursor']
+
+            assert sorted(seen) == ids
+
+    asyncio.run(scenario())
+
+
+def test_search_rejects_malformed_cursors():
+    async def scenario():
+        async with make_client() as client:
+            alice = await register(client, 'alice')
+
+            for cursor in ['0:nan:1', '0:inf:1', '0:-inf:1', '1.5:1', '0:1.5', 'x:1.5:1', '']:
+                response = await client.get('/search', params={'q': 'message', 'cursor': cursor}, headers=alice)
+                assert response.status_code == 400, cursor
+
+    asyncio.run(scenario())
+
+
+
+###################################################################################################
+#
+#   Stats
+#
+###################################################################################################
+
+def test_stats_are_disabled_by_default():
+    async def scenario():
+        async with make_client() as client:
+            alice = await register(client, 'alice')
+            assert (await client.get('/stats/', headers=alice)).status_code == 404
+
+    asyncio.run(scenario())
+
+
+def test_stats_require_a_user(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(settings, 'STATS_ENABLED', True)
+
+    async def scenario():
+        async with make_client() as client:
+            alice = await register(client, 'alice')
+            assert (await client.get('/stats/')).status_code == 401
+
+            response = await client.get('/stats/', headers=alice)
+            assert response.status_code == 200
+            assert 'password_hashing' in response.json()
+
+    asyncio.run(scenario())
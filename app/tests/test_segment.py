@@ -0,0 +1,57 @@
+
+import os
+import pytest
+
+from shared.segment import SegmentReader, SegmentRecord, write_segment
+
+###################################################################################################
+#
+#   Fixtures
+#
+###################################################################################################
+
+
+@pytest.fixture(scope='function')
+def segment_path(tmp_path) -> str:
+    path = str(tmp_path / 'test.seg')
+    records = (SegmentRecord(id, 'sender-id', f'message {id} ' + 'x' * 50, id * 1000) for id in range(1, 101))
+
+    # Small blocks, so reads span several of them
+    write_segment(path, records, block_size=512)
+    return path
+
+
+###################################################################################################
+#
+#   Tests
+#
+###################################################################################################
+
+def test_write_segment_is_atomic(segment_path: str):
+    assert os.listdir(os.path.dirname(segment_path)) == ['test.seg']
+
+
+def test_read_range(segment_path: str):
+    with SegmentReader(segment_path) as reader:
+        assert len(reader.blocks) > 1
+        assert [x.id for x in reader.read()] == list(range(1, 101))
+        assert [x.id for x in reader.read(after=10, before=15)] == [11, 12, 13, 14]
+        assert reader.read(after=100) == []
+
+        record = reader.read(after=41, limit=1)[0]
+        assert record == SegmentRecord(42, 'sender-id', 'message 42 ' + 'x' * 50, 42000)
+
+
+def test_read_limit_and_reverse(segment_path: str):
+    with SegmentReader(segment_path) as reader:
+        assert [x.id for x in reader.read(after=20, limit=3)] == [21, 22, 23]
+        assert [x.id for x in reader.read(before=80, limit=3, reverse=True)] == [77, 78, 79]
+        assert [x.id for x in reader.read(limit=2, reverse=True)] == [99, 100]
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / 'other.seg'
+    path.write_bytes(b'\0' * 64)
+
+    with pytest.raises(ValueError):
+        SegmentReader(str(path))
@@ -1,27 +1,252 @@
 
 import argparse
+import asyncio
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from sqlmodel import SQLModel
+from sqlalchemy import Connection, Engine, Table, func, text
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlmodel import Session, SQLModel, col, select
+from datetime import timedelta
+from typing import AsyncIterator, List, Optional, Union, cast
 import uvicorn
 
 from app.config import settings
-from app.routes import auth, conversations, users
-from app.dependencies import get_engine, AppDependencyCollection, db_engine
+from app.routes import auth, conversations, search, stats, users, websocket
+from app.dependencies import get_engine, open_engine, AppDependencyCollection, db_engine, shard_engines
+from app.models.conversation import Conversation, ConversationSummary
+from app.models.message import MESSAGE_SEARCH_DDL, Message
+from app.models.messagesegment import ARCHIVED_SEGMENT_SEARCH_DDL, LEGACY_ARCHIVED_SEARCH_TABLES
+from app.repositories.archive import ArchivedMessageRepository
+from app.repositories.message import DbMessageRepository, ShardedMessageRepository
+from app.repositories.messagecache import CachedMessageRepository
 
+from app.sweeper import run_token_sweeper, sweep_expired_tokens
 from shared.password import hash_password
+from shared.time import get_current_time
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    '''
+    Runs the background tasks for as long as the application is being served
+    '''
+    sweeper = None
+    if settings.OAUTH2_TOKEN_SWEEP_INTERVAL > 0:
+        sweeper = asyncio.create_task(
+            run_token_sweeper(
+                settings.OAUTH2_TOKEN_SWEEP_INTERVAL,
+                settings.OAUTH2_TOKEN_SWEEP_BATCH_SIZE,
+                settings.OAUTH2_TOKEN_SWEEP_BATCH_PAUSE
+            )
+        )
+
+    yield
+
+    if sweeper is not None:
+        sweeper.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(auth.router)
 app.include_router(conversations.router)
+app.include_router(search.router)
+app.include_router(stats.router)
 app.include_router(users.router)
+app.include_router(websocket.router)
 
 @app.get('/')
 async def root() -> str:
     return 'ChatFlow'
 
 
+# Spacing between the starting points of each message shard's ID sequence. Conversations moved
+# between shards keep their IDs, this keeps them clear of the IDs allocated by the target shard.
+MESSAGE_SHARD_ID_SPACING = 1 << 40
+
+
+def upgrade_database(engine: Engine, tables: Optional[List[Table]] = None) -> None:
+    '''
+    Brings an existing database up to date with the current models. create_all() only creates
+    indexes alongside the tables it creates, so indexes added to tables that already exist
+    have to be built separately.
+    '''
+    SQLModel.metadata.create_all(engine, tables=tables)
+
+    for table in tables or SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(engine, checkfirst=True)
+            except IntegrityError as e:
+                print(f"Unable to build unique index '{index.name}', resolve the duplicates first: {e.orig}")
+
+
+def upgrade_access_tokens(engine: Engine) -> None:
+    '''
+    Adds the stored expiry to access tokens that predate it, filling it in for existing tokens
+    '''
+    with engine.begin() as connection:
+        columns = [row[1] for row in connection.execute(text('PRAGMA table_info(accesstoken)'))]
+        if not columns or 'expires_at' in columns:
+            return
+
+        connection.execute(text('ALTER TABLE accesstoken ADD COLUMN expires_at DATETIME'))
+        connection.execute(
+            text(
+                "UPDATE accesstoken SET expires_at = "
+                "strftime('%Y-%m-%d %H:%M:%f', created_at, '+' || time_to_live || ' seconds')"
+            )
+        )
+
+
+def setup_message_shards(engines: List[Engine], upgrade: bool) -> None:
+    '''
+    Creates the message table on every message shard and seeds each shard's ID sequence
+    '''
+    for index, engine in enumerate(engines):
+        if upgrade:
+            upgrade_database(engine, tables=[SQLModel.metadata.tables['message']])
+        else:
+            SQLModel.metadata.create_all(engine, tables=[SQLModel.metadata.tables['message']])
+
+        seed_message_shard_sequence(engine, index)
+
+
+def seed_message_shard_sequence(engine: Engine, index: int) -> None:
+    '''
+    Moves a shard's ID sequence up to the start of the shard's range. This includes shards whose
+    message table already existed (e.g. a former single database), whose sequence would otherwise
+    carry on allocating IDs in another shard's range.
+    '''
+    start = index * MESSAGE_SHARD_ID_SPACING
+    with engine.begin() as connection:
+        table = connection.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'message'")).scalar()
+        if table is None or 'AUTOINCREMENT' not in table.upper():
+            print(f'Unable to seed the ID sequence of message shard {index}, its message table predates AUTOINCREMENT')
+            return
+
+        # The sequence only gets a row once the first message is inserted
+        seq = connection.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'message'")).scalar()
+        if seq is None:
+            connection.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('message', :seq)"), {'seq': start})
+        elif seq < start:
+            connection.execute(text("UPDATE sqlite_sequence SET seq = :seq WHERE name = 'message'"), {'seq': start})
+
+    # Sequences never move backwards, so this one can only be reported
+    if seq is not None and seq >= start + MESSAGE_SHARD_ID_SPACING:
+        print(f'The ID sequence of message shard {index} has reached the range of shard {index + 1}, moves onto it may collide')
+
+
+def rebalance_messages(repository: ShardedMessageRepository, batch_size: int, dry_run: bool = False) -> None:
+    '''
+    Moves every conversation stored on the wrong shard onto the one it belongs to. Conversations
+    whose move collides with the target's IDs are reported and left where they are.
+    '''
+    for conversation_id, source, target in repository.find_misplaced_conversations():
+        print(f"Conversation '{conversation_id}': shard {source} -> {target}")
+        if dry_run:
+            continue
+
+        try:
+            moved = repository.move_conversation(conversation_id, source, target, batch_size)
+            print(f'  moved {moved} messages')
+        except ValueError as e:
+            print(f'  skipped: {e}')
+
+
+def get_hot_message_repository(engine: AppDependencyCollection) -> Union[DbMessageRepository, ShardedMessageRepository]:
+    '''
+    Retrieves the repository for the message table itself, without any archive or cache in front of it.
+    Only meaningful for the database storage backend.
+    '''
+    repository = engine.message_repository
+    while isinstance(repository, (ArchivedMessageRepository, CachedMessageRepository)):
+        repository = repository.repository
+    return cast(Union[DbMessageRepository, ShardedMessageRepository], repository)
+
+
+def setup_message_search(engine: Engine, rebuild: bool = False) -> None:
+    '''
+    Creates the full-text index over messages where it's missing, indexing any existing messages.
+    Databases created by dbsetup already have it, this brings older databases up to date.
+    '''
+    with engine.begin() as connection:
+        exists = connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'message_fts'")).first()
+        for statement in MESSAGE_SEARCH_DDL:
+            connection.execute(text(statement))
+
+        if rebuild or not exists:
+            rebuild_message_search(connection)
+
+
+def rebuild_message_search(connection: Connection) -> None:
+    '''
+    Re-indexes every message from scratch
+    '''
+    connection.execute(text("INSERT INTO message_fts (message_fts) VALUES ('rebuild')"))
+    count = connection.execute(text('SELECT COUNT(*) FROM message')).scalar()
+    print(f'Indexed {count} messages for search')
+
+
+def setup_archive_search(rebuild: bool = False) -> None:
+    '''
+    Indexes archived messages for search where the archive predates the index
+    '''
+    if settings.MESSAGES_ARCHIVE_DIR is None or settings.STORAGE_BACKEND == 'memory':
+        return
+
+    with db_engine.begin() as connection:
+        for name in LEGACY_ARCHIVED_SEARCH_TABLES:
+            connection.execute(text(f'DROP TABLE IF EXISTS {name}'))
+        for statement in ARCHIVED_SEGMENT_SEARCH_DDL:
+            connection.execute(text(statement))
+
+    with open_engine() as engine:
+        archive = ArchivedMessageRepository(
+            get_hot_message_repository(engine),
+            engine.session,
+            settings.MESSAGES_ARCHIVE_DIR
+        )
+        if rebuild or not archive.is_search_indexed():
+            print(f'Indexed {archive.rebuild_search_index()} archived messages for search')
+
+
+def backfill_conversation_summaries() -> None:
+    '''
+    Creates summaries for conversations that predate them, tallied from their existing messages
+    '''
+    with Session(db_engine) as session:
+        missing = session.exec(
+            select(Conversation).where(col(Conversation.id).not_in(select(ConversationSummary.conversation_id)))
+        ).all()
+        if not missing:
+            return
+
+        # Tally every conversation's messages, across all shards if messages are sharded
+        tallies = {}
+        for engine in shard_engines or [db_engine]:
+            with Session(engine) as message_session:
+                rows = message_session.exec(
+                    select(Message.conversation_id, func.max(Message.id), func.max(Message.created_at), func.count())
+                    .group_by(Message.conversation_id)
+                )
+                for conversation_id, last_id, last_at, count in rows:
+                    tallies[conversation_id] = (last_id, last_at, count)
+
+        for conversation in missing:
+            last_id, last_at, count = tallies.get(conversation.id, (None, conversation.created_at, 0))
+            session.add(
+                ConversationSummary(
+                    conversation_id=conversation.id,
+                    last_message_id=last_id,
+                    last_activity_at=last_at,
+                    message_count=count
+                )
+            )
+
+        session.commit()
+        print(f'Created summaries for {len(missing)} conversations')
+
+
 if __name__ == '__main__':
 
     # Create main parser and subparsers for commands
@@ -31,8 +256,38 @@ if __name__ == '__main__':
 
     # Add commands
     subparsers.add_parser('run', help='Run the application')
-    subparsers.add_parser('dbsetup', help='Setup the database')
+    dbsetup_parser = subparsers.add_parser('dbsetup', help='Setup the database')
+    dbsetup_parser.add_argument(
+        '--upgrade',
+        action='store_true',
+        help='Build any missing indexes and summaries on an existing database'
+    )
     subparsers.add_parser('seed', help='Seed the database')
+    rebalance_parser = subparsers.add_parser(
+        'rebalance-messages',
+        help='Move conversations onto the message shard they belong to after changing shards'
+    )
+    rebalance_parser.add_argument('--dry-run', action='store_true', help='Only list what would move')
+    rebalance_parser.add_argument('--batch-size', type=int, default=1000, help='Messages per transaction')
+    subparsers.add_parser('rebuild-search-index', help='Re-index every message for full-text search')
+    archive_parser = subparsers.add_parser(
+        'archive-messages',
+        help='Move old messages into compressed segments and drop segments past retention'
+    )
+    archive_parser.add_argument('--batch-size', type=int, default=1000, help='Messages deleted per transaction')
+    purge_parser = subparsers.add_parser('purge-tokens', help='Delete expired access tokens')
+    purge_parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=settings.OAUTH2_TOKEN_SWEEP_BATCH_SIZE,
+        help='Tokens deleted per transaction'
+    )
+    purge_parser.add_argument(
+        '--pause',
+        type=float,
+        default=settings.OAUTH2_TOKEN_SWEEP_BATCH_PAUSE,
+        help='Seconds to pause between transactions'
+    )
 
     # Parse arguments
     args = parser.parse_args()
@@ -42,39 +297,87 @@ if __name__ == '__main__':
         uvicorn.run('main:app', host='0.0.0.0', port=settings.SERVER_PORT, reload=True)
 
     elif args.command == 'dbsetup':
-        SQLModel.metadata.create_all(db_engine)
+        if args.upgrade:
+            upgrade_access_tokens(db_engine)
+            upgrade_database(db_engine)
+        else:
+            SQLModel.metadata.create_all(db_engine)
+        setup_message_shards(shard_engines, args.upgrade)
+
+        if args.upgrade:
+            for engine in shard_engines or [db_engine]:
+                setup_message_search(engine)
+            setup_archive_search()
+            backfill_conversation_summaries()
 
     elif args.command == 'seed':
-        engine = next(get_engine())
-        alice = engine.user_repository.create_user(
+        app_engine = next(get_engine())
+        alice = app_engine.user_repository.create_user(
             username='alice',
             email='alice@example.com',
             pwhash=hash_password('password')
         )
-        bob = engine.user_repository.create_user(
+        bob = app_engine.user_repository.create_user(
             username='bob',
             email='bob@example.com',
             pwhash=hash_password('password')
         )
-        charlie = engine.user_repository.create_user(
+        charlie = app_engine.user_repository.create_user(
             username='charlie',
             email='charlie@example.com',
             pwhash=hash_password('password')
         )
 
-        convo = engine.conversation_repository.create_conversation(
-            name="Alice, Bob and Charlie"
+        app_engine.conversation_repository.create_conversation(
+            name="Alice, Bob and Charlie",
+            user_ids=[alice.id, bob.id, charlie.id]
         )
-        engine.membership_repository.create_membership(convo.id, alice.id)
-        engine.membership_repository.create_membership(convo.id, bob.id)
-        engine.membership_repository.create_membership(convo.id, charlie.id)
-
-        convo = engine.conversation_repository.create_conversation(
-            name="Alice & Bob"
+        app_engine.conversation_repository.create_conversation(
+            name="Alice & Bob",
+            user_ids=[alice.id, bob.id]
         )
-        engine.membership_repository.create_membership(convo.id, alice.id)
-        engine.membership_repository.create_membership(convo.id, bob.id)
 
+    elif args.command == 'rebalance-messages':
+        with open_engine() as app_engine:
+            repository = get_hot_message_repository(app_engine)
+            if not isinstance(repository, ShardedMessageRepository):
+                parser.exit(status=1, message='Messages are not sharded, see MESSAGE_SHARD_URLS\n')
+
+            rebalance_messages(repository, args.batch_size, dry_run=args.dry_run)
+
+    elif args.command == 'rebuild-search-index':
+        for engine in shard_engines or [db_engine]:
+            setup_message_search(engine, rebuild=True)
+        setup_archive_search(rebuild=True)
+
+    elif args.command == 'archive-messages':
+        if settings.MESSAGES_ARCHIVE_DIR is None or settings.STORAGE_BACKEND == 'memory':
+            parser.exit(status=1, message='Archiving is disabled, see MESSAGES_ARCHIVE_DIR\n')
+
+        with open_engine() as app_engine:
+            archive = ArchivedMessageRepository(
+                get_hot_message_repository(app_engine),
+                app_engine.session,
+                settings.MESSAGES_ARCHIVE_DIR
+            )
+
+            cutoff = get_current_time() - timedelta(days=settings.MESSAGES_ARCHIVE_AFTER_DAYS)
+            for conversation_id, up_to_id in archive.repository.find_messages_created_before(cutoff).items():
+                archived = archive.archive_conversation(
+                    conversation_id,
+                    up_to_id,
+                    settings.MESSAGES_ARCHIVE_SEGMENT_MAX_MESSAGES,
+                    args.batch_size
+                )
+                print(f"Conversation '{conversation_id}': archived {archived} messages")
+
+            if settings.MESSAGES_RETENTION_DAYS is not None:
+                cutoff = get_current_time() - timedelta(days=settings.MESSAGES_RETENTION_DAYS)
+                print(f'Dropped {archive.drop_segments(cutoff)} messages past retention')
+
+    elif args.command == 'purge-tokens':
+        deleted = asyncio.run(sweep_expired_tokens(args.batch_size, args.pause))
+        print(f'Deleted {deleted} expired access tokens')
 
     else:
         parser.print_help()
@@ -3,7 +3,7 @@ import argon2
 
 
 # Limit exported symbols to just routines
-__all__ = [ "hash_password", "verify_password", "is_needing_rehash" ]
+__all__ = [ "hash_password", "verify_password", "is_needing_rehash", "get_memory_cost" ]
 
 
 # Argon2 profile for the password hasher. The following settings define the
@@ -51,3 +51,9 @@ def is_needing_rehash(hashed: bytes) -> bool:
     '''
     return _hasher.check_needs_rehash(hashed)
 
+
+def get_memory_cost() -> int:
+    '''
+    Returns the number of bytes of memory allocated by each hash or verification
+    '''
+    return _hasher.memory_cost * 1024
@@ -0,0 +1,153 @@
+
+import json
+import mmap
+import os
+import struct
+import zlib
+from typing import Iterable, List, NamedTuple, Optional
+
+
+# Limit exported symbols to the segment format's public interface
+__all__ = [ "SegmentRecord", "SegmentReader", "write_segment" ]
+
+
+# Segment files are immutable once written and laid out as follows:
+#
+#   [block 0][block 1]...[block N-1][index][footer]
+#
+# Each block is a zlib-compressed run of records (one JSON array per line), ordered by ID. The
+# index holds one entry per block: the first and last record IDs it contains along with its
+# offset and length within the file. The footer locates the index.
+_INDEX_ENTRY = struct.Struct('<qqQI')
+_FOOTER = struct.Struct('<QI8s')
+_MAGIC = b'CFSEG001'
+
+
+class SegmentRecord(NamedTuple):
+    id: int
+    sender_id: str
+    content: str
+
+    # Microseconds since the epoch, UTC
+    created_at: int
+
+
+def write_segment(path: str, records: Iterable[SegmentRecord], block_size: int = 64 * 1024) -> int:
+    '''
+    Writes records, which must be ordered by ascending ID, to a new segment file. Blocks are cut
+    once they reach roughly 'block_size' bytes before compression. The file is written under a
+    temporary name and moved into place once durable, so readers never see a partial segment.
+    Returns the size of the file in bytes.
+    '''
+    temporary_path = path + '.tmp'
+    index = []
+
+    with open(temporary_path, 'wb') as file:
+        lines: List[bytes] = []
+        first_id = last_id = None
+        pending = 0
+
+        def flush_block() -> None:
+            nonlocal lines, pending
+            block = zlib.compress(b'\n'.join(lines))
+            index.append(_INDEX_ENTRY.pack(first_id, last_id, file.tell(), len(block)))
+            file.write(block)
+            lines, pending = [], 0
+
+        for record in records:
+            line = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            if not lines:
+                first_id = record.id
+            last_id = record.id
+            lines.append(line)
+            pending += len(line) + 1
+
+            if pending >= block_size:
+                flush_block()
+
+        if lines:
+            flush_block()
+
+        index_offset = file.tell()
+        file.write(b''.join(index))
+        file.write(_FOOTER.pack(index_offset, len(index), _MAGIC))
+        file.flush()
+        os.fsync(file.fileno())
+        size = file.tell()
+
+    os.replace(temporary_path, path)
+    return size
+
+
+
+class SegmentReader:
+    '''
+    Reads records from a segment file. The file is memory-mapped and only the blocks overlapping
+    the requested ID range are decompressed.
+    '''
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        index_offset, block_count, magic = _FOOTER.unpack_from(self.map, len(self.map) - _FOOTER.size)
+        if magic != _MAGIC:
+            self.map.close()
+            raise ValueError(f"'{path}' is not a message segment")
+
+        index = self.map[index_offset:index_offset + block_count * _INDEX_ENTRY.size]
+        self.blocks = list(_INDEX_ENTRY.iter_unpack(index))
+
+
+    def close(self) -> None:
+        self.map.close()
+
+
+    def __enter__(self) -> 'SegmentReader':
+        return self
+
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+    def read(
+        self,
+        after: Optional[int] = None,
+        before: Optional[int] = None,
+        limit: Optional[int] = None,
+        reverse: bool = False
+    ) -> List[SegmentRecord]:
+        '''
+        Returns the records with IDs between 'after' and 'before' (both exclusive), ordered by
+        ascending ID. With a limit, 'reverse' keeps the newest records rather than the oldest,
+        reading blocks from the end of the segment.
+        '''
+        blocks = [
+            x for x in self.blocks
+            if (after is None or x[1] > after) and (before is None or x[0] < before)
+        ]
+        if reverse:
+            blocks.reverse()
+
+        chunks: List[List[SegmentRecord]] = []
+        count = 0
+        for _, _, offset, length in blocks:
+            block = zlib.decompress(self.map[offset:offset + length])
+            matches = [
+                x for x in (SegmentRecord(*json.loads(line)) for line in block.split(b'\n'))
+                if (after is None or x.id > after) and (before is None or x.id < before)
+            ]
+
+            chunks.append(matches)
+            count += len(matches)
+            if limit is not None and count >= limit:
+                break
+
+        if reverse:
+            chunks.reverse()
+        records = [x for chunk in chunks for x in chunk]
+
+        if limit is not None:
+            records = records[-limit:] if reverse else records[:limit]
+        return records